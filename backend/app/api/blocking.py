@@ -0,0 +1,269 @@
+"""Runs the blocking work of API requests off the event loop
+
+The routers are async, but pyVmomi, proxmoxer and SQLAlchemy block. An
+endpoint decorated with @blocking runs on a dedicated, bounded thread pool,
+so a slow vCenter ties up one of its threads instead of the event loop and
+every other request of the worker.
+
+Each endpoint has a timeout, overridable in API_ENDPOINT_TIMEOUTS_SECONDS,
+after which the client gets a 504; the thread cannot be interrupted and
+finishes in the background, still counted as in flight. Once
+API_BLOCKING_MAX_PENDING calls are in flight new ones get a 503 instead of
+queueing without bound.
+
+Streamed responses whose items are produced by blocking code, such as a
+live vCenter crawl, go through executor.stream, which runs the iteration on
+the same pool as one call per stream.
+
+Because a timed-out call keeps running, endpoints must not use a database
+session from the request's dependencies, which FastAPI closes once the
+response is sent. An endpoint with a db parameter instead gets a session
+of its own, opened on the worker thread and closed when the call returns.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional
+
+from fastapi import HTTPException, status
+
+from app.config import settings
+from app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(samples, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 4)
+
+
+class EndpointStats:
+    """Counters and recent latencies of one endpoint"""
+    
+    # Latency samples kept for the percentiles
+    SAMPLES = 1024
+    
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.latencies = deque(maxlen=self.SAMPLES)
+        self.queue_waits = deque(maxlen=self.SAMPLES)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'latency_seconds': {
+                'p50': _percentile(self.latencies, 0.50),
+                'p95': _percentile(self.latencies, 0.95),
+                'p99': _percentile(self.latencies, 0.99),
+                'max': round(max(self.latencies), 4) if self.latencies else None
+            },
+            'queue_wait_p95_seconds': _percentile(self.queue_waits, 0.95)
+        }
+
+
+class BlockingExecutor:
+    """Bounded thread pool for the blocking calls of API requests, with metrics"""
+    
+    # Items a stream's producer may run ahead of the client
+    STREAM_QUEUE_DEPTH = 64
+    
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.workers = workers or settings.API_BLOCKING_WORKERS
+        self.max_pending = max_pending or settings.API_BLOCKING_MAX_PENDING
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='api-blocking')
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.peak_pending = 0
+        self.stats: Dict[str, EndpointStats] = {}
+    
+    async def run(self, name: str, func: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """Run func(*args, **kwargs) on the pool and await it, accounted under name"""
+        timeout = settings.API_ENDPOINT_TIMEOUTS_SECONDS.get(name, timeout)
+        
+        with self.lock:
+            stats = self.stats.setdefault(name, EndpointStats())
+            stats.calls += 1
+            if self.pending >= self.max_pending:
+                stats.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Server busy, try again shortly"
+                )
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+            stats.in_flight += 1
+            stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        
+        submitted = time.monotonic()
+        abandoned = threading.Event()
+        
+        def call():
+            started = time.monotonic()
+            with self.lock:
+                self.running += 1
+                stats.queue_waits.append(started - submitted)
+            try:
+                # A call that timed out while queued has nobody waiting for it
+                if not abandoned.is_set():
+                    return func(*args, **kwargs)
+            finally:
+                finished = time.monotonic()
+                with self.lock:
+                    self.running -= 1
+                    self.pending -= 1
+                    stats.in_flight -= 1
+                    stats.latencies.append(finished - submitted)
+        
+        future = asyncio.get_running_loop().run_in_executor(self.executor, call)
+        try:
+            # Shielded so a timeout or a client disconnect never drops a queued call's accounting
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            abandoned.set()
+            with self.lock:
+                stats.timeouts += 1
+            logger.warning(f"{name} timed out after {timeout}s")
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"Timed out after {timeout:g}s"
+            )
+        except HTTPException as e:
+            if e.status_code >= 500:
+                with self.lock:
+                    stats.errors += 1
+            raise
+        except Exception:
+            with self.lock:
+                stats.errors += 1
+            raise
+    
+    async def stream(self, name: str, items: Iterable) -> AsyncIterator:
+        """
+        Iterate items on the pool and yield them on the event loop
+        
+        One pool thread per stream iterates items into a bounded queue, so a
+        slow client holds back the producer rather than buffering without
+        bound. The stream is accounted under name as one call without a
+        timeout. When the client goes away the producer stops at its next
+        item and closes items, if it is a generator. Errors of the producer
+        are raised after the items it produced.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=self.STREAM_QUEUE_DEPTH)
+        stopped = threading.Event()
+        
+        def put(item) -> bool:
+            future = asyncio.run_coroutine_threadsafe(chunks.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.5)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stopped.is_set():
+                        future.cancel()
+                        return False
+        
+        def produce():
+            try:
+                for item in items:
+                    if stopped.is_set() or not put(item):
+                        break
+            finally:
+                close = getattr(items, 'close', None)
+                if close is not None:
+                    close()
+        
+        producer = asyncio.ensure_future(self.run(name, produce, timeout=None))
+        getter = None
+        try:
+            while True:
+                getter = asyncio.ensure_future(chunks.get())
+                await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    continue
+                getter.cancel()
+                while not chunks.empty():
+                    yield chunks.get_nowait()
+                producer.result()
+                return
+        finally:
+            stopped.set()
+            if getter is not None:
+                getter.cancel()
+            # Nobody awaits the producer of an abandoned stream; keep its error quiet
+            producer.add_done_callback(lambda future: future.cancelled() or future.exception())
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Pool-wide concurrency and per-endpoint counters and latencies"""
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'running': self.running,
+                'queued': self.pending - self.running,
+                'peak_pending': self.peak_pending,
+                'endpoints': {name: stats.snapshot() for name, stats in sorted(self.stats.items())}
+            }
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def blocking(name: str, timeout: Optional[float] = 30):
+    """
+    Run a synchronous endpoint on the blocking executor
+    
+    Apply below the router decorator; the signature FastAPI reads is kept,
+    except for a db parameter, which is filled with the call's own session
+    and must not be declared with Depends(get_db). timeout is in seconds,
+    None waits as long as it takes.
+    """
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+        wants_db = 'db' in signature.parameters
+        
+        def call(*args, **kwargs):
+            if not wants_db:
+                return func(*args, **kwargs)
+            db = SessionLocal()
+            try:
+                return func(*args, db=db, **kwargs)
+            finally:
+                db.close()
+        
+        @functools.wraps(func)
+        async def endpoint(*args, **kwargs):
+            return await executor.run(name, call, *args, timeout=timeout, **kwargs)
+        
+        if wants_db:
+            endpoint.__signature__ = signature.replace(
+                parameters=[parameter for parameter in signature.parameters.values() if parameter.name != 'db']
+            )
+        return endpoint
+    return decorator
+
+
+# Shared by all endpoints of this API process
+executor = BlockingExecutor()
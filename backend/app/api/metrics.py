@@ -0,0 +1,12 @@
+"""API metrics endpoints"""
+from fastapi import APIRouter
+
+from app.api.blocking import executor
+
+router = APIRouter()
+
+
+@router.get("/blocking")
+async def get_blocking_metrics():
+    """Concurrency and latency of the blocking calls of this API process"""
+    return executor.metrics()
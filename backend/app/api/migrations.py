@@ -1,15 +1,16 @@
 """Migration API endpoints"""
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, HTTPException, status
 from sqlalchemy.orm import Session
 from typing import List
 from datetime import datetime
 
-from app.database import get_db
-from app.models.migration_job import MigrationJob, JobStatus
+from app.api.blocking import blocking
+from app.models.migration_job import MigrationJob, JobStatus, ValidationResult
 from app.schemas.migration import (
     MigrationJobCreate,
     MigrationJobResponse,
-    MigrationJobUpdate
+    MigrationJobUpdate,
+    ValidationResultResponse
 )
 from app.tasks.migration_tasks import run_migration_job
 
@@ -17,9 +18,10 @@ router = APIRouter()
 
 
 @router.post("/", response_model=MigrationJobResponse, status_code=status.HTTP_201_CREATED)
-async def create_migration_job(
+@blocking("migrations.create", timeout=10)
+def create_migration_job(
     job_data: MigrationJobCreate,
-    db: Session = Depends(get_db)
+    db: Session = None
 ):
     """Create a new migration job"""
     
@@ -35,8 +37,12 @@ async def create_migration_job(
         target_host=job_data.target_host,
         target_user=job_data.target_user,
         target_password=job_data.target_password,
+        target_token_name=job_data.target_token_name,
+        target_token_value=job_data.target_token_value,
         target_node=job_data.target_node,
         target_storage=job_data.target_storage,
+        vmid_range_start=job_data.vmid_range_start,
+        vmid_range_end=job_data.vmid_range_end,
         vm_configs=job_data.vm_configs.dict() if job_data.vm_configs else None,
         schedule_type=job_data.schedule_type,
         scheduled_time=job_data.scheduled_time,
@@ -45,6 +51,8 @@ async def create_migration_job(
         validate_transfer=job_data.validate_transfer,
         send_notification=job_data.send_notification,
         notification_email=job_data.notification_email,
+        bandwidth_limit_mbps=job_data.bandwidth_limit_mbps,
+        group_cutover=job_data.group_cutover,
         total_vms=len(job_data.source_vms),
         completed_vms=0,
         failed_vms=0,
@@ -69,11 +77,12 @@ async def create_migration_job(
 
 
 @router.get("/", response_model=List[MigrationJobResponse])
-async def list_migration_jobs(
+@blocking("migrations.list", timeout=10)
+def list_migration_jobs(
     skip: int = 0,
     limit: int = 100,
     status_filter: JobStatus = None,
-    db: Session = Depends(get_db)
+    db: Session = None
 ):
     """List all migration jobs"""
     query = db.query(MigrationJob)
@@ -86,9 +95,10 @@ async def list_migration_jobs(
 
 
 @router.get("/{job_id}", response_model=MigrationJobResponse)
-async def get_migration_job(
+@blocking("migrations.get", timeout=10)
+def get_migration_job(
     job_id: int,
-    db: Session = Depends(get_db)
+    db: Session = None
 ):
     """Get a specific migration job"""
     job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
@@ -102,11 +112,30 @@ async def get_migration_job(
     return job
 
 
+@router.get("/{job_id}/validation", response_model=List[ValidationResultResponse])
+@blocking("migrations.validation", timeout=10)
+def get_migration_validation(
+    job_id: int,
+    db: Session = None
+):
+    """Get the validation results of a migration job's VMs"""
+    job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
+    
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    
+    return db.query(ValidationResult).filter(ValidationResult.job_id == job_id).all()
+
+
 @router.patch("/{job_id}", response_model=MigrationJobResponse)
-async def update_migration_job(
+@blocking("migrations.update", timeout=10)
+def update_migration_job(
     job_id: int,
     job_update: MigrationJobUpdate,
-    db: Session = Depends(get_db)
+    db: Session = None
 ):
     """Update a migration job"""
     job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
@@ -129,9 +158,10 @@ async def update_migration_job(
 
 
 @router.delete("/{job_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_migration_job(
+@blocking("migrations.delete", timeout=10)
+def delete_migration_job(
     job_id: int,
-    db: Session = Depends(get_db)
+    db: Session = None
 ):
     """Delete a migration job"""
     job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
@@ -156,9 +186,10 @@ async def delete_migration_job(
 
 
 @router.post("/{job_id}/cancel")
-async def cancel_migration_job(
+@blocking("migrations.cancel", timeout=10)
+def cancel_migration_job(
     job_id: int,
-    db: Session = Depends(get_db)
+    db: Session = None
 ):
     """Cancel a running migration job"""
     job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
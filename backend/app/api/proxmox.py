@@ -2,14 +2,17 @@
 from fastapi import APIRouter, HTTPException, status
 from typing import List, Dict, Any
 
+from app.api.blocking import blocking
 from app.connectors.proxmox_connector import ProxmoxConnector
+from app.connectors.proxmox_pool import pool
 from app.schemas.migration import ProxmoxConnectionTest
 
 router = APIRouter()
 
 
 @router.post("/test-connection")
-async def test_proxmox_connection(connection: ProxmoxConnectionTest):
+@blocking("proxmox.test_connection")
+def test_proxmox_connection(connection: ProxmoxConnectionTest):
     """Test Proxmox connection"""
     try:
         with ProxmoxConnector(
@@ -17,8 +20,12 @@ async def test_proxmox_connection(connection: ProxmoxConnectionTest):
             user=connection.user,
             password=connection.password,
             port=connection.port,
-            verify_ssl=connection.verify_ssl
+            verify_ssl=connection.verify_ssl,
+            token_name=connection.token_name,
+            token_value=connection.token_value
         ) as connector:
+            # An API token is only checked by a request
+            connector.get_version()
             return {
                 "success": True,
                 "message": f"Successfully connected to {connection.host}"
@@ -31,7 +38,8 @@ async def test_proxmox_connection(connection: ProxmoxConnectionTest):
 
 
 @router.post("/list-nodes", response_model=List[str])
-async def list_proxmox_nodes(connection: ProxmoxConnectionTest):
+@blocking("proxmox.list_nodes")
+def list_proxmox_nodes(connection: ProxmoxConnectionTest):
     """List all Proxmox nodes"""
     try:
         with ProxmoxConnector(
@@ -39,7 +47,9 @@ async def list_proxmox_nodes(connection: ProxmoxConnectionTest):
             user=connection.user,
             password=connection.password,
             port=connection.port,
-            verify_ssl=connection.verify_ssl
+            verify_ssl=connection.verify_ssl,
+            token_name=connection.token_name,
+            token_value=connection.token_value
         ) as connector:
             nodes = connector.list_nodes()
             return nodes
@@ -51,7 +61,8 @@ async def list_proxmox_nodes(connection: ProxmoxConnectionTest):
 
 
 @router.post("/list-storage")
-async def list_proxmox_storage(
+@blocking("proxmox.list_storage")
+def list_proxmox_storage(
     connection: ProxmoxConnectionTest,
     node: str
 ) -> List[Dict[str, Any]]:
@@ -62,7 +73,9 @@ async def list_proxmox_storage(
             user=connection.user,
             password=connection.password,
             port=connection.port,
-            verify_ssl=connection.verify_ssl
+            verify_ssl=connection.verify_ssl,
+            token_name=connection.token_name,
+            token_value=connection.token_value
         ) as connector:
             storage = connector.list_storage(node)
             return storage
@@ -71,3 +84,9 @@ async def list_proxmox_storage(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to list storage: {str(e)}"
         )
+
+
+@router.get("/pool-metrics")
+async def get_proxmox_pool_metrics():
+    """Session pool counters and per-session state of this API process"""
+    return pool.metrics()
@@ -1,15 +1,21 @@
 """VMware API endpoints"""
-from fastapi import APIRouter, HTTPException, status
-from typing import List
+from fastapi import APIRouter, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+import json
 
+from app.api.blocking import blocking, executor
 from app.connectors.vmware_connector import VMwareConnector
+from app.connectors.vmware_pool import pool
 from app.schemas.migration import VMwareConnectionTest, VMInfo
+from app.services.vmware_inventory import inventory, filter_vms, paginate, decode_cursor, sort_key
 
 router = APIRouter()
 
 
 @router.post("/test-connection")
-async def test_vmware_connection(connection: VMwareConnectionTest):
+@blocking("vmware.test_connection")
+def test_vmware_connection(connection: VMwareConnectionTest):
     """Test VMware connection"""
     try:
         with VMwareConnector(
@@ -31,20 +37,105 @@ async def test_vmware_connection(connection: VMwareConnectionTest):
 
 
 @router.post("/list-vms", response_model=List[VMInfo])
-async def list_vmware_vms(connection: VMwareConnectionTest):
-    """List all VMs on VMware"""
+@blocking("vmware.list_vms", timeout=120)
+def list_vmware_vms(
+    connection: VMwareConnectionTest,
+    refresh: bool = False,
+    name: Optional[str] = None,
+    power_state: Optional[str] = None,
+    folder: Optional[str] = None,
+    cluster: Optional[str] = None,
+    min_disk_gb: Optional[float] = Query(None, ge=0),
+    max_disk_gb: Optional[float] = Query(None, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    """
+    List all VMs on VMware
+    
+    Served from the shared inventory cache; X-Inventory-Age-Seconds tells
+    how old the data is. refresh=true waits for a refresh from vCenter.
+    
+    name (a shell pattern, or a substring), power_state, folder, cluster and
+    the total disk size bounds filter on the server. With limit, VMs come in
+    pages ordered by name; X-Next-Cursor is passed as cursor for the next
+    page and is absent on the last. format=ndjson streams one VM per line;
+    without paging it starts while vCenter is still being crawled if the
+    cache has to be filled first.
+    """
+    if cursor is not None:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    filters = dict(
+        name=name,
+        power_state=power_state,
+        folder=folder,
+        cluster=cluster,
+        min_disk_gb=min_disk_gb,
+        max_disk_gb=max_disk_gb
+    )
+    paged = limit is not None or cursor is not None
+    stream_live = format == "ndjson" and not paged
+    
+    connector = VMwareConnector(
+        host=connection.host,
+        user=connection.user,
+        password=connection.password,
+        port=connection.port,
+        verify_ssl=connection.verify_ssl
+    )
     try:
-        with VMwareConnector(
-            host=connection.host,
-            user=connection.user,
-            password=connection.password,
-            port=connection.port,
-            verify_ssl=connection.verify_ssl
-        ) as connector:
-            vms = connector.list_vms()
-            return vms
+        connector.connect()
+        vms, age_seconds = inventory.list_vms(connector, force_refresh=refresh, wait=not stream_live)
+        headers = {}
+        if age_seconds is not None:
+            headers["X-Inventory-Age-Seconds"] = str(int(age_seconds))
+        
+        if stream_live:
+            # The connector stays leased until a live crawl is through
+            def lines():
+                try:
+                    for vm in filter_vms(vms, **filters):
+                        yield json.dumps(vm) + "\n"
+                finally:
+                    connector.disconnect()
+            
+            # The crawl blocks on vCenter, so it runs on the blocking executor too
+            return StreamingResponse(
+                executor.stream("vmware.list_vms.stream", lines()),
+                media_type="application/x-ndjson",
+                headers=headers
+            )
+        
+        matching = sorted(filter_vms(vms, **filters), key=sort_key)
+        connector.disconnect()
     except Exception as e:
+        connector.disconnect()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to list VMs: {str(e)}"
         )
+    
+    page, next_cursor = paginate(matching, limit=limit, cursor=cursor)
+    headers["X-Total-Count"] = str(len(matching))
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    
+    if format == "ndjson":
+        return StreamingResponse(
+            (json.dumps(vm) + "\n" for vm in page),
+            media_type="application/x-ndjson",
+            headers=headers
+        )
+    # Serialized as they are; the cache only holds connector output, so per-object validation buys nothing
+    return Response(content=json.dumps(page), media_type="application/json", headers=headers)
+
+
+@router.get("/pool-metrics")
+async def get_vmware_pool_metrics():
+    """Session pool counters and per-session state of this API process"""
+    return pool.metrics()
@@ -1,5 +1,6 @@
 """Celery application"""
 from celery import Celery
+from celery.signals import worker_process_shutdown
 from app.config import settings
 
 celery_app = Celery(
@@ -16,6 +17,21 @@ celery_app.conf.update(
     timezone='UTC',
     enable_utc=True,
     task_track_started=True,
-    task_time_limit=3600 * 12,  # 12 hours max
+    task_time_limit=settings.MIGRATION_TIME_LIMIT_SECONDS,
+    task_soft_time_limit=settings.MIGRATION_TIME_LIMIT_SECONDS - 600,  # Leave time to checkpoint and retry
+    task_acks_late=True,  # Redeliver jobs of workers that die mid-migration
+    task_reject_on_worker_lost=True,
+    # Redis redelivers unacked tasks after this; a running job must never look lost
+    broker_transport_options={'visibility_timeout': settings.MIGRATION_TIME_LIMIT_SECONDS + 3600},
     worker_max_tasks_per_child=10,
 )
+
+
+@worker_process_shutdown.connect
+def close_pooled_sessions(**kwargs):
+    """Log pooled sessions out instead of leaving them to time out"""
+    from app.connectors.proxmox_pool import pool as proxmox_pool
+    from app.connectors.vmware_pool import pool as vsphere_pool
+
+    vsphere_pool.close_all()
+    proxmox_pool.close_all()
@@ -1,6 +1,6 @@
 """Application configuration"""
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Any, Dict, Optional
 
 
 class Settings(BaseSettings):
@@ -30,12 +30,26 @@ class Settings(BaseSettings):
     # CORS
     CORS_ORIGINS: list = ["http://localhost:3000", "http://localhost:8000"]
     
+    # Blocking work of API requests (connectors, database)
+    API_BLOCKING_WORKERS: int = 32  # Threads per API process
+    API_BLOCKING_MAX_PENDING: int = 256  # Calls in flight before new ones are turned away with 503
+    API_ENDPOINT_TIMEOUTS_SECONDS: Dict[str, float] = {}  # Overrides, e.g. {"vmware.list_vms": 300}
+    
     # VMware (optional defaults, can be configured via UI)
     VMWARE_HOST: Optional[str] = None
     VMWARE_USER: Optional[str] = None
     VMWARE_PASSWORD: Optional[str] = None
     VMWARE_PORT: int = 443
     VMWARE_VERIFY_SSL: bool = False
+    VMWARE_PROPERTY_PAGE_SIZE: int = 1000  # Objects per PropertyCollector page
+    VMWARE_INDEX_SYNC_SECONDS: int = 10  # Max age of the name/UUID index before a delta sync
+    VMWARE_TASK_TIMEOUT_SECONDS: int = 3600  # Longest wait for a vSphere task
+    VMWARE_TASK_POLL_SECONDS: int = 30  # Server-side long-poll of the task waiter
+    VMWARE_SESSION_CHECK_SECONDS: int = 60  # Re-check a pooled session on lease after this long
+    VMWARE_SESSION_KEEPALIVE_SECONDS: int = 300  # Ping pooled sessions this often
+    VMWARE_SESSION_IDLE_SECONDS: int = 1800  # Log out sessions nobody leased for this long
+    VMWARE_BULK_MAX_CONCURRENT_TASKS: int = 8  # Snapshot/power-off tasks in flight per bulk call
+    VMWARE_INVENTORY_MAX_AGE_SECONDS: int = 30  # Serve the cached inventory, refreshing it after this long
     
     # Proxmox (optional defaults, can be configured via UI)
     PROXMOX_HOST: Optional[str] = None
@@ -43,12 +57,64 @@ class Settings(BaseSettings):
     PROXMOX_PASSWORD: Optional[str] = None
     PROXMOX_PORT: int = 8006
     PROXMOX_VERIFY_SSL: bool = False
+    PROXMOX_API_TIMEOUT_SECONDS: int = 30  # Per API request
+    PROXMOX_HTTP_POOL_SIZE: int = 20  # Keep-alive connections per pooled session
+    PROXMOX_TICKET_RENEW_SECONDS: int = 3600  # Renew tickets this old; Proxmox expires them after 2 hours
+    PROXMOX_SESSION_KEEPALIVE_SECONDS: int = 300  # Check pooled sessions' tickets this often
+    PROXMOX_SESSION_IDLE_SECONDS: int = 1800  # Drop sessions nobody leased for this long
+    PROXMOX_TASK_TIMEOUT_SECONDS: int = 600  # Longest wait for a Proxmox task
+    PROXMOX_TASK_POLL_MIN_SECONDS: float = 0.5  # First poll of the task waiter; backs off from here
+    PROXMOX_TASK_POLL_MAX_SECONDS: float = 5.0  # Slowest poll while tasks keep running
+    PROXMOX_VMID_MIN: int = 100  # VMIDs for migrated VMs, unless the job has its own range
+    PROXMOX_VMID_MAX: int = 999999999
+    PROXMOX_VMID_LEASE_SECONDS: int = 86400  # A reserved VMID is free again after this, if not released
     
     # Migration Settings
     MAX_CONCURRENT_MIGRATIONS: int = 2
     CHUNK_SIZE_MB: int = 100
+    MAX_PARALLEL_DISKS_PER_VM: int = 4
     VALIDATION_ENABLED: bool = True
     
+    # Disk transfer
+    TRANSFER_READER: str = "ssh"  # ssh, nbd or local
+    TRANSFER_WRITER: str = "ssh"  # ssh or local
+    TRANSFER_QUEUE_DEPTH: int = 2  # Chunks buffered between reader and writer
+    SPARSE_BLOCK_SIZE_KB: int = 64  # Granularity of zero-block detection
+    CHECKPOINT_INTERVAL_MB: int = 1024  # Data flushed between resume checkpoints
+    TRANSFER_STALL_TIMEOUT_SECONDS: int = 900  # Fail a disk whose transfer moves no bytes for this long
+    DISK_LAYOUT_OVERRIDES: Dict[str, Dict[str, Any]] = {}  # Per storage type, e.g. {"nfs": {"queue_depth": 8}}
+    MIGRATION_MAX_RETRIES: int = 3
+    MIGRATION_RETRY_DELAY_SECONDS: int = 60
+    MIGRATION_TIME_LIMIT_SECONDS: int = 3600 * 12  # Longest run of a job task before it is retried
+    SOURCE_SSH_USER: str = "root"
+    SOURCE_SSH_PASSWORD: Optional[str] = None
+    SOURCE_SSH_KEY_FILE: Optional[str] = None
+    TARGET_SSH_USER: str = "root"
+    TARGET_SSH_PASSWORD: Optional[str] = None
+    TARGET_SSH_KEY_FILE: Optional[str] = None
+    TRANSFER_COMPRESSION: str = "off"  # off, auto, zstd, lz4 or zlib (SSH writer only)
+    COMPRESSION_MIN_RATIO: float = 0.9  # Frames compressing worse than this go out raw
+    COMPRESSION_MIN_CPU_HEADROOM: float = 0.15  # Lower the level below this idle CPU share
+    VDDK_LIBDIR: Optional[str] = None  # VMware VDDK install, used by warm migrations
+    
+    # Bandwidth limits in Mbit/s of source data read; 0 means unlimited
+    BANDWIDTH_LIMIT_MBPS: int = 0  # All streams of a worker, or of all workers with Redis
+    BANDWIDTH_HOST_DEFAULT_MBPS: int = 0  # Each ESXi host without its own limit
+    BANDWIDTH_HOST_LIMITS_MBPS: Dict[str, int] = {}  # Per ESXi host, e.g. {"esx01": 2000}
+    BANDWIDTH_BURST_SECONDS: float = 1.0  # Unused bandwidth a stream may catch up on
+    BANDWIDTH_REDIS_ENABLED: bool = False  # Share the buckets across workers via REDIS_URL
+    
+    # Placement of "auto" targets
+    PLACEMENT_CACHE_SECONDS: int = 30  # Reuse a cluster's resource usage for this long
+    PLACEMENT_DISK_HEADROOM: float = 0.1  # Free space a storage keeps beyond the disks placed on it
+    
+    # Progress reporting
+    PROGRESS_UPDATE_INTERVAL_SECONDS: int = 5  # Job row updates; running jobs also pick up limit changes
+    
+    # Warm migration
+    WARM_MAX_PASSES: int = 5  # Incremental passes before the forced cutover
+    WARM_CUTOVER_THRESHOLD_MB: int = 1024  # Delta small enough to cut over after
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
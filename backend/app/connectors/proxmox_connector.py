@@ -1,40 +1,85 @@
 """Proxmox VE connector"""
-from proxmoxer import ProxmoxAPI
 from typing import List, Dict, Any, Optional
+import re
 import logging
 
+from app.connectors.proxmox_pool import pool
+from app.connectors.proxmox_tasks import ProxmoxTask, ProxmoxTaskWaiter
+
 logger = logging.getLogger(__name__)
 
 
+# Storage types keeping volumes as image files, named with their format's extension
+FILE_STORAGE_TYPES = ('dir', 'nfs', 'cifs', 'cephfs', 'btrfs', 'glusterfs')
+
+
 class ProxmoxConnector:
-    """Proxmox VE API connector"""
+    """
+    Proxmox VE API connector
+    
+    Sessions come from the process-wide pool: connect() leases one and
+    disconnect() returns it, still authenticated, for the next connector.
+    With token_name and token_value the API token is used instead of the
+    password, and no login is needed at all.
+    """
     
-    def __init__(self, host: str, user: str, password: str, port: int = 8006, verify_ssl: bool = False):
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: Optional[str] = None,
+        port: int = 8006,
+        verify_ssl: bool = False,
+        token_name: Optional[str] = None,
+        token_value: Optional[str] = None
+    ):
         self.host = host
         self.user = user
         self.password = password
         self.port = port
         self.verify_ssl = verify_ssl
-        self.proxmox = None
+        self.token_name = token_name
+        self.token_value = token_value
+        self._session = None
+    
+    @property
+    def proxmox(self):
+        """ProxmoxAPI of the leased session"""
+        return self._session.api if self._session else None
     
     def connect(self) -> bool:
         """Connect to Proxmox"""
+        if self._session is not None:
+            return True
         try:
-            self.proxmox = ProxmoxAPI(
+            self._session = pool.acquire(
                 self.host,
-                user=self.user,
+                self.user,
                 password=self.password,
                 port=self.port,
-                verify_ssl=self.verify_ssl
+                verify_ssl=self.verify_ssl,
+                token_name=self.token_name,
+                token_value=self.token_value
             )
-            # Test connection
-            self.proxmox.version.get()
             logger.info(f"Connected to Proxmox: {self.host}")
             return True
         except Exception as e:
             logger.error(f"Failed to connect to Proxmox: {str(e)}")
             raise ConnectionError(f"Proxmox connection failed: {str(e)}")
     
+    def disconnect(self):
+        """Return the session to the pool"""
+        if self._session is not None:
+            pool.release(self._session)
+            self._session = None
+    
+    def get_version(self) -> Dict[str, Any]:
+        """Get the Proxmox VE version; a round trip that proves the credentials"""
+        if not self.proxmox:
+            self.connect()
+        
+        return self.proxmox.version.get()
+    
     def list_nodes(self) -> List[str]:
         """List all Proxmox nodes"""
         if not self.proxmox:
@@ -51,6 +96,20 @@ class ProxmoxConnector:
         storage_list = self.proxmox.nodes(node).storage.get()
         return storage_list
     
+    def get_storage_config(self, storage: str) -> Dict[str, Any]:
+        """Get the cluster-wide configuration of a storage (pool, vgname, monhost, ...)"""
+        if not self.proxmox:
+            self.connect()
+        
+        return self.proxmox.storage(storage).get()
+    
+    def get_cluster_resources(self) -> List[Dict[str, Any]]:
+        """Get every node, storage and guest of the cluster with its usage, in one call"""
+        if not self.proxmox:
+            self.connect()
+        
+        return self.proxmox.cluster.resources.get()
+    
     def get_next_vmid(self) -> int:
         """Get next available VM ID"""
         if not self.proxmox:
@@ -58,8 +117,14 @@ class ProxmoxConnector:
         
         return self.proxmox.cluster.nextid.get()
     
-    def create_vm(self, node: str, vmid: int, name: str, **kwargs) -> int:
-        """Create a new VM"""
+    def create_vm(self, node: str, vmid: int, name: str, **kwargs) -> ProxmoxTask:
+        """
+        Create a new VM; the VM exists once the returned task finished
+        
+        Any further qemu.create option, e.g. net1 or scsihw, is passed on,
+        so a whole VM spec goes in one call. Without a netN, net0 is a
+        virtio NIC on bridge.
+        """
         if not self.proxmox:
             self.connect()
         
@@ -74,58 +139,65 @@ class ProxmoxConnector:
             'bios': kwargs.get('bios', 'seabios')
         }
         
+        config.update({key: value for key, value in kwargs.items() if key not in config and key != 'bridge'})
+        
         # Network config
-        if 'net0' in kwargs:
-            config['net0'] = kwargs['net0']
-        else:
+        if not any(re.fullmatch(r'net\d+', key) for key in config):
             bridge = kwargs.get('bridge', 'vmbr0')
             config['net0'] = f'virtio,bridge={bridge},firewall=1'
         
         try:
-            self.proxmox.nodes(node).qemu.create(**config)
-            logger.info(f"VM {vmid} created on node {node}")
-            return vmid
+            task = ProxmoxTask(self.proxmox.nodes(node).qemu.create(**config))
+            logger.info(f"Creating VM {vmid} on node {node}")
+            return task
         except Exception as e:
             logger.error(f"Failed to create VM: {str(e)}")
             raise
     
     def attach_disk(self, node: str, vmid: int, disk_path: str, interface: str = 'scsi0') -> bool:
         """Attach disk to VM"""
+        return self.update_vm_config(node, vmid, **{interface: disk_path})
+    
+    def update_vm_config(self, node: str, vmid: int, **options) -> bool:
+        """
+        Set VM config options in one call
+        
+        PUT on the config applies them before returning, so there is no task,
+        and takes the VM's config lock once for all of them.
+        """
         if not self.proxmox:
             self.connect()
         
         try:
-            self.proxmox.nodes(node).qemu(vmid).config.put(**{
-                interface: disk_path
-            })
-            logger.info(f"Disk attached to VM {vmid}: {interface} -> {disk_path}")
+            self.proxmox.nodes(node).qemu(vmid).config.put(**options)
+            logger.info(f"VM {vmid} config updated: {', '.join(f'{key}={value}' for key, value in options.items())}")
             return True
         except Exception as e:
-            logger.error(f"Failed to attach disk: {str(e)}")
+            logger.error(f"Failed to update VM config: {str(e)}")
             raise
     
-    def start_vm(self, node: str, vmid: int) -> bool:
-        """Start VM"""
+    def start_vm(self, node: str, vmid: int) -> ProxmoxTask:
+        """Start VM; returns the start task"""
         if not self.proxmox:
             self.connect()
         
         try:
-            self.proxmox.nodes(node).qemu(vmid).status.start.post()
-            logger.info(f"VM {vmid} started")
-            return True
+            task = ProxmoxTask(self.proxmox.nodes(node).qemu(vmid).status.start.post())
+            logger.info(f"Starting VM {vmid}")
+            return task
         except Exception as e:
             logger.error(f"Failed to start VM: {str(e)}")
             raise
     
-    def stop_vm(self, node: str, vmid: int) -> bool:
-        """Stop VM"""
+    def stop_vm(self, node: str, vmid: int) -> ProxmoxTask:
+        """Stop VM; returns the stop task"""
         if not self.proxmox:
             self.connect()
         
         try:
-            self.proxmox.nodes(node).qemu(vmid).status.stop.post()
-            logger.info(f"VM {vmid} stopped")
-            return True
+            task = ProxmoxTask(self.proxmox.nodes(node).qemu(vmid).status.stop.post())
+            logger.info(f"Stopping VM {vmid}")
+            return task
         except Exception as e:
             logger.error(f"Failed to stop VM: {str(e)}")
             raise
@@ -137,15 +209,22 @@ class ProxmoxConnector:
         
         return self.proxmox.nodes(node).qemu(vmid).status.current.get()
     
-    def delete_vm(self, node: str, vmid: int) -> bool:
-        """Delete VM"""
+    def vm_exists(self, node: str, vmid: int) -> bool:
+        """Check whether a VM exists on a node"""
+        if not self.proxmox:
+            self.connect()
+        
+        return any(int(vm['vmid']) == int(vmid) for vm in self.proxmox.nodes(node).qemu.get())
+    
+    def delete_vm(self, node: str, vmid: int) -> ProxmoxTask:
+        """Delete VM; returns the destroy task"""
         if not self.proxmox:
             self.connect()
         
         try:
-            self.proxmox.nodes(node).qemu(vmid).delete()
-            logger.info(f"VM {vmid} deleted")
-            return True
+            task = ProxmoxTask(self.proxmox.nodes(node).qemu(vmid).delete())
+            logger.info(f"Deleting VM {vmid}")
+            return task
         except Exception as e:
             logger.error(f"Failed to delete VM: {str(e)}")
             raise
@@ -154,9 +233,94 @@ class ProxmoxConnector:
         """Get full disk path"""
         return f"{storage}:vm-{vmid}-{disk_name}"
     
+    def allocate_disk(
+        self,
+        node: str,
+        storage: str,
+        vmid: int,
+        disk_name: str,
+        size_bytes: int,
+        fmt: str = 'raw',
+        storage_type: Optional[str] = None
+    ) -> str:
+        """
+        Allocate a disk volume on storage, returns the volume ID
+        
+        Image files on file storages are named with the format's extension,
+        which Proxmox requires there; storage_type saves looking it up.
+        """
+        if not self.proxmox:
+            self.connect()
+        
+        if storage_type is None:
+            storage_type = self.get_storage_config(storage).get('type')
+        filename = f"vm-{vmid}-{disk_name}"
+        if storage_type in FILE_STORAGE_TYPES:
+            filename += f".{fmt}"
+        
+        # A size without unit is in KiB; round up so the whole source fits
+        size_kb = (size_bytes + 1023) // 1024
+        
+        try:
+            volid = self.proxmox.nodes(node).storage(storage).content.post(
+                vmid=vmid,
+                filename=filename,
+                size=str(size_kb),
+                format=fmt
+            )
+            logger.info(f"Allocated {volid} ({size_kb} KiB) for VM {vmid}")
+            return volid
+        except Exception as e:
+            logger.error(f"Failed to allocate disk: {str(e)}")
+            raise
+    
+    def get_volume_path(self, node: str, storage: str, volid: str) -> str:
+        """Get the filesystem or block device path of a volume on its node"""
+        if not self.proxmox:
+            self.connect()
+        
+        info = self.proxmox.nodes(node).storage(storage).content(volid).get()
+        return info['path']
+    
+    def get_node_address(self, node: str) -> str:
+        """Get the cluster IP address of a node, falling back to the API host"""
+        if not self.proxmox:
+            self.connect()
+        
+        for entry in self.proxmox.cluster.status.get():
+            if entry.get('type') == 'node' and entry.get('name') == node and entry.get('ip'):
+                return entry['ip']
+        
+        return self.host
+    
+    def wait_for_task(self, task: ProxmoxTask, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Wait for a task to finish, raises if it failed or timed out
+        
+        Returns the outcome, with the task's 'duration_seconds'; see
+        ProxmoxTaskWaiter.wait_many.
+        """
+        outcome = self._get_task_waiter().wait(task, timeout=timeout)
+        logger.debug(f"Task {task.type} {task.id} on {task.node} took {outcome['duration_seconds']}s")
+        return outcome
+    
+    def wait_for_tasks(self, tasks: List[ProxmoxTask], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Wait for several tasks together
+        
+        Returns a dict per task with 'upid', 'status', 'duration_seconds'
+        and 'error'; see ProxmoxTaskWaiter.wait_many.
+        """
+        return self._get_task_waiter().wait_many(tasks, timeout=timeout)
+    
+    def _get_task_waiter(self) -> ProxmoxTaskWaiter:
+        if not self.proxmox:
+            self.connect()
+        return self._session.task_waiter()
+    
     def __enter__(self):
         self.connect()
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.disconnect()
@@ -0,0 +1,325 @@
+"""Process-wide pool of authenticated Proxmox API sessions"""
+# Sessions are kept alive through proxmoxer internals: ProxmoxAPI._backend and
+# _store['session'], and ProxmoxHTTPAuth.renew_age, birth_time and
+# _get_new_tokens. They are checked by tests/test_proxmox_pool.py on proxmoxer
+# 2.0.1 to 2.3.0, the range requirements.txt allows.
+from proxmoxer import ProxmoxAPI
+from proxmoxer.backends.https import ProxmoxHTTPAuth
+from requests.adapters import HTTPAdapter
+import copy
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple
+import logging
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Proxmox rejects tickets older than this
+TICKET_LIFETIME_SECONDS = 7200
+
+# proxmoxer renews a ticket in place once a request finds it this old, racing
+# other threads' requests; put off until just before expiry so the pool renews first
+AUTH_RENEW_AGE_SECONDS = TICKET_LIFETIME_SECONDS - 300
+
+
+class PooledProxmoxSession:
+    """
+    One authenticated ProxmoxAPI, shared by every connector using it
+    
+    The API object keeps a requests session, so connections are reused
+    between calls. With an API token every request carries the token and
+    there is no ticket; with a password the session holds a ticket that is
+    renewed with itself before it expires. The session also owns the task
+    waiter, so tasks of all its connectors are polled together.
+    
+    Renewals and logins after the first one run under lock and never touch
+    the requests session, which other leases keep using meanwhile. They
+    build a new auth object and swap it in with one assignment, so every
+    request sends a matching ticket and CSRF token, old or new.
+    """
+    
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        port: int,
+        verify_ssl: bool,
+        password: Optional[str] = None,
+        token_name: Optional[str] = None,
+        token_value: Optional[str] = None
+    ):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.verify_ssl = verify_ssl
+        self.password = password
+        self.token_name = token_name
+        self.token_value = token_value
+        self.api = None
+        self.leases = 0
+        self.logins = 0
+        self.renewals = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.RLock()
+        self._task_waiter = None
+    
+    @property
+    def uses_token(self) -> bool:
+        return self.token_name is not None
+    
+    def login(self):
+        """Build the API object, or log in again with the password; call with lock held"""
+        if self.api is not None and not self.uses_token:
+            backend = self.api._backend
+            auth = ProxmoxHTTPAuth(
+                self.user,
+                self.password,
+                base_url=backend.base_url,
+                verify_ssl=self.verify_ssl,
+                timeout=settings.PROXMOX_API_TIMEOUT_SECONDS
+            )
+            self._swap_auth(auth)
+            self.logins += 1
+            logger.info(f"Logged in to Proxmox again: {self.host} as {self.user}")
+            return
+        
+        self._close_api()
+        credentials = (
+            {'token_name': self.token_name, 'token_value': self.token_value}
+            if self.uses_token else {'password': self.password}
+        )
+        api = ProxmoxAPI(
+            self.host,
+            user=self.user,
+            port=self.port,
+            verify_ssl=self.verify_ssl,
+            timeout=settings.PROXMOX_API_TIMEOUT_SECONDS,
+            **credentials
+        )
+        # The default adapter keeps 10 connections; concurrent VMs need more
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PROXMOX_HTTP_POOL_SIZE)
+        api._store['session'].mount('https://', adapter)
+        if not self.uses_token:
+            api._backend.auth.renew_age = AUTH_RENEW_AGE_SECONDS
+        self.api = api
+        self.logins += 1
+        logger.info(f"Logged in to Proxmox: {self.host} as {self.user}{' with API token' if self.uses_token else ''}")
+    
+    def ticket_age(self) -> Optional[float]:
+        """Seconds since the ticket was issued; None with an API token"""
+        if self.api is None or self.uses_token:
+            return None
+        return time.monotonic() - self._auth().birth_time
+    
+    def renew(self):
+        """Exchange the ticket for a new one, no password is sent; call with lock held"""
+        auth = copy.copy(self._auth())
+        auth._get_new_tokens()
+        self._swap_auth(auth)
+        self.renewals += 1
+        logger.debug(f"Renewed Proxmox ticket for {self.user} on {self.host}")
+    
+    def refresh(self) -> str:
+        """
+        Make sure the ticket is usable for a while, returns what was done
+        
+        A ticket past PROXMOX_TICKET_RENEW_SECONDS is renewed; one that has
+        expired, or cannot be renewed, is replaced by a new login.
+        """
+        age = self.ticket_age()
+        if self.api is None or (age is not None and age >= TICKET_LIFETIME_SECONDS - 60):
+            self.login()
+            return 'login'
+        if age is not None and age >= settings.PROXMOX_TICKET_RENEW_SECONDS:
+            try:
+                self.renew()
+                return 'renewal'
+            except Exception as e:
+                logger.info(f"Renewing Proxmox ticket on {self.host} failed, logging in again: {str(e)}")
+                self.login()
+                return 'login'
+        return 'reuse'
+    
+    def task_waiter(self):
+        """The session's task waiter, shared by all threads using the session"""
+        from app.connectors.proxmox_tasks import ProxmoxTaskWaiter
+        
+        with self.lock:
+            if self._task_waiter is None:
+                self._task_waiter = ProxmoxTaskWaiter(self)
+            return self._task_waiter
+    
+    def close(self):
+        """Stop the task waiter and close the keep-alive connections; tickets simply expire"""
+        if self._task_waiter is not None:
+            self._task_waiter.close()
+            self._task_waiter = None
+        self._close_api()
+    
+    def _close_api(self):
+        if self.api is not None:
+            try:
+                self.api._store['session'].close()
+            except Exception as e:
+                logger.debug(f"Closing Proxmox session to {self.host} failed: {str(e)}")
+            self.api = None
+    
+    def _auth(self):
+        return self.api._backend.auth
+    
+    def _swap_auth(self, auth: ProxmoxHTTPAuth):
+        auth.renew_age = AUTH_RENEW_AGE_SECONDS
+        self.api._backend.auth = auth
+        self.api._store['session'].auth = auth
+
+
+class ProxmoxPool:
+    """
+    Authenticated Proxmox sessions keyed by (host, port, user, credentials)
+    
+    Connectors lease a session instead of logging in on every use. Tickets
+    are renewed when leased past PROXMOX_TICKET_RENEW_SECONDS and by a
+    background thread, so sessions held through long transfers never run
+    into the two-hour expiry. Idle sessions are dropped after
+    PROXMOX_SESSION_IDLE_SECONDS. The secret is part of the key, hashed, so
+    a lease always proves it.
+    """
+    
+    def __init__(self):
+        self.sessions: Dict[Tuple, PooledProxmoxSession] = {}
+        self.lock = threading.Lock()
+        self.counters = {'logins': 0, 'renewals': 0, 'reuses': 0, 'login_failures': 0, 'evictions': 0}
+        self._pid = os.getpid()
+        self._keepalive = None
+    
+    def acquire(
+        self,
+        host: str,
+        user: str,
+        password: Optional[str] = None,
+        port: int = 8006,
+        verify_ssl: bool = False,
+        token_name: Optional[str] = None,
+        token_value: Optional[str] = None
+    ) -> PooledProxmoxSession:
+        """Lease an authenticated session, logging in if there is none"""
+        secret = token_value if token_name is not None else password
+        if secret is None:
+            raise ValueError("Proxmox needs a password or an API token")
+        key = (host, port, user, token_name, hashlib.sha256(secret.encode()).hexdigest())
+        
+        with self.lock:
+            self._check_fork()
+            session = self.sessions.get(key)
+            if session is None:
+                session = PooledProxmoxSession(host, user, port, verify_ssl, password, token_name, token_value)
+                self.sessions[key] = session
+            session.leases += 1
+            self._start_keepalive()
+        
+        try:
+            with session.lock:
+                outcome = session.refresh()
+            self._count({'login': 'logins', 'renewal': 'renewals', 'reuse': 'reuses'}[outcome])
+        except Exception:
+            self._count('login_failures')
+            self.release(session)
+            with self.lock:
+                # Don't keep credentials around that never worked
+                if session.api is None and not session.leases and self.sessions.get(key) is session:
+                    del self.sessions[key]
+            raise
+        
+        return session
+    
+    def release(self, session: PooledProxmoxSession):
+        """Return a leased session; it stays authenticated for the next lease"""
+        with self.lock:
+            session.leases = max(0, session.leases - 1)
+            session.last_used = time.monotonic()
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Counters and per-session state"""
+        now = time.monotonic()
+        with self.lock:
+            sessions = []
+            for session in self.sessions.values():
+                age = session.ticket_age()
+                sessions.append({
+                    'host': session.host,
+                    'user': session.user,
+                    'auth': 'token' if session.uses_token else 'ticket',
+                    'leases': session.leases,
+                    'logins': session.logins,
+                    'renewals': session.renewals,
+                    'ticket_age_seconds': int(age) if age is not None else None,
+                    'idle_seconds': int(now - session.last_used) if not session.leases else 0
+                })
+            return {**self.counters, 'sessions': sessions}
+    
+    def close_all(self):
+        """Drop every session"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+    
+    def _count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+    
+    def _check_fork(self):
+        # Connections inherited from a parent process must not be shared with it
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self.sessions = {}
+            self._keepalive = None
+    
+    def _start_keepalive(self):
+        if self._keepalive is None or not self._keepalive.is_alive():
+            self._keepalive = threading.Thread(target=self._keep_alive, name='proxmox-keepalive', daemon=True)
+            self._keepalive.start()
+    
+    def _keep_alive(self):
+        while True:
+            time.sleep(settings.PROXMOX_SESSION_KEEPALIVE_SECONDS)
+            now = time.monotonic()
+            with self.lock:
+                if os.getpid() != self._pid:
+                    return
+                idle = [
+                    key for key, session in self.sessions.items()
+                    if not session.leases and now - session.last_used >= settings.PROXMOX_SESSION_IDLE_SECONDS
+                ]
+                evicted = [self.sessions.pop(key) for key in idle]
+                self.counters['evictions'] += len(evicted)
+                active = list(self.sessions.values())
+            
+            for session in evicted:
+                with session.lock:
+                    session.close()
+            
+            for session in active:
+                if session.uses_token or not session.lock.acquire(blocking=False):
+                    continue
+                try:
+                    age = session.ticket_age()
+                    if age is not None and age >= settings.PROXMOX_TICKET_RENEW_SECONDS:
+                        outcome = session.refresh()
+                        self._count('logins' if outcome == 'login' else 'renewals')
+                except Exception as e:
+                    # Left to the next lease, which logs in again
+                    logger.warning(f"Renewing Proxmox ticket on {session.host} failed: {str(e)}")
+                finally:
+                    session.lock.release()
+
+
+# Shared by every connector of this process
+pool = ProxmoxPool()
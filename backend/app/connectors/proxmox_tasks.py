@@ -0,0 +1,189 @@
+"""Tracking of Proxmox tasks (UPIDs)"""
+import threading
+import time
+from typing import List, Dict, Any, Optional
+import logging
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProxmoxTask:
+    """
+    Handle of a task a Proxmox API call started
+    
+    A UPID reads UPID:node:pid:pstart:starttime:type:id:user: with the
+    start time in hex seconds since the epoch.
+    """
+    
+    def __init__(self, upid: str):
+        parts = upid.split(':')
+        if len(parts) < 8 or parts[0] != 'UPID':
+            raise ValueError(f"Not a UPID: {upid}")
+        self.upid = upid
+        self.node = parts[1]
+        self.started_at = int(parts[4], 16)
+        self.type = parts[5]
+        self.id = parts[6]
+    
+    def __repr__(self):
+        return f"ProxmoxTask({self.upid})"
+
+
+class _PendingTask:
+    """What the waiter knows about one task"""
+    
+    def __init__(self, task: ProxmoxTask):
+        self.task = task
+        self.status = None
+        self.duration = None
+        self.done = threading.Event()
+    
+    def finish(self, status: str, endtime: Optional[float] = None):
+        self.status = status
+        self.duration = max(0.0, (endtime or time.time()) - self.task.started_at)
+        self.done.set()
+    
+    def failed(self) -> bool:
+        # Tasks that only logged warnings end with "WARNINGS: n"
+        return self.status != 'OK' and not self.status.startswith('WARNINGS')
+
+
+class ProxmoxTaskWaiter:
+    """
+    Waits on any number of Proxmox tasks of one session
+    
+    A single background thread polls for all waiting threads: each round
+    lists the tasks of every node with pending tasks in one /nodes/{node}/tasks
+    query, and only tasks missing from that list are looked up on their
+    own. The poll interval starts at PROXMOX_TASK_POLL_MIN_SECONDS and
+    doubles up to PROXMOX_TASK_POLL_MAX_SECONDS while nothing finishes.
+    """
+    
+    # Tasks listed per node and round; older ones are looked up one by one
+    LIST_LIMIT = 500
+    
+    def __init__(self, session):
+        self.session = session
+        self.pending: Dict[str, _PendingTask] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.closed = False
+    
+    def wait(self, task: ProxmoxTask, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Wait for a task and return its outcome; raises if it failed or timed out"""
+        outcome = self.wait_many([task], timeout=timeout)[0]
+        if outcome['error'] is not None:
+            if isinstance(outcome['error'], TimeoutError):
+                raise outcome['error']
+            raise Exception(f"Task failed: {outcome['error']}")
+        return outcome
+    
+    def wait_many(self, tasks: List[ProxmoxTask], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Wait for several tasks together
+        
+        Returns one dict per task, in order, with 'upid', 'status' (the exit
+        status, None while running), 'duration_seconds' and 'error' (a
+        message, or a TimeoutError for tasks still running at the deadline).
+        """
+        timeout = timeout if timeout is not None else settings.PROXMOX_TASK_TIMEOUT_SECONDS
+        deadline = time.monotonic() + timeout
+        
+        pendings = [self._register(task) for task in tasks]
+        try:
+            for pending in pendings:
+                pending.done.wait(max(0.0, deadline - time.monotonic()))
+        finally:
+            with self.lock:
+                for pending in pendings:
+                    self.pending.pop(pending.task.upid, None)
+        
+        outcomes = []
+        for pending in pendings:
+            if not pending.done.is_set():
+                error = TimeoutError(f"Task {pending.task.upid} still running after {int(timeout)}s")
+            elif pending.failed():
+                error = pending.status
+            else:
+                error = None
+            outcomes.append({
+                'upid': pending.task.upid,
+                'status': pending.status,
+                'duration_seconds': round(pending.duration, 3) if pending.duration is not None else None,
+                'error': error
+            })
+        return outcomes
+    
+    def close(self):
+        """Stop the background thread"""
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+    
+    def _register(self, task: ProxmoxTask) -> _PendingTask:
+        pending = _PendingTask(task)
+        with self.lock:
+            self.pending[task.upid] = pending
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='proxmox-task-waiter', daemon=True)
+                self.thread.start()
+        # A new task deserves a prompt first look
+        self.wakeup.set()
+        return pending
+    
+    def _run(self):
+        interval = settings.PROXMOX_TASK_POLL_MIN_SECONDS
+        while not self.closed:
+            self.wakeup.wait(interval)
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                interval = settings.PROXMOX_TASK_POLL_MIN_SECONDS
+            
+            with self.lock:
+                if not self.pending:
+                    # Idle; the next registration starts a new thread
+                    self.thread = None
+                    return
+                by_node: Dict[str, List[_PendingTask]] = {}
+                for pending in self.pending.values():
+                    by_node.setdefault(pending.task.node, []).append(pending)
+            
+            finished = 0
+            for node, pendings in by_node.items():
+                try:
+                    finished += self._poll_node(node, pendings)
+                except Exception as e:
+                    # Transient API trouble; the waits time out if it persists
+                    logger.warning(f"Polling Proxmox tasks on {node} failed: {str(e)}")
+            
+            if finished:
+                interval = settings.PROXMOX_TASK_POLL_MIN_SECONDS
+            else:
+                interval = min(interval * 2, settings.PROXMOX_TASK_POLL_MAX_SECONDS)
+    
+    def _poll_node(self, node: str, pendings: List[_PendingTask]) -> int:
+        api = self.session.api
+        listed = api.nodes(node).tasks.get(
+            source='all',
+            since=min(pending.task.started_at for pending in pendings) - 1,
+            limit=self.LIST_LIMIT
+        )
+        entries = {entry['upid']: entry for entry in listed}
+        
+        finished = 0
+        for pending in pendings:
+            entry = entries.get(pending.task.upid)
+            if entry is None:
+                # Beyond the listing; ask for this one
+                entry = api.nodes(node).tasks(pending.task.upid).status.get()
+                if entry.get('status') == 'stopped':
+                    pending.finish(entry.get('exitstatus') or 'unknown')
+                    finished += 1
+            elif entry.get('endtime'):
+                pending.finish(entry.get('status') or 'unknown', entry['endtime'])
+                finished += 1
+        return finished
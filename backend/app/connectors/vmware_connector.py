@@ -1,15 +1,332 @@
 """VMware vSphere connector"""
-from pyVim import connect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import ssl
-from typing import List, Dict, Any, Optional
+import threading
+import time
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 import logging
 
+from app.config import settings
+from app.connectors.vmware_pool import pool
+from app.connectors.vmware_tasks import TaskWaiter
+
 logger = logging.getLogger(__name__)
 
 
+# Properties _vm_info_from_properties reads; nothing else is fetched
+VM_INFO_PROPERTIES = [
+    'name',
+    'runtime.powerState',
+    'config.hardware.numCPU',
+    'config.hardware.memoryMB',
+    'config.hardware.device',
+    'config.guestFullName',
+    'config.uuid',
+    'config.instanceUuid',
+    'parent',
+    'runtime.host',
+]
+
+# Objects whose names locate a VM: its folder, its host and the host's cluster
+INVENTORY_NAME_TYPES = [vim.Folder, vim.ComputeResource, vim.HostSystem]
+
+# Names of the snapshots migrations take before copying a VM's disks
+MIGRATION_SNAPSHOT_PREFIX = "migration-backup-"
+
+
+def _view_filter_spec(view: vim.view.ContainerView, obj_type, path_set: List[str]):
+    """FilterSpec selecting path_set of every obj_type object in a container view"""
+    return vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view,
+            skip=True,
+            selectSet=[vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverseView',
+                path='view',
+                skip=False,
+                type=vim.view.ContainerView
+            )]
+        )],
+        propSet=[vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set, all=False)]
+    )
+
+
+def _retrieve_properties(connection, root, obj_type, path_set: List[str]) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+    """
+    Yield (object, {property path: value}) for objects of obj_type
+    
+    root is either a ContainerView, whose objects are traversed, or a
+    single managed object. Results are paged with RetrievePropertiesEx.
+    """
+    collector = connection.RetrieveContent().propertyCollector
+    
+    if isinstance(root, vim.view.ContainerView):
+        filter_spec = _view_filter_spec(root, obj_type, path_set)
+    else:
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=root, skip=False)],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set, all=False)]
+        )
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=settings.VMWARE_PROPERTY_PAGE_SIZE)
+    
+    result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=options)
+    try:
+        while result:
+            for obj in result.objects:
+                yield obj.obj, {prop.name: prop.val for prop in obj.propSet}
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token=result.token)
+    finally:
+        # Release the server-side result set if the caller stopped early
+        if result and result.token:
+            collector.CancelRetrievePropertiesEx(token=result.token)
+
+
+def _inventory_names(connection) -> Dict[str, Dict[str, str]]:
+    """
+    Folder names and the cluster name of each host, by managed object ID
+    
+    One bulk fetch; _vm_info_from_properties resolves a VM's 'parent' and
+    'runtime.host' with it. A standalone host's cluster is its compute
+    resource, named after the host.
+    """
+    content = connection.RetrieveContent()
+    view = content.viewManager.CreateContainerView(content.rootFolder, INVENTORY_NAME_TYPES, True)
+    folders = {}
+    compute_resources = {}
+    host_parents = {}
+    try:
+        for obj, properties in _retrieve_properties(connection, view, vim.ManagedEntity, ['name', 'parent']):
+            if isinstance(obj, vim.HostSystem):
+                host_parents[obj._moId] = properties.get('parent')
+            elif isinstance(obj, vim.Folder):
+                folders[obj._moId] = properties.get('name')
+            else:
+                compute_resources[obj._moId] = properties.get('name')
+    finally:
+        view.Destroy()
+    
+    clusters = {
+        moid: compute_resources.get(parent._moId)
+        for moid, parent in host_parents.items() if parent is not None
+    }
+    return {'folders': folders, 'clusters': clusters}
+
+
+class VMIndex:
+    """
+    Name and UUID to VM index of one vCenter session
+    
+    Built with one bulk fetch, then kept current from the update stream of a
+    private PropertyCollector: renamed, created and deleted VMs arrive as
+    deltas, fetched at most every VMWARE_INDEX_SYNC_SECONDS or on a miss.
+    Lookups in between are dictionary hits.
+    """
+    
+    PROPERTIES = ['name', 'config.uuid', 'config.instanceUuid']
+    
+    def __init__(self, connection, sync_interval: Optional[float] = None):
+        content = connection.RetrieveContent()
+        self.sync_interval = sync_interval if sync_interval is not None else settings.VMWARE_INDEX_SYNC_SECONDS
+        # A private collector keeps this update stream apart from other waiters
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+        self.collector.CreateFilter(_view_filter_spec(self.view, vim.VirtualMachine, self.PROPERTIES), True)
+        self.version = ''
+        self.vms: Dict[str, Tuple[vim.VirtualMachine, Dict[str, Any]]] = {}
+        self.by_name: Dict[str, str] = {}
+        self.by_uuid: Dict[str, str] = {}
+        self.synced_at = 0.0
+        self.lock = threading.Lock()
+    
+    def find(self, name: Optional[str] = None, uuid: Optional[str] = None) -> Optional[vim.VirtualMachine]:
+        """Find a VM by name, or by BIOS or instance UUID"""
+        with self.lock:
+            synced = time.monotonic() - self.synced_at >= self.sync_interval
+            if synced:
+                self._sync()
+            vm = self._lookup(name, uuid)
+            if vm is None and not synced:
+                # Maybe created or renamed since the last sync
+                self._sync()
+                vm = self._lookup(name, uuid)
+            return vm
+    
+    def destroy(self):
+        """Drop the server-side collector and view"""
+        try:
+            self.collector.DestroyPropertyCollector()
+            self.view.Destroy()
+        except Exception as e:
+            logger.debug(f"Failed to destroy VM index: {str(e)}")
+    
+    def _lookup(self, name: Optional[str], uuid: Optional[str]) -> Optional[vim.VirtualMachine]:
+        moid = self.by_name.get(name) if name is not None else self.by_uuid.get(uuid)
+        return self.vms[moid][0] if moid in self.vms else None
+    
+    def _sync(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        while True:
+            update = self.collector.WaitForUpdatesEx(version=self.version, options=options)
+            if update is None:
+                break
+            for filter_update in update.filterSet:
+                for object_update in filter_update.objectSet:
+                    self._apply(object_update)
+            self.version = update.version
+            if not update.truncated:
+                break
+        self.synced_at = time.monotonic()
+    
+    def _apply(self, object_update):
+        moid = object_update.obj._moId
+        if moid in self.vms:
+            self._unmap(moid)
+        if object_update.kind == 'leave':
+            self.vms.pop(moid, None)
+            return
+        
+        vm, properties = self.vms.get(moid, (object_update.obj, {}))
+        for change in object_update.changeSet:
+            if change.op == 'assign':
+                properties[change.name] = change.val
+            else:
+                properties.pop(change.name, None)
+        self.vms[moid] = (vm, properties)
+        
+        if properties.get('name') is not None:
+            self.by_name[properties['name']] = moid
+        for key in ('config.uuid', 'config.instanceUuid'):
+            if properties.get(key):
+                self.by_uuid[properties[key]] = moid
+    
+    def _unmap(self, moid: str):
+        properties = self.vms[moid][1]
+        if self.by_name.get(properties.get('name')) == moid:
+            del self.by_name[properties['name']]
+        for key in ('config.uuid', 'config.instanceUuid'):
+            if self.by_uuid.get(properties.get(key)) == moid:
+                del self.by_uuid[properties[key]]
+
+
+class InventoryFeed:
+    """
+    Change stream of the VM information list_vms reports, for one session
+    
+    The first call to changes() returns the whole inventory, later calls
+    only the VMs created, changed or deleted since the previous call. Changes
+    that arrive as partial updates of a property (a single device, say) are
+    not merged; the VM is fetched again instead. Folder and cluster names
+    are fetched on every call, and when one was renamed all VMs count as
+    changed.
+    """
+    
+    def __init__(self, connection):
+        content = connection.RetrieveContent()
+        self.connection = connection
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+        self.collector.CreateFilter(_view_filter_spec(self.view, vim.VirtualMachine, VM_INFO_PROPERTIES), True)
+        self.version = ''
+        self.vms: Dict[str, Tuple[vim.VirtualMachine, Dict[str, Any]]] = {}
+        self.names = None
+        self.lock = threading.Lock()
+    
+    def changes(self) -> Tuple[bool, Dict[str, Dict[str, Any]], List[str]]:
+        """
+        Fetch what changed since the previous call
+        
+        Returns (full, updated, removed): whether this is the whole inventory,
+        list_vms information of new and changed VMs by managed object ID and
+        the IDs of deleted VMs. VMs without readable configuration are left
+        out, as list_vms does.
+        """
+        with self.lock:
+            full = not self.version
+            changed = set()
+            removed = set()
+            refetch = set()
+            
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+            while True:
+                update = self.collector.WaitForUpdatesEx(version=self.version, options=options)
+                if update is None:
+                    break
+                for filter_update in update.filterSet:
+                    for object_update in filter_update.objectSet:
+                        moid = object_update.obj._moId
+                        if object_update.kind == 'leave':
+                            self.vms.pop(moid, None)
+                            changed.discard(moid)
+                            refetch.discard(moid)
+                            removed.add(moid)
+                            continue
+                        vm, properties = self.vms.setdefault(moid, (object_update.obj, {}))
+                        for change in object_update.changeSet:
+                            if change.name not in VM_INFO_PROPERTIES:
+                                refetch.add(moid)
+                            elif change.op == 'assign':
+                                properties[change.name] = change.val
+                            else:
+                                properties.pop(change.name, None)
+                        changed.add(moid)
+                        removed.discard(moid)
+                self.version = update.version
+                if not update.truncated:
+                    break
+            
+            if refetch:
+                self._refetch(refetch)
+            
+            names = _inventory_names(self.connection)
+            if names != self.names:
+                self.names = names
+                changed = set(self.vms)
+            
+            updated = {}
+            for moid in changed:
+                vm, properties = self.vms[moid]
+                try:
+                    updated[moid] = VMwareConnector._vm_info_from_properties(vm, properties, names)
+                except Exception as e:
+                    logger.warning(f"Failed to get info for VM {properties.get('name', moid)}: {str(e)}")
+                    # Report it gone rather than keep a stale entry
+                    removed.add(moid)
+            return full, updated, sorted(removed)
+    
+    def destroy(self):
+        """Drop the server-side collector and view"""
+        try:
+            self.collector.DestroyPropertyCollector()
+            self.view.Destroy()
+        except Exception as e:
+            logger.debug(f"Failed to destroy inventory feed: {str(e)}")
+    
+    def _refetch(self, moids):
+        collector = self.connection.RetrieveContent().propertyCollector
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[
+                vmodl.query.PropertyCollector.ObjectSpec(obj=self.vms[moid][0], skip=False)
+                for moid in moids
+            ],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                type=vim.VirtualMachine, pathSet=VM_INFO_PROPERTIES, all=False
+            )]
+        )
+        for obj in collector.RetrieveProperties(specSet=[spec]) or []:
+            self.vms[obj.obj._moId] = (obj.obj, {prop.name: prop.val for prop in obj.propSet})
+
+
 class VMwareConnector:
-    """VMware vSphere API connector"""
+    """
+    VMware vSphere API connector
+    
+    Sessions come from the process-wide pool: connect() leases one and
+    disconnect() returns it, logged in, for the next connector.
+    """
     
     def __init__(self, host: str, user: str, password: str, port: int = 443, verify_ssl: bool = False):
         self.host = host
@@ -17,21 +334,24 @@ class VMwareConnector:
         self.password = password
         self.port = port
         self.verify_ssl = verify_ssl
-        self.connection = None
+        self._session = None
+    
+    @property
+    def connection(self):
+        """Service instance of the leased session"""
+        return self._session.connection if self._session else None
     
     def connect(self) -> bool:
         """Connect to vCenter/ESXi"""
+        if self._session is not None:
+            return True
         try:
-            context = None
-            if not self.verify_ssl:
-                context = ssl._create_unverified_context()
-            
-            self.connection = connect.SmartConnect(
-                host=self.host,
-                user=self.user,
-                pwd=self.password,
+            self._session = pool.acquire(
+                self.host,
+                self.user,
+                self.password,
                 port=self.port,
-                sslContext=context
+                verify_ssl=self.verify_ssl
             )
             logger.info(f"Connected to VMware: {self.host}")
             return True
@@ -41,57 +361,109 @@ class VMwareConnector:
     
     def disconnect(self):
         """Disconnect from vCenter/ESXi"""
-        if self.connection:
-            connect.Disconnect(self.connection)
+        if self._session is not None:
+            pool.release(self._session)
+            self._session = None
             logger.info("Disconnected from VMware")
     
     def list_vms(self) -> List[Dict[str, Any]]:
         """List all VMs"""
+        return list(self.iter_vms())
+    
+    def iter_vms(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the information of every VM as it is fetched
+        
+        Properties of all VMs are fetched in pages of VMWARE_PROPERTY_PAGE_SIZE
+        through the PropertyCollector, so the whole inventory takes a handful
+        of round trips instead of several per VM.
+        """
         if not self.connection:
             self.connect()
         
+        names = _inventory_names(self.connection)
         content = self.connection.RetrieveContent()
         container = content.viewManager.CreateContainerView(
             content.rootFolder, [vim.VirtualMachine], True
         )
         
-        vms = []
-        for vm in container.view:
-            try:
-                vm_info = self._get_vm_info(vm)
-                vms.append(vm_info)
-            except Exception as e:
-                logger.warning(f"Failed to get info for VM {vm.name}: {str(e)}")
-        
-        container.Destroy()
-        return vms
+        try:
+            for vm, properties in self._retrieve_properties(container, vim.VirtualMachine, VM_INFO_PROPERTIES):
+                try:
+                    info = self._vm_info_from_properties(vm, properties, names)
+                except Exception as e:
+                    logger.warning(f"Failed to get info for VM {properties.get('name', vm._moId)}: {str(e)}")
+                    continue
+                yield info
+        finally:
+            container.Destroy()
+    
+    def _retrieve_properties(
+        self,
+        root,
+        obj_type,
+        path_set: List[str]
+    ) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        """Yield (object, {property path: value}) for objects of obj_type; see _retrieve_properties"""
+        return _retrieve_properties(self.connection, root, obj_type, path_set)
     
     def get_vm_by_name(self, name: str) -> Optional[vim.VirtualMachine]:
         """Get VM object by name"""
+        return self._get_vm_index().find(name=name)
+    
+    def get_vm_by_uuid(self, uuid: str) -> Optional[vim.VirtualMachine]:
+        """Get VM object by BIOS or instance UUID"""
+        return self._get_vm_index().find(uuid=uuid)
+    
+    def get_vm_info(self, vm_name: str) -> Dict[str, Any]:
+        """Get the information list_vms reports, for one VM"""
+        return self._get_vm_info(self._get_vm(vm_name))
+    
+    def invalidate_vm_index(self):
+        """Drop the VM index; the next lookup rebuilds it"""
+        if self._session is not None:
+            self._session.invalidate_vm_index()
+    
+    def inventory_changes(self) -> Tuple[bool, Dict[str, Dict[str, Any]], List[str]]:
+        """VMs changed since the previous call on this session; see InventoryFeed.changes"""
         if not self.connection:
             self.connect()
-        
-        content = self.connection.RetrieveContent()
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder, [vim.VirtualMachine], True
-        )
-        
-        for vm in container.view:
-            if vm.name == name:
-                container.Destroy()
-                return vm
-        
-        container.Destroy()
-        return None
+        return self._session.inventory_feed().changes()
+    
+    def reset_inventory_feed(self):
+        """Start the session's inventory feed over; its next changes are the whole inventory"""
+        if self._session is not None:
+            self._session.reset_inventory_feed()
+    
+    def _get_vm_index(self) -> VMIndex:
+        if not self.connection:
+            self.connect()
+        return self._session.vm_index()
     
     def _get_vm_info(self, vm: vim.VirtualMachine) -> Dict[str, Any]:
         """Extract VM information"""
-        summary = vm.summary
-        config = vm.config
+        names = _inventory_names(self.connection)
+        for _, properties in self._retrieve_properties(vm, vim.VirtualMachine, VM_INFO_PROPERTIES):
+            return self._vm_info_from_properties(vm, properties, names)
+        raise ValueError(f"VM not found: {vm._moId}")
+    
+    @staticmethod
+    def _vm_info_from_properties(
+        vm: vim.VirtualMachine,
+        properties: Dict[str, Any],
+        names: Optional[Dict[str, Dict[str, str]]] = None
+    ) -> Dict[str, Any]:
+        """Build VM information from retrieved VM_INFO_PROPERTIES and _inventory_names"""
+        # Unset properties are left out; a VM without config is inaccessible
+        if 'config.hardware.device' not in properties:
+            raise ValueError("VM configuration is not available")
+        devices = properties['config.hardware.device']
+        parent = properties.get('parent')
+        host = properties.get('runtime.host')
         
         # Get disk info
         disks = []
-        for device in config.hardware.device:
+        for device in devices:
             if isinstance(device, vim.vm.device.VirtualDisk):
                 disks.append({
                     'label': device.deviceInfo.label,
@@ -102,7 +474,7 @@ class VMwareConnector:
         
         # Get network info
         networks = []
-        for device in config.hardware.device:
+        for device in devices:
             if isinstance(device, vim.vm.device.VirtualEthernetCard):
                 networks.append({
                     'label': device.deviceInfo.label,
@@ -113,16 +485,18 @@ class VMwareConnector:
         
         return {
             'id': vm._moId,
-            'name': vm.name,
-            'status': summary.runtime.powerState,
-            'cpu_cores': config.hardware.numCPU,
-            'memory_mb': config.hardware.memoryMB,
+            'name': properties['name'],
+            'status': properties.get('runtime.powerState'),
+            'cpu_cores': properties['config.hardware.numCPU'],
+            'memory_mb': properties['config.hardware.memoryMB'],
             'disk_size_gb': int(sum(d['size_gb'] for d in disks)),
             'disks': disks,
             'networks': networks,
-            'guest_os': config.guestFullName,
-            'uuid': config.uuid,
-            'instance_uuid': config.instanceUuid
+            'guest_os': properties.get('config.guestFullName'),
+            'uuid': properties.get('config.uuid'),
+            'instance_uuid': properties.get('config.instanceUuid'),
+            'folder': names['folders'].get(parent._moId) if names and parent else None,
+            'cluster': names['clusters'].get(host._moId) if names and host else None
         }
     
     def power_off_vm(self, vm_name: str) -> bool:
@@ -144,7 +518,26 @@ class VMwareConnector:
             logger.error(f"Failed to power off VM {vm_name}: {str(e)}")
             raise
     
-    def create_snapshot(self, vm_name: str, snapshot_name: str) -> str:
+    def power_on_vm(self, vm_name: str) -> bool:
+        """Power on VM"""
+        vm = self.get_vm_by_name(vm_name)
+        if not vm:
+            raise ValueError(f"VM not found: {vm_name}")
+        
+        if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
+            logger.info(f"VM {vm_name} already powered on")
+            return True
+        
+        try:
+            task = vm.PowerOnVM_Task()
+            self._wait_for_task(task)
+            logger.info(f"VM {vm_name} powered on")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to power on VM {vm_name}: {str(e)}")
+            raise
+    
+    def create_snapshot(self, vm_name: str, snapshot_name: str, quiesce: bool = True) -> str:
         """Create VM snapshot"""
         vm = self.get_vm_by_name(vm_name)
         if not vm:
@@ -155,7 +548,7 @@ class VMwareConnector:
                 name=snapshot_name,
                 description="Migration backup snapshot",
                 memory=False,
-                quiesce=True
+                quiesce=quiesce
             )
             self._wait_for_task(task)
             logger.info(f"Snapshot created for {vm_name}: {snapshot_name}")
@@ -164,6 +557,203 @@ class VMwareConnector:
             logger.error(f"Failed to create snapshot: {str(e)}")
             raise
     
+    def create_snapshots(
+        self,
+        vm_names: List[str],
+        snapshot_name: str,
+        quiesce: bool = True,
+        max_concurrent: Optional[int] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Snapshot several VMs at once
+        
+        Returns {vm_name: {'success': bool, 'error': message or None}}; see
+        _run_bulk for concurrency and timeout.
+        """
+        def start(vm: vim.VirtualMachine):
+            return vm.CreateSnapshot_Task(
+                name=snapshot_name,
+                description="Migration backup snapshot",
+                memory=False,
+                quiesce=quiesce
+            )
+        
+        return self._run_bulk("Snapshot", vm_names, start, max_concurrent, timeout)
+    
+    def power_off_vms(
+        self,
+        vm_names: List[str],
+        max_concurrent: Optional[int] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Power off several VMs at once; VMs already off succeed right away
+        
+        Returns {vm_name: {'success': bool, 'error': message or None}}; see
+        _run_bulk for concurrency and timeout.
+        """
+        def start(vm: vim.VirtualMachine):
+            if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOff:
+                return None
+            return vm.PowerOffVM_Task()
+        
+        return self._run_bulk("Power-off", vm_names, start, max_concurrent, timeout)
+    
+    def _run_bulk(
+        self,
+        action: str,
+        vm_names: List[str],
+        start: Callable[[vim.VirtualMachine], Optional[vim.Task]],
+        max_concurrent: Optional[int] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Run start(vm) for every VM and wait for the tasks it returns
+        
+        At most max_concurrent (VMWARE_BULK_MAX_CONCURRENT_TASKS) tasks are
+        in flight; the next VM's task starts as soon as one finishes. All
+        waits share the session's task waiter, so they are served by one
+        update stream. timeout bounds the whole batch. A VM failing does not
+        stop the others.
+        """
+        vm_names = list(dict.fromkeys(vm_names))
+        if not vm_names:
+            return {}
+        max_concurrent = max_concurrent or settings.VMWARE_BULK_MAX_CONCURRENT_TASKS
+        timeout = timeout if timeout is not None else settings.VMWARE_TASK_TIMEOUT_SECONDS
+        deadline = time.monotonic() + timeout
+        waiter = self._get_task_waiter()
+        
+        def run(vm_name: str) -> Dict[str, Any]:
+            try:
+                task = start(self._get_vm(vm_name))
+                if task is not None:
+                    waiter.wait(task, timeout=max(0.0, deadline - time.monotonic()))
+                return {'success': True, 'error': None}
+            except Exception as e:
+                return {'success': False, 'error': getattr(e, 'msg', None) or str(e)}
+        
+        with ThreadPoolExecutor(
+            max_workers=min(max_concurrent, len(vm_names)),
+            thread_name_prefix="vsphere-bulk"
+        ) as executor:
+            results = dict(zip(vm_names, executor.map(run, vm_names)))
+        
+        failed = [vm_name for vm_name, outcome in results.items() if not outcome['success']]
+        if failed:
+            logger.error(f"{action} failed for {len(failed)} of {len(vm_names)} VMs: {', '.join(failed)}")
+        else:
+            logger.info(f"{action} done for {len(vm_names)} VMs")
+        return results
+    
+    def remove_snapshot(self, vm_name: str, snapshot_name: str) -> bool:
+        """Remove a VM snapshot, consolidating its changes into the parent"""
+        snapshot = self._find_snapshot(self._get_vm(vm_name), snapshot_name)
+        
+        try:
+            task = snapshot.RemoveSnapshot_Task(removeChildren=False, consolidate=True)
+            self._wait_for_task(task)
+            logger.info(f"Snapshot removed for {vm_name}: {snapshot_name}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to remove snapshot: {str(e)}")
+            raise
+    
+    def enable_change_tracking(self, vm_name: str) -> bool:
+        """Enable Changed Block Tracking, needed for incremental disk copies"""
+        vm = self._get_vm(vm_name)
+        
+        if vm.config.changeTrackingEnabled:
+            return True
+        
+        try:
+            task = vm.ReconfigVM_Task(spec=vim.vm.ConfigSpec(changeTrackingEnabled=True))
+            self._wait_for_task(task)
+            logger.info(f"Changed Block Tracking enabled for {vm_name}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to enable Changed Block Tracking: {str(e)}")
+            raise
+    
+    def get_snapshot_disks(self, vm_name: str, snapshot_name: str) -> List[Dict[str, Any]]:
+        """Get the disks of a snapshot with their CBT change IDs"""
+        snapshot = self._find_snapshot(self._get_vm(vm_name), snapshot_name)
+        
+        disks = []
+        for device in snapshot.config.hardware.device:
+            if isinstance(device, vim.vm.device.VirtualDisk):
+                disks.append({
+                    'key': device.key,
+                    'file_name': device.backing.fileName,
+                    'change_id': getattr(device.backing, 'changeId', None),
+                    'capacity_bytes': device.capacityInBytes
+                })
+        return disks
+    
+    def query_changed_areas(
+        self,
+        vm_name: str,
+        snapshot_name: str,
+        device_key: int,
+        change_id: str,
+        capacity_bytes: int
+    ) -> List[Tuple[int, int]]:
+        """
+        Get (offset, length) areas of a disk changed since change_id
+        
+        change_id '*' returns all allocated areas of the disk.
+        """
+        vm = self._get_vm(vm_name)
+        snapshot = self._find_snapshot(vm, snapshot_name)
+        
+        areas = []
+        offset = 0
+        # Results are paged; each call covers the disk from startOffset onwards
+        while offset < capacity_bytes:
+            info = vm.QueryChangedDiskAreas(
+                snapshot=snapshot,
+                deviceKey=device_key,
+                startOffset=offset,
+                changeId=change_id
+            )
+            areas.extend((area.start, area.length) for area in info.changedArea or [])
+            next_offset = info.startOffset + info.length
+            if next_offset <= offset:
+                break
+            offset = next_offset
+        
+        return areas
+    
+    def get_vm_moref(self, vm_name: str) -> str:
+        """Get the managed object ID of a VM"""
+        return self._get_vm(vm_name)._moId
+    
+    def get_snapshot_moref(self, vm_name: str, snapshot_name: str) -> str:
+        """Get the managed object ID of a VM snapshot"""
+        return self._find_snapshot(self._get_vm(vm_name), snapshot_name)._moId
+    
+    def get_thumbprint(self) -> str:
+        """Get the SHA-1 thumbprint of the server certificate, as VDDK expects it"""
+        pem = ssl.get_server_certificate((self.host, self.port))
+        digest = hashlib.sha1(ssl.PEM_cert_to_DER_cert(pem)).hexdigest().upper()
+        return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+    
+    def _get_vm(self, vm_name: str) -> vim.VirtualMachine:
+        vm = self.get_vm_by_name(vm_name)
+        if not vm:
+            raise ValueError(f"VM not found: {vm_name}")
+        return vm
+    
+    def _find_snapshot(self, vm: vim.VirtualMachine, snapshot_name: str) -> vim.vm.Snapshot:
+        pending = list(vm.snapshot.rootSnapshotList) if vm.snapshot else []
+        while pending:
+            tree = pending.pop()
+            if tree.name == snapshot_name:
+                return tree.snapshot
+            pending.extend(tree.childSnapshotList)
+        raise ValueError(f"Snapshot {snapshot_name} not found for VM {vm.name}")
+    
     def get_disk_path(self, vm_name: str, disk_index: int = 0) -> str:
         """Get disk file path"""
         vm = self.get_vm_by_name(vm_name)
@@ -179,13 +769,77 @@ class VMwareConnector:
         
         raise ValueError(f"Disk {disk_index} not found for VM {vm_name}")
     
-    def _wait_for_task(self, task):
-        """Wait for vCenter task to complete"""
-        while task.info.state not in [vim.TaskInfo.State.success, vim.TaskInfo.State.error]:
-            pass
+    def get_frozen_disk_paths(self, vm_name: str) -> List[str]:
+        """
+        Get the files holding a powered-off VM's whole disks, for reading them directly
         
-        if task.info.state == vim.TaskInfo.State.error:
-            raise Exception(f"Task failed: {task.info.error.msg}")
+        A migration snapshot taken after power-off moves the VM's writes to a
+        new, empty delta, so each disk is the file below that delta. Without
+        one it is the current file, which the migration snapshot will leave
+        in place, so the paths can be resolved before power-off. Only
+        complete flat extents can be read as raw disks, so VMs with older
+        snapshots are refused.
+        """
+        vm = self.get_vm_by_name(vm_name)
+        if not vm:
+            raise ValueError(f"VM not found: {vm_name}")
+        
+        current = vm.snapshot.currentSnapshot if vm.snapshot else None
+        pending = list(vm.snapshot.rootSnapshotList) if vm.snapshot else []
+        current_name = None
+        while pending and current is not None:
+            tree = pending.pop()
+            if tree.snapshot == current:
+                current_name = tree.name
+                break
+            pending.extend(tree.childSnapshotList)
+        migration_snapshot = bool(current_name and current_name.startswith(MIGRATION_SNAPSHOT_PREFIX))
+        
+        paths = []
+        for device in vm.config.hardware.device:
+            if isinstance(device, vim.vm.device.VirtualDisk):
+                backing = device.backing
+                if migration_snapshot and backing.parent is not None:
+                    backing = backing.parent
+                if backing.parent is not None:
+                    raise ValueError(
+                        f"Disk {len(paths)} of VM {vm_name} is a snapshot delta; "
+                        f"consolidate its snapshots or migrate it warm"
+                    )
+                paths.append(backing.fileName)
+        
+        return paths
+    
+    def get_vm_host_name(self, vm_name: str) -> str:
+        """Get the name of the ESXi host the VM is registered on"""
+        vm = self.get_vm_by_name(vm_name)
+        if not vm:
+            raise ValueError(f"VM not found: {vm_name}")
+        
+        return vm.runtime.host.name
+    
+    def wait_for_tasks(self, tasks: List[vim.Task], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Wait for several tasks together
+        
+        Returns a dict per task with 'state', 'result' and 'error'; see
+        TaskWaiter.wait_many.
+        """
+        return self._get_task_waiter().wait_many(tasks, timeout=timeout)
+    
+    def _wait_for_task(
+        self,
+        task,
+        timeout: Optional[float] = None,
+        progress_callback: Callable[[int], None] = None
+    ):
+        """Wait for vCenter task to complete"""
+        return self._get_task_waiter().wait(task, timeout=timeout, progress_callback=progress_callback)
+    
+    def _get_task_waiter(self) -> TaskWaiter:
+        if not self.connection:
+            self.connect()
+        return self._session.task_waiter()
     
     def __enter__(self):
         self.connect()
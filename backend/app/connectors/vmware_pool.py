@@ -0,0 +1,271 @@
+"""Process-wide pool of authenticated vSphere sessions"""
+from pyVim import connect
+import hashlib
+import os
+import ssl
+import threading
+import time
+from typing import Dict, Any, Tuple
+import logging
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PooledSession:
+    """
+    One authenticated vSphere session, shared by every connector using it
+
+    The session also owns the VM index, the inventory feed and the task
+    waiter, since they hold server-side collectors that belong to the session.
+    """
+
+    def __init__(self, host: str, user: str, password: str, port: int, verify_ssl: bool):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.verify_ssl = verify_ssl
+        self.connection = None
+        self.leases = 0
+        self.logins = 0
+        self.logged_in_at = None
+        self.last_used = time.monotonic()
+        self.last_checked = 0.0
+        self.lock = threading.RLock()
+        self._vm_index = None
+        self._inventory_feed = None
+        self._task_waiter = None
+
+    def login(self):
+        """Log in, replacing any previous session"""
+        self._drop_helpers()
+        context = None
+        if not self.verify_ssl:
+            context = ssl._create_unverified_context()
+        self.connection = connect.SmartConnect(
+            host=self.host,
+            user=self.user,
+            pwd=self.password,
+            port=self.port,
+            sslContext=context
+        )
+        self.logins += 1
+        self.logged_in_at = time.monotonic()
+        self.last_checked = self.logged_in_at
+        logger.info(f"Logged in to VMware: {self.host} as {self.user}")
+
+    def is_alive(self) -> bool:
+        """Ask the server whether the session is still authenticated"""
+        if self.connection is None:
+            return False
+        try:
+            return self.connection.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def vm_index(self):
+        """The session's name/UUID index, built on first use"""
+        from app.connectors.vmware_connector import VMIndex
+
+        with self.lock:
+            if self._vm_index is None:
+                self._vm_index = VMIndex(self.connection)
+            return self._vm_index
+
+    def invalidate_vm_index(self):
+        """Drop the index; the next lookup rebuilds it"""
+        with self.lock:
+            if self._vm_index is not None:
+                self._vm_index.destroy()
+                self._vm_index = None
+
+    def inventory_feed(self):
+        """The session's inventory change feed, created on first use"""
+        from app.connectors.vmware_connector import InventoryFeed
+
+        with self.lock:
+            if self._inventory_feed is None:
+                self._inventory_feed = InventoryFeed(self.connection)
+            return self._inventory_feed
+
+    def reset_inventory_feed(self):
+        """Drop the feed; the next one starts with the whole inventory"""
+        with self.lock:
+            if self._inventory_feed is not None:
+                self._inventory_feed.destroy()
+                self._inventory_feed = None
+
+    def task_waiter(self):
+        """The session's task waiter, shared by all threads using the session"""
+        from app.connectors.vmware_tasks import TaskWaiter
+
+        with self.lock:
+            if self._task_waiter is None:
+                self._task_waiter = TaskWaiter(self.connection)
+            return self._task_waiter
+
+    def logout(self):
+        """Log out and drop the server-side helpers"""
+        self._drop_helpers()
+        if self.connection is not None:
+            try:
+                connect.Disconnect(self.connection)
+            except Exception as e:
+                logger.debug(f"Logout from {self.host} failed: {str(e)}")
+            self.connection = None
+            logger.info(f"Logged out of VMware: {self.host}")
+
+    def _drop_helpers(self):
+        self.invalidate_vm_index()
+        self.reset_inventory_feed()
+        if self._task_waiter is not None:
+            self._task_waiter.close()
+            self._task_waiter = None
+
+
+class VSpherePool:
+    """
+    Authenticated sessions keyed by (host, port, user, password)
+
+    Connectors lease a session instead of logging in and out. Sessions are
+    health-checked when leased after VMWARE_SESSION_CHECK_SECONDS, kept
+    alive by a background thread and logged in again when they expire.
+    Idle sessions are logged out after VMWARE_SESSION_IDLE_SECONDS. The
+    password is part of the key, hashed, so a lease always proves it.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[Tuple, PooledSession] = {}
+        self.lock = threading.Lock()
+        self.counters = {'logins': 0, 'relogins': 0, 'reuses': 0, 'login_failures': 0, 'evictions': 0}
+        self._pid = os.getpid()
+        self._keepalive = None
+
+    def acquire(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        port: int = 443,
+        verify_ssl: bool = False
+    ) -> PooledSession:
+        """Lease a logged-in session, logging in if there is none"""
+        key = (host, port, user, hashlib.sha256(password.encode()).hexdigest())
+
+        with self.lock:
+            self._check_fork()
+            session = self.sessions.get(key)
+            if session is None:
+                session = PooledSession(host, user, password, port, verify_ssl)
+                self.sessions[key] = session
+            session.leases += 1
+            self._start_keepalive()
+
+        try:
+            with session.lock:
+                if session.connection is None:
+                    session.login()
+                    self._count('logins')
+                elif time.monotonic() - session.last_checked >= settings.VMWARE_SESSION_CHECK_SECONDS:
+                    if not session.is_alive():
+                        logger.info(f"VMware session to {host} expired, logging in again")
+                        session.login()
+                        self._count('relogins')
+                    else:
+                        self._count('reuses')
+                    session.last_checked = time.monotonic()
+                else:
+                    self._count('reuses')
+        except Exception:
+            self._count('login_failures')
+            self.release(session)
+            raise
+
+        return session
+
+    def release(self, session: PooledSession):
+        """Return a leased session; it stays logged in for the next lease"""
+        with self.lock:
+            session.leases = max(0, session.leases - 1)
+            session.last_used = time.monotonic()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Counters and per-session state"""
+        now = time.monotonic()
+        with self.lock:
+            return {
+                **self.counters,
+                'sessions': [
+                    {
+                        'host': session.host,
+                        'user': session.user,
+                        'logged_in': session.connection is not None,
+                        'leases': session.leases,
+                        'logins': session.logins,
+                        'age_seconds': int(now - session.logged_in_at) if session.logged_in_at else None,
+                        'idle_seconds': int(now - session.last_used) if not session.leases else 0
+                    }
+                    for session in self.sessions.values()
+                ]
+            }
+
+    def close_all(self):
+        """Log out of every session"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.logout()
+
+    def _count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _check_fork(self):
+        # Sockets inherited from a parent process must not be shared with it
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self.sessions = {}
+            self._keepalive = None
+
+    def _start_keepalive(self):
+        if self._keepalive is None or not self._keepalive.is_alive():
+            self._keepalive = threading.Thread(target=self._keep_alive, name='vsphere-keepalive', daemon=True)
+            self._keepalive.start()
+
+    def _keep_alive(self):
+        while True:
+            time.sleep(settings.VMWARE_SESSION_KEEPALIVE_SECONDS)
+            now = time.monotonic()
+            with self.lock:
+                if os.getpid() != self._pid:
+                    return
+                idle = [
+                    key for key, session in self.sessions.items()
+                    if not session.leases and now - session.last_used >= settings.VMWARE_SESSION_IDLE_SECONDS
+                ]
+                evicted = [self.sessions.pop(key) for key in idle]
+                self.counters['evictions'] += len(evicted)
+                active = list(self.sessions.values())
+
+            for session in evicted:
+                with session.lock:
+                    session.logout()
+
+            for session in active:
+                # Any call resets the server's idle timer; a dead session is redone on next lease
+                if session.lock.acquire(blocking=False):
+                    try:
+                        if session.connection is not None and session.is_alive():
+                            session.last_checked = time.monotonic()
+                        else:
+                            session.last_checked = 0.0
+                    finally:
+                        session.lock.release()
+
+
+# Shared by every connector of this process
+pool = VSpherePool()
@@ -0,0 +1,202 @@
+"""Event-driven waiting on vSphere tasks"""
+from pyVmomi import vim, vmodl
+import threading
+import time
+from typing import List, Dict, Any, Callable, Optional
+import logging
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.error', 'info.result']
+
+
+class _PendingTask:
+    """What the waiter knows about one task"""
+
+    def __init__(self, task: vim.Task, progress_callback: Callable[[int], None] = None):
+        self.task = task
+        self.progress_callback = progress_callback
+        self.filter = None
+        self.state = None
+        self.progress = None
+        self.error = None
+        self.result = None
+        self.done = threading.Event()
+
+    def apply(self, name: str, value):
+        if name == 'info.state':
+            self.state = value
+        elif name == 'info.progress':
+            self.progress = value
+            if self.progress_callback and value is not None:
+                try:
+                    self.progress_callback(value)
+                except Exception as e:
+                    logger.warning(f"Task progress callback failed: {str(e)}")
+        elif name == 'info.error':
+            self.error = value
+        elif name == 'info.result':
+            self.result = value
+
+    def settle(self):
+        """Release the waiter once the task finished; called after a whole change set"""
+        if self.state in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+            self.done.set()
+
+    def fail(self, error: Exception):
+        self.state = vim.TaskInfo.State.error
+        self.error = error
+        self.done.set()
+
+    def error_message(self) -> str:
+        return getattr(self.error, 'msg', None) or str(self.error)
+
+
+class TaskWaiter:
+    """
+    Waits on any number of vSphere tasks of one session
+
+    A single background thread long-polls a private PropertyCollector with
+    WaitForUpdatesEx; each waited-on task is a property filter on it. Waiting
+    threads block on an event until their task's state changes to success
+    or error, so nothing spins and the server only reports changes.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.collector = connection.RetrieveContent().propertyCollector.CreatePropertyCollector()
+        self.version = ''
+        self.pending: Dict[str, _PendingTask] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def wait(
+        self,
+        task: vim.Task,
+        timeout: Optional[float] = None,
+        progress_callback: Callable[[int], None] = None
+    ):
+        """Wait for a task and return its result; raises if it failed or timed out"""
+        outcome = self.wait_many([task], timeout=timeout, progress_callback=progress_callback)[0]
+        if outcome['error'] is not None:
+            if isinstance(outcome['error'], TimeoutError):
+                raise outcome['error']
+            raise Exception(f"Task failed: {outcome['error']}")
+        return outcome['result']
+
+    def wait_many(
+        self,
+        tasks: List[vim.Task],
+        timeout: Optional[float] = None,
+        progress_callback: Callable[[int], None] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Wait for several tasks together
+
+        Returns one dict per task, in order, with 'state', 'result' and
+        'error' (a message, or a TimeoutError for tasks still running at the
+        deadline). progress_callback gets the mean progress of the tasks.
+        """
+        timeout = timeout if timeout is not None else settings.VMWARE_TASK_TIMEOUT_SECONDS
+        deadline = time.monotonic() + timeout
+
+        pendings = []
+
+        def report(_):
+            if progress_callback:
+                progress_callback(int(sum(p.progress or 0 for p in pendings) / len(pendings)))
+
+        try:
+            for task in tasks:
+                pendings.append(self._register(task, report if progress_callback else None))
+            for pending in pendings:
+                pending.done.wait(max(0.0, deadline - time.monotonic()))
+        finally:
+            for pending in pendings:
+                self._unregister(pending)
+
+        outcomes = []
+        for pending in pendings:
+            if not pending.done.is_set():
+                error = TimeoutError(f"Task {pending.task._moId} still running after {int(timeout)}s")
+            elif pending.state == vim.TaskInfo.State.error:
+                error = pending.error_message()
+            else:
+                error = None
+            outcomes.append({'state': pending.state, 'result': pending.result, 'error': error})
+        return outcomes
+
+    def close(self):
+        """Stop the background thread and drop the collector"""
+        self.closed = True
+        try:
+            self.collector.CancelWaitForUpdates()
+        except Exception:
+            pass
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        try:
+            self.collector.DestroyPropertyCollector()
+        except Exception as e:
+            logger.debug(f"Failed to destroy task collector: {str(e)}")
+
+    def _register(self, task: vim.Task, progress_callback: Callable[[int], None] = None) -> _PendingTask:
+        pending = _PendingTask(task, progress_callback)
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)]
+        )
+        # Held across CreateFilter so the first update cannot beat the registration
+        with self.lock:
+            pending.filter = self.collector.CreateFilter(spec, True)
+            self.pending[pending.filter._moId] = pending
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='vsphere-task-waiter', daemon=True)
+                self.thread.start()
+        return pending
+
+    def _unregister(self, pending: _PendingTask):
+        with self.lock:
+            self.pending.pop(pending.filter._moId, None)
+        try:
+            pending.filter.DestroyPropertyFilter()
+        except Exception as e:
+            logger.debug(f"Failed to destroy task filter: {str(e)}")
+
+    def _run(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=settings.VMWARE_TASK_POLL_SECONDS)
+        while not self.closed:
+            with self.lock:
+                if not self.pending:
+                    # Idle; the next registration starts a new thread
+                    self.thread = None
+                    return
+            try:
+                update = self.collector.WaitForUpdatesEx(version=self.version, options=options)
+            except vmodl.fault.RequestCanceled:
+                continue
+            except Exception as e:
+                logger.error(f"Waiting on vSphere tasks failed: {str(e)}")
+                with self.lock:
+                    for pending in self.pending.values():
+                        pending.fail(e)
+                    self.version = ''
+                    self.thread = None
+                return
+
+            if update is None:
+                continue
+            self.version = update.version
+            with self.lock:
+                for filter_update in update.filterSet:
+                    pending = self.pending.get(filter_update.filter._moId)
+                    if pending is None:
+                        continue
+                    for object_update in filter_update.objectSet:
+                        for change in object_update.changeSet:
+                            pending.apply(change.name, change.val)
+                    pending.settle()
@@ -2,7 +2,10 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.config import settings
-from app.api import migrations, vmware, proxmox
+from app.api import migrations, vmware, proxmox, metrics
+from app.api.blocking import executor as blocking_executor
+from app.connectors.proxmox_pool import pool as proxmox_pool
+from app.connectors.vmware_pool import pool as vsphere_pool
 from app.database import engine, Base
 import logging
 
@@ -29,12 +32,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Inventory-Age-Seconds", "X-Next-Cursor", "X-Total-Count"],
 )
 
 # Include routers
 app.include_router(migrations.router, prefix="/api/migrations", tags=["migrations"])
 app.include_router(vmware.router, prefix="/api/vmware", tags=["vmware"])
 app.include_router(proxmox.router, prefix="/api/proxmox", tags=["proxmox"])
+app.include_router(metrics.router, prefix="/api/metrics", tags=["metrics"])
+
+
+@app.on_event("shutdown")
+def release_resources():
+    """Log pooled sessions out and stop the blocking executor"""
+    vsphere_pool.close_all()
+    proxmox_pool.close_all()
+    blocking_executor.shutdown()
 
 
 @app.get("/")
@@ -1,5 +1,5 @@
 """Database models for migration jobs"""
-from sqlalchemy import Column, Integer, String, DateTime, JSON, Enum, Boolean, Text
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, JSON, Enum, Boolean, Text
 from sqlalchemy.sql import func
 from datetime import datetime
 import enum
@@ -40,8 +40,13 @@ class MigrationJob(Base):
     
     # Target configuration
     target_host = Column(String(255), nullable=False)
-    target_node = Column(String(255), nullable=False)
-    target_storage = Column(String(255), nullable=False)
+    target_token_name = Column(String(255), nullable=True)  # Proxmox API token instead of the password
+    target_token_value = Column(String(255), nullable=True)
+    target_node = Column(String(255), nullable=False)  # A node, or "auto"
+    target_storage = Column(String(255), nullable=False)  # A storage, or "auto"
+    placements = Column(JSON, nullable=True)  # {vm_name: {'node', 'storage'}} chosen for "auto" targets
+    vmid_range_start = Column(Integer, nullable=True)  # VMIDs of the migrated VMs, default PROXMOX_VMID_MIN/MAX
+    vmid_range_end = Column(Integer, nullable=True)
     
     # VM configurations (hardware adjustments)
     vm_configs = Column(JSON, nullable=True)  # Per-VM configuration overrides
@@ -56,6 +61,8 @@ class MigrationJob(Base):
     validate_transfer = Column(Boolean, default=True)
     send_notification = Column(Boolean, default=True)
     notification_email = Column(String(255), nullable=True)
+    bandwidth_limit_mbps = Column(Integer, nullable=True)  # None or 0 for unlimited
+    group_cutover = Column(Boolean, default=False)  # Snapshot and power off all VMs together up front
     
     # Progress tracking
     total_vms = Column(Integer, default=0)
@@ -105,3 +112,33 @@ class ValidationResult(Base):
     
     # Timing
     validated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class DiskCheckpoint(Base):
+    """Resume point for a disk transfer of a migrating VM"""
+    __tablename__ = "disk_checkpoints"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, nullable=False, index=True)
+    vm_name = Column(String(255), nullable=False)
+    disk_index = Column(Integer, nullable=False)
+    
+    # Target the transfer writes to
+    target_vmid = Column(Integer, nullable=False)
+    target_volid = Column(String(255), nullable=True)
+    size_bytes = Column(BigInteger, nullable=True)
+    
+    # Everything below committed_offset is flushed to the target
+    committed_offset = Column(BigInteger, default=0)
+    
+    # Last data run written before the checkpoint, re-hashed on resume
+    last_chunk_offset = Column(BigInteger, nullable=True)
+    last_chunk_length = Column(Integer, nullable=True)
+    last_chunk_hash = Column(String(128), nullable=True)
+    
+    # Disk fully transferred and attached
+    completed = Column(Boolean, default=False)
+    
+    # Timing
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -1,6 +1,6 @@
 """Pydantic schemas for API requests/responses"""
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, Field, model_validator
+from typing import Optional, List, Dict, Any, Literal
 from datetime import datetime
 from app.models.migration_job import JobStatus, ScheduleType
 
@@ -13,6 +13,8 @@ class VMConfigSchema(BaseModel):
     network_type: Optional[str] = "virtio"
     network_bridge: Optional[str] = "vmbr0"
     thin_provisioning: bool = True
+    disk_parallelism: Optional[int] = Field(None, ge=1)
+    migration_mode: Literal["cold", "warm"] = "cold"
 
 
 class MigrationJobCreate(BaseModel):
@@ -28,9 +30,16 @@ class MigrationJobCreate(BaseModel):
     # Target
     target_host: str
     target_user: str
-    target_password: str
+    target_password: Optional[str] = None
+    # Proxmox API token (ID without the user, and secret), used instead of the password
+    target_token_name: Optional[str] = None
+    target_token_value: Optional[str] = None
+    # "auto" lets the placement engine pick per VM by free capacity and load
     target_node: str
     target_storage: str
+    # VMIDs for the migrated VMs; the configured range if unset
+    vmid_range_start: Optional[int] = Field(None, ge=100, le=999999999)
+    vmid_range_end: Optional[int] = Field(None, ge=100, le=999999999)
     
     # VM configs (optional per-VM overrides)
     vm_configs: Optional[Dict[str, VMConfigSchema]] = None
@@ -45,6 +54,21 @@ class MigrationJobCreate(BaseModel):
     validate_transfer: bool = True
     send_notification: bool = False
     notification_email: Optional[str] = None
+    bandwidth_limit_mbps: Optional[int] = Field(None, ge=0)
+    group_cutover: bool = False
+    
+    @model_validator(mode='after')
+    def check_target_credentials(self):
+        if self.target_password is None and (self.target_token_name is None or self.target_token_value is None):
+            raise ValueError("target_password or target_token_name and target_token_value required")
+        return self
+    
+    @model_validator(mode='after')
+    def check_vmid_range(self):
+        if self.vmid_range_start and self.vmid_range_end:
+            if self.vmid_range_end - self.vmid_range_start + 1 < len(self.source_vms):
+                raise ValueError("vmid_range_start to vmid_range_end must hold a VMID per source VM")
+        return self
 
 
 class MigrationJobResponse(BaseModel):
@@ -56,6 +80,10 @@ class MigrationJobResponse(BaseModel):
     source_host: str
     target_host: str
     target_node: str
+    target_storage: str
+    placements: Optional[Dict[str, Dict[str, str]]] = None
+    vmid_range_start: Optional[int] = None
+    vmid_range_end: Optional[int] = None
     
     schedule_type: ScheduleType
     scheduled_time: Optional[datetime]
@@ -69,6 +97,8 @@ class MigrationJobResponse(BaseModel):
     total_size_gb: int
     transferred_size_gb: int
     transfer_speed_mbps: int
+    bandwidth_limit_mbps: Optional[int] = None
+    group_cutover: bool = False
     
     created_at: datetime
     started_at: Optional[datetime]
@@ -89,6 +119,7 @@ class MigrationJobUpdate(BaseModel):
     failed_vms: Optional[int] = None
     transferred_size_gb: Optional[int] = None
     transfer_speed_mbps: Optional[int] = None
+    bandwidth_limit_mbps: Optional[int] = Field(None, ge=0)
     error_message: Optional[str] = None
 
 
@@ -105,9 +136,18 @@ class ProxmoxConnectionTest(BaseModel):
     """Test Proxmox connection"""
     host: str
     user: str
-    password: str
+    password: Optional[str] = None
     port: int = 8006
     verify_ssl: bool = False
+    # API token (ID without the user, and secret), used instead of the password
+    token_name: Optional[str] = None
+    token_value: Optional[str] = None
+    
+    @model_validator(mode='after')
+    def check_credentials(self):
+        if self.password is None and (self.token_name is None or self.token_value is None):
+            raise ValueError("password or token_name and token_value required")
+        return self
 
 
 class VMInfo(BaseModel):
@@ -121,6 +161,10 @@ class VMInfo(BaseModel):
     disks: List[Dict[str, Any]]
     networks: List[Dict[str, Any]]
     guest_os: Optional[str] = None
+    uuid: Optional[str] = None
+    instance_uuid: Optional[str] = None
+    folder: Optional[str] = None
+    cluster: Optional[str] = None
 
 
 class ValidationResultResponse(BaseModel):
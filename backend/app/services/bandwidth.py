@@ -0,0 +1,224 @@
+"""Bandwidth limiting for disk streams
+
+Every disk stream reads through a Throttle that draws from up to three
+token buckets: the global one, the one of the ESXi host being read from and
+the one of the job. Buckets live in the worker process, so all streams of a
+worker share them; with BANDWIDTH_REDIS_ENABLED the buckets are kept in Redis
+and shared by all workers instead.
+
+Buckets run on debt: a read always takes its bytes and then waits until the
+bucket is back in credit. A stream never stalls behind a large request and
+the long-run rate stays at the limit.
+"""
+import threading
+import time
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def mbps_to_bytes(mbps: Optional[float]) -> Optional[float]:
+    """Convert a Mbit/s limit to bytes per second; 0 or None means unlimited"""
+    if not mbps:
+        return None
+    return mbps * 1_000_000 / 8
+
+
+class TokenBucket:
+    """In-process token bucket, safe to share between threads"""
+
+    def __init__(self, rate: Optional[float], burst_seconds: Optional[float] = None):
+        self.rate = rate
+        self.burst_seconds = burst_seconds or settings.BANDWIDTH_BURST_SECONDS
+        self.tokens = self._burst()
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate: Optional[float]):
+        """Change the rate; takes effect for the next request"""
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            if rate is not None:
+                self.tokens = min(self.tokens, self._burst())
+
+    def take(self, nbytes: int) -> float:
+        """Take nbytes from the bucket, returns the seconds to wait before using them"""
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self._burst(), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _burst(self) -> float:
+        return (self.rate or 0) * self.burst_seconds
+
+
+# Debt-based bucket in a Redis hash; time comes from Redis so worker clocks don't matter
+_REDIS_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local want = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate) - want
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+if tokens < 0 then
+    return tostring(-tokens / rate)
+end
+return '0'
+"""
+
+
+class RedisTokenBucket:
+    """Token bucket kept in Redis, shared by every worker using the same key"""
+
+    def __init__(self, client, key: str, rate: Optional[float], burst_seconds: Optional[float] = None):
+        self.client = client
+        self.key = key
+        self.rate = rate
+        self.burst_seconds = burst_seconds or settings.BANDWIDTH_BURST_SECONDS
+        self._take = client.register_script(_REDIS_TAKE)
+
+    def set_rate(self, rate: Optional[float]):
+        # The rate travels with every request, so there is nothing to update remotely
+        self.rate = rate
+
+    def take(self, nbytes: int) -> float:
+        rate = self.rate
+        if rate is None:
+            return 0.0
+        try:
+            return float(self._take(keys=[self.key], args=[rate, rate * self.burst_seconds, nbytes]))
+        except Exception as e:
+            # Fail open: losing Redis must not stall every migration
+            logger.warning(f"Bandwidth bucket {self.key} unavailable: {str(e)}")
+            return 0.0
+
+
+class ThroughputMeter:
+    """Bytes moved and the rate achieved over a sliding window"""
+
+    def __init__(self, window_seconds: float = 10.0):
+        self.window_seconds = window_seconds
+        self.total_bytes = 0
+        self.samples = deque()
+        self.lock = threading.Lock()
+
+    def record(self, nbytes: int):
+        """Account for bytes moved"""
+        now = time.monotonic()
+        with self.lock:
+            self.total_bytes += nbytes
+            self.samples.append((now, nbytes))
+            self._expire(now)
+
+    def mbps(self) -> float:
+        """Throughput over the window in Mbit/s"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if not self.samples:
+                return 0.0
+            elapsed = max(now - self.samples[0][0], 1.0)
+            return sum(nbytes for _, nbytes in self.samples) * 8 / 1_000_000 / elapsed
+
+    def _expire(self, now: float):
+        while self.samples and now - self.samples[0][0] > self.window_seconds:
+            self.samples.popleft()
+
+
+class Throttle:
+    """Callable a disk stream calls with the bytes it is about to read"""
+
+    def __init__(self, buckets: List, meter: Optional[ThroughputMeter] = None):
+        self.buckets = buckets
+        self.meter = meter
+
+    def __call__(self, nbytes: int):
+        # Every bucket is charged; the slowest decides the wait
+        wait = max((bucket.take(nbytes) for bucket in self.buckets), default=0.0)
+        if wait > 0:
+            time.sleep(wait)
+        if self.meter is not None:
+            self.meter.record(nbytes)
+
+
+class BandwidthLimiter:
+    """The token buckets of this worker process"""
+
+    def __init__(self):
+        self.buckets: Dict[str, object] = {}
+        self.lock = threading.Lock()
+        self._redis = None
+
+    def throttle(
+        self,
+        source_host: Optional[str] = None,
+        job_id: Optional[int] = None,
+        meter: Optional[ThroughputMeter] = None
+    ) -> Throttle:
+        """Throttle for a stream reading from source_host on behalf of job_id"""
+        buckets = [self._bucket('global', mbps_to_bytes(settings.BANDWIDTH_LIMIT_MBPS))]
+        if source_host:
+            host_limit = settings.BANDWIDTH_HOST_LIMITS_MBPS.get(
+                source_host, settings.BANDWIDTH_HOST_DEFAULT_MBPS
+            )
+            buckets.append(self._bucket(f'host:{source_host}', mbps_to_bytes(host_limit)))
+        if job_id is not None:
+            # Created with the job's limit by set_job_limit
+            buckets.append(self._bucket(f'job:{job_id}', None, update=False))
+        return Throttle(buckets, meter)
+
+    def set_job_limit(self, job_id: int, limit_mbps: Optional[float]):
+        """Set or change the limit of a job, also while its streams run"""
+        rate = mbps_to_bytes(limit_mbps)
+        bucket = self._bucket(f'job:{job_id}', rate, update=False)
+        if bucket.rate != rate:
+            logger.info(f"Bandwidth limit of job {job_id} set to {limit_mbps or 'unlimited'} Mbit/s")
+            bucket.set_rate(rate)
+
+    def release_job(self, job_id: int):
+        """Forget a finished job's bucket"""
+        with self.lock:
+            self.buckets.pop(f'job:{job_id}', None)
+
+    def _bucket(self, name: str, rate: Optional[float], update: bool = True):
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                if settings.BANDWIDTH_REDIS_ENABLED:
+                    bucket = RedisTokenBucket(self._redis_client(), f'bandwidth:{name}', rate)
+                else:
+                    bucket = TokenBucket(rate)
+                self.buckets[name] = bucket
+            elif update and bucket.rate != rate:
+                # Configured limits can change between jobs
+                bucket.set_rate(rate)
+            return bucket
+
+    def _redis_client(self):
+        if self._redis is None:
+            import redis
+
+            self._redis = redis.Redis.from_url(settings.REDIS_URL)
+        return self._redis
+
+
+# Shared by all streams of this worker process
+limiter = BandwidthLimiter()
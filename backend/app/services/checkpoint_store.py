@@ -0,0 +1,123 @@
+"""Persistence for disk transfer checkpoints"""
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.database import SessionLocal
+from app.models.migration_job import DiskCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """
+    Stores disk transfer checkpoints of one migration job
+
+    Every call uses its own short-lived session, so a store can be shared by
+    the VM and disk threads of a job.
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def get_vm(self, vm_name: str) -> List[Dict[str, Any]]:
+        """Get the checkpoints of a VM, ordered by disk index"""
+        db = SessionLocal()
+        try:
+            rows = self._query(db, vm_name).order_by(DiskCheckpoint.disk_index).all()
+            return [self._to_dict(row) for row in rows]
+        finally:
+            db.close()
+
+    def start_vm(self, vm_name: str, target_vmid: int, disk_count: int):
+        """Record a freshly created target VM, replacing stale checkpoints"""
+        db = SessionLocal()
+        try:
+            self._query(db, vm_name).delete(synchronize_session=False)
+            for disk_index in range(disk_count):
+                db.add(DiskCheckpoint(
+                    job_id=self.job_id,
+                    vm_name=vm_name,
+                    disk_index=disk_index,
+                    target_vmid=target_vmid,
+                    committed_offset=0,
+                    completed=False
+                ))
+            db.commit()
+        finally:
+            db.close()
+
+    def set_volume(self, vm_name: str, disk_index: int, volid: str, size_bytes: int):
+        """Record the target volume allocated for a disk"""
+        self._update(vm_name, disk_index, target_volid=volid, size_bytes=size_bytes)
+
+    def save(
+        self,
+        vm_name: str,
+        disk_index: int,
+        committed_offset: int,
+        last_chunk: Optional[Tuple[int, int, str]] = None
+    ):
+        """Record how far a disk transfer has durably progressed"""
+        values = {'committed_offset': committed_offset}
+        if last_chunk:
+            values['last_chunk_offset'], values['last_chunk_length'], values['last_chunk_hash'] = last_chunk
+        self._update(vm_name, disk_index, **values)
+        logger.debug(f"Checkpoint {vm_name} disk {disk_index}: {committed_offset} bytes committed")
+
+    def complete_disk(self, vm_name: str, disk_index: int):
+        """Mark a disk as transferred and attached"""
+        self._update(vm_name, disk_index, completed=True)
+
+    def completed_vms(self) -> List[str]:
+        """VMs of the job whose disks have all completed"""
+        db = SessionLocal()
+        try:
+            rows = db.query(DiskCheckpoint).filter(DiskCheckpoint.job_id == self.job_id).all()
+            vms = {}
+            for row in rows:
+                vms[row.vm_name] = vms.get(row.vm_name, True) and bool(row.completed)
+            return [vm_name for vm_name, completed in vms.items() if completed]
+        finally:
+            db.close()
+
+    def clear(self, vm_name: Optional[str] = None):
+        """Drop the checkpoints of a VM, or of the whole job"""
+        db = SessionLocal()
+        try:
+            query = db.query(DiskCheckpoint).filter(DiskCheckpoint.job_id == self.job_id)
+            if vm_name is not None:
+                query = query.filter(DiskCheckpoint.vm_name == vm_name)
+            query.delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _query(self, db, vm_name: str):
+        return db.query(DiskCheckpoint).filter(
+            DiskCheckpoint.job_id == self.job_id,
+            DiskCheckpoint.vm_name == vm_name
+        )
+
+    def _update(self, vm_name: str, disk_index: int, **values):
+        db = SessionLocal()
+        try:
+            self._query(db, vm_name).filter(
+                DiskCheckpoint.disk_index == disk_index
+            ).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    @staticmethod
+    def _to_dict(row: DiskCheckpoint) -> Dict[str, Any]:
+        return {
+            'disk_index': row.disk_index,
+            'target_vmid': row.target_vmid,
+            'target_volid': row.target_volid,
+            'size_bytes': row.size_bytes,
+            'committed_offset': row.committed_offset or 0,
+            'last_chunk_offset': row.last_chunk_offset,
+            'last_chunk_length': row.last_chunk_length,
+            'last_chunk_hash': row.last_chunk_hash,
+            'completed': bool(row.completed)
+        }
@@ -0,0 +1,354 @@
+"""Adaptive on-the-wire compression for disk streams
+
+CompressedSSHWriter runs a small receiver on the target node over SSH and
+sends it framed, compressed data. The receiver decompresses and writes each
+frame in place, so the compressed stream is what crosses the link.
+
+The compression level is tuned while the transfer runs: the compressor
+hill-climbs towards the level with the best raw throughput (compression plus
+send time, which includes waiting on the link) and backs off when the worker
+runs out of CPU. Frames that do not compress are sent as they are.
+"""
+import os
+import shlex
+import struct
+import time
+import zlib
+import logging
+from typing import Dict, Callable, List, Optional, Tuple
+
+from app.config import settings
+from app.services.disk_transfer import DiskWriter, _SSHMixin
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Frame opcodes; data opcodes double as codec identifiers
+OP_RAW = 0
+OP_ZLIB = 1
+OP_ZSTD = 2
+OP_LZ4 = 3
+OP_ZERO = 4
+OP_FLUSH = 5
+OP_READ = 6
+OP_CLOSE = 7
+
+# opcode, offset, raw length, payload length
+FRAME_HEADER = struct.Struct('!BQII')
+
+# Data is compressed in frames of this size, whatever the chunk size
+FRAME_SIZE = 4 * 1024 * 1024
+
+CODEC_NAMES = {'zstd': OP_ZSTD, 'lz4': OP_LZ4, 'zlib': OP_ZLIB}
+
+# Most preferred first
+CODEC_PREFERENCE = [OP_ZSTD, OP_LZ4, OP_ZLIB]
+
+# Levels the controller moves between; the top of each codec's range costs
+# far more CPU than it saves on the wire
+CODEC_LEVELS = {
+    OP_ZSTD: (1, 12),
+    OP_LZ4: (0, 9),
+    OP_ZLIB: (1, 9),
+}
+
+
+def local_codecs() -> List[int]:
+    """Codecs this worker can compress with"""
+    codecs = [OP_ZLIB]
+    if zstandard is not None:
+        codecs.append(OP_ZSTD)
+    if lz4 is not None:
+        codecs.append(OP_LZ4)
+    return codecs
+
+
+def cpu_headroom() -> float:
+    """Fraction of the worker's CPUs not busy, from the 1-minute load average"""
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        return 1.0
+    return max(0.0, 1.0 - load / (os.cpu_count() or 1))
+
+
+class AdaptiveCompressor:
+    """Compresses frames and tunes the level to the throughput achieved"""
+
+    # Frames measured before the level is reconsidered
+    WINDOW = 8
+
+    # Windows to stay at a level after a probe away from it failed
+    HOLD_WINDOWS = 4
+
+    def __init__(self, codec: int, min_ratio: Optional[float] = None):
+        self.codec = codec
+        self.min_level, self.max_level = CODEC_LEVELS[codec]
+        self.level = self.min_level
+        self.min_ratio = min_ratio or settings.COMPRESSION_MIN_RATIO
+        self.direction = 1
+        self.throughput: Dict[int, float] = {}
+        self._last_level = None
+        self._hold = 0
+
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_frames = 0
+        self._skip_frames = 0
+        self._skip_backoff = 1
+        self._compressors: Dict[int, Callable[[bytes], bytes]] = {}
+
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def compress(self, data) -> Tuple[int, bytes]:
+        """Compress a frame, returns (opcode, payload)"""
+        if self._skip_frames > 0:
+            # Recently incompressible data; don't burn CPU on it again yet
+            self._skip_frames -= 1
+            return OP_RAW, bytes(data)
+
+        payload = self._compressor(self.level)(data)
+        if len(payload) > len(data) * self.min_ratio:
+            self._skip_frames = self._skip_backoff
+            self._skip_backoff = min(self._skip_backoff * 2, 64)
+            return OP_RAW, bytes(data)
+
+        self._skip_backoff = 1
+        return self.codec, payload
+
+    def record(self, raw_length: int, wire_length: int, seconds: float):
+        """Account for a frame's compress-and-send time and adjust the level"""
+        self.raw_bytes += raw_length
+        self.wire_bytes += wire_length
+        self._window_bytes += raw_length
+        self._window_seconds += seconds
+        self._window_frames += 1
+
+        if self._window_frames < self.WINDOW:
+            return
+
+        rate = self._window_bytes / self._window_seconds if self._window_seconds > 0 else float('inf')
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_frames = 0
+
+        previous = self.throughput.get(self.level)
+        self.throughput[self.level] = rate if previous is None else 0.5 * previous + 0.5 * rate
+
+        if cpu_headroom() < settings.COMPRESSION_MIN_CPU_HEADROOM:
+            self._move(self.level - 1)
+            return
+
+        if self._hold > 0:
+            self._hold -= 1
+            return
+
+        # Hill-climb: keep stepping while it helps; when a step hurt, go back,
+        # turn around and settle for a few windows before probing again
+        last = self._last_level
+        if last is not None and self.throughput[self.level] < self.throughput.get(last, 0):
+            self.direction = -self.direction
+            self._hold = self.HOLD_WINDOWS
+            self._move(last)
+        else:
+            self._move(self.level + self.direction)
+
+    def ratio(self) -> float:
+        """Raw to wire byte ratio achieved so far"""
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def _move(self, level: int):
+        level = max(self.min_level, min(self.max_level, level))
+        if level == self.max_level:
+            self.direction = -1
+        elif level == self.min_level:
+            self.direction = 1
+        if level != self.level:
+            logger.debug(f"Compression level {self.level} -> {level}")
+            self._last_level = self.level
+            self.level = level
+
+    def _compressor(self, level: int) -> Callable[[bytes], bytes]:
+        if level not in self._compressors:
+            if self.codec == OP_ZSTD:
+                self._compressors[level] = zstandard.ZstdCompressor(level=level).compress
+            elif self.codec == OP_LZ4:
+                self._compressors[level] = lambda data, level=level: lz4.frame.compress(
+                    data, compression_level=level
+                )
+            else:
+                self._compressors[level] = lambda data, level=level: zlib.compress(data, level)
+        return self._compressors[level]
+
+
+# Runs on the target node; reports its codecs, then applies frames in place
+_RECEIVER = r'''
+import os, struct, sys, zlib
+codecs = {1: zlib.decompress}
+try:
+    import zstandard
+    codecs[2] = zstandard.ZstdDecompressor().decompress
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    codecs[3] = lz4.frame.decompress
+except ImportError:
+    pass
+inp, out = sys.stdin.buffer, sys.stdout.buffer
+out.write((",".join(str(c) for c in sorted(codecs)) + "\n").encode())
+out.flush()
+fd = os.open(sys.argv[1], os.O_RDWR)
+header = struct.Struct("!BQII")
+def read_exact(n):
+    buf = bytearray()
+    while len(buf) < n:
+        part = inp.read(n - len(buf))
+        if not part:
+            sys.exit("stream closed")
+        buf += part
+    return bytes(buf)
+while True:
+    op, offset, length, size = header.unpack(read_exact(header.size))
+    payload = read_exact(size) if size else b""
+    if op == 5 or op == 7:
+        os.fsync(fd)
+        out.write(b"K")
+        out.flush()
+        if op == 7:
+            break
+        continue
+    if op == 6:
+        data = os.pread(fd, length, offset)
+        out.write(data + bytes(length - len(data)))
+        out.flush()
+        continue
+    data = payload if op == 0 else bytes(length) if op == 4 else codecs[op](payload)
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+'''
+
+
+class CompressedSSHWriter(_SSHMixin, DiskWriter):
+    """Writes a disk image on a remote host through a compressing frame stream"""
+
+    def __init__(self, host: str, path: str, user: str = 'root', password: Optional[str] = None,
+                 key_file: Optional[str] = None, port: int = 22, zeroed: bool = False,
+                 codec: str = 'auto'):
+        self.host = host
+        self.path = path
+        self.user = user
+        self.password = password
+        self.key_file = key_file
+        self.port = port
+        self.zeroed = zeroed
+        self.codec = codec
+        self.client = None
+        self.channel = None
+        self.compressor = None
+
+    def open(self, size: int):
+        self._connect(open_sftp=False)
+
+        self.channel = self.client.get_transport().open_session()
+        self.channel.exec_command(
+            f"python3 -c {shlex.quote(_RECEIVER)} {shlex.quote(self.path)}"
+        )
+
+        remote_codecs = {int(c) for c in self._read_line().split(',') if c}
+        self.compressor = AdaptiveCompressor(self._choose_codec(remote_codecs))
+        logger.info(f"Compressing stream to {self.host} with codec {self.compressor.codec}")
+
+    def write(self, offset: int, data: bytes):
+        view = memoryview(data)
+        for start in range(0, len(view), FRAME_SIZE):
+            frame = view[start:start + FRAME_SIZE]
+            started = time.monotonic()
+            op, payload = self.compressor.compress(frame)
+            self._send(op, offset + start, len(frame), payload)
+            self.compressor.record(len(frame), len(payload), time.monotonic() - started)
+
+    def write_zeroes(self, offset: int, length: int):
+        # The receiver materializes zero frames, so keep them modest
+        while length > 0:
+            size = min(length, FRAME_SIZE * 16)
+            self._send(OP_ZERO, offset, size, b'')
+            offset += size
+            length -= size
+
+    def read(self, offset: int, length: int) -> bytes:
+        self._send(OP_READ, offset, length, b'')
+        return self._recv_exact(length)
+
+    def flush(self):
+        self._send(OP_FLUSH, 0, 0, b'')
+        self._expect_ack()
+
+    def chunk_digests(self, size: int, chunk_size: int) -> List[str]:
+        # Make sure the receiver has written everything before hashing
+        self.flush()
+        return self._remote_chunk_digests(size, chunk_size)
+
+    def close(self):
+        if self.channel is not None:
+            try:
+                self._send(OP_CLOSE, 0, 0, b'')
+                self._expect_ack()
+                logger.info(f"Stream to {self.host} compressed {self.compressor.ratio():.2f}x")
+            except Exception as e:
+                logger.warning(f"Failed to close compressed stream cleanly: {str(e)}")
+            self.channel.close()
+            self.channel = None
+        self._disconnect()
+
+    def _choose_codec(self, remote_codecs: set) -> int:
+        usable = [c for c in CODEC_PREFERENCE if c in remote_codecs and c in local_codecs()]
+        if self.codec != 'auto':
+            wanted = CODEC_NAMES[self.codec]
+            if wanted in usable:
+                return wanted
+            logger.warning(f"Codec {self.codec} not available on both ends, using {usable[0]}")
+        return usable[0]
+
+    def _send(self, op: int, offset: int, length: int, payload: bytes):
+        self.channel.sendall(FRAME_HEADER.pack(op, offset, length, len(payload)))
+        if payload:
+            self.channel.sendall(payload)
+
+    def _recv_exact(self, length: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < length:
+            part = self.channel.recv(length - len(buf))
+            if not part:
+                raise IOError(f"Receiver on {self.host} closed the stream: {self._stderr()}")
+            buf += part
+        return bytes(buf)
+
+    def _read_line(self) -> str:
+        buf = bytearray()
+        while not buf.endswith(b'\n'):
+            buf += self._recv_exact(1)
+        return buf.decode().strip()
+
+    def _expect_ack(self):
+        if self._recv_exact(1) != b'K':
+            raise IOError(f"Unexpected reply from receiver on {self.host}")
+
+    def _stderr(self) -> str:
+        if self.channel.recv_stderr_ready():
+            return self.channel.recv_stderr(4096).decode(errors='replace').strip()
+        return ''
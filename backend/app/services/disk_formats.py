@@ -0,0 +1,141 @@
+"""Layout of migrated disks on their target storage, per storage type
+
+Disks are streamed as raw data straight into their volumes, so the format
+is raw on every storage; qcow2 cannot be written in place. What pays off
+per storage is how the volume is laid out and fed:
+
+- preallocation: image files on local directories are reserved with
+  fallocate right after allocation, so the stream lands in contiguous
+  extents and a full filesystem fails the allocation, not the transfer
+  halfway. Network filesystems stay sparse, as fallocate there either
+  writes zeroes over the wire or is not supported, and so does btrfs,
+  whose copy-on-write moves every preallocated block on its first write.
+  Reserved ranges read as zero, so holes are still skipped.
+- queue_depth: chunks read ahead of the writer. Targets with a network
+  round trip per write (NFS, CIFS, CephFS, RBD) get a deeper queue so the
+  reader keeps going while a slow write completes.
+
+Layouts can be overridden per storage type with DISK_LAYOUT_OVERRIDES, and
+benchmark() times the candidates on an actual mount to check the choice;
+scripts/benchmark_disk_layouts.py runs it from the command line.
+"""
+import os
+import shutil
+import tempfile
+import time
+import logging
+from typing import Dict, Any, List, Optional
+
+from app.config import settings
+from app.services.disk_transfer import DiskTransfer, LocalFileReader, LocalFileWriter
+
+logger = logging.getLogger(__name__)
+
+
+# Preallocation modes a layout can ask for
+PREALLOCATION_MODES = ('off', 'falloc')
+
+# Volumes of block storages are device nodes; there is nothing to preallocate
+_BLOCK = {'format': 'raw', 'preallocation': 'off', 'queue_depth': 2}
+
+# Sparse over the network; a deeper queue hides the round trips
+_NETWORK_FILE = {'format': 'raw', 'preallocation': 'off', 'queue_depth': 4}
+
+LAYOUTS: Dict[str, Dict[str, Any]] = {
+    'lvmthin': _BLOCK,
+    'zfspool': _BLOCK,
+    'lvm': _BLOCK,
+    'rbd': {**_BLOCK, 'queue_depth': 4},
+    'nfs': _NETWORK_FILE,
+    'cifs': _NETWORK_FILE,
+    'cephfs': _NETWORK_FILE,
+    'btrfs': {'format': 'raw', 'preallocation': 'off', 'queue_depth': 2},
+    'dir': {'format': 'raw', 'preallocation': 'falloc', 'queue_depth': 2},
+}
+
+# Unknown storages get what transfers always used
+DEFAULT_LAYOUT: Dict[str, Any] = {'format': 'raw', 'preallocation': 'off', 'queue_depth': None}
+
+# Compared against the selected layout by benchmark()
+BENCHMARK_CANDIDATES: Dict[str, Dict[str, Any]] = {
+    'sparse': {'format': 'raw', 'preallocation': 'off', 'queue_depth': 2},
+    'sparse-deep-queue': _NETWORK_FILE,
+    'falloc': LAYOUTS['dir'],
+    'falloc-deep-queue': {**LAYOUTS['dir'], 'queue_depth': 4},
+}
+
+
+def disk_layout(storage_type: Optional[str]) -> Dict[str, Any]:
+    """
+    Layout for disks written onto a storage of the given type
+
+    Keys: 'format' (always raw), 'preallocation' ('off' or 'falloc') and
+    'queue_depth' (None for TRANSFER_QUEUE_DEPTH). Raises ValueError for
+    overrides asking for something the in-place writers cannot do.
+    """
+    layout = dict(LAYOUTS.get(storage_type, DEFAULT_LAYOUT))
+    layout.update(settings.DISK_LAYOUT_OVERRIDES.get(storage_type, {}))
+    if layout['format'] != 'raw':
+        raise ValueError(f"Disks are written in place as raw, not {layout['format']} (storage type {storage_type})")
+    if layout['preallocation'] not in PREALLOCATION_MODES:
+        raise ValueError(f"Unknown preallocation {layout['preallocation']} for storage type {storage_type}")
+    return layout
+
+
+def benchmark(
+    directory: str,
+    storage_type: Optional[str] = None,
+    size_mb: int = 256,
+    candidates: Optional[Dict[str, Dict[str, Any]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Time a disk transfer into directory with each candidate layout
+
+    The source is a local raw image of size_mb, half random data and half
+    zeroes in alternating MiB runs, written to a target preallocated as the
+    layout says. The clock includes the preallocation and the final flush.
+    Returns one dict per candidate with 'name', 'seconds', 'mbps' (source
+    MB per second, None if too fast to time) and 'selected', fastest
+    first; the layout disk_layout picks is named 'selected'.
+    """
+    candidates = dict(candidates or BENCHMARK_CANDIDATES)
+    candidates['selected'] = disk_layout(storage_type)
+    size = size_mb * 1024 * 1024
+
+    source_dir = tempfile.mkdtemp(prefix='layout-bench-src-')
+    target_dir = tempfile.mkdtemp(prefix='layout-bench-', dir=directory)
+    try:
+        source = os.path.join(source_dir, 'source.raw')
+        with open(source, 'wb') as f:
+            for index in range(size_mb):
+                f.write(os.urandom(1024 * 1024) if index % 2 == 0 else bytes(1024 * 1024))
+
+        results = []
+        for name, layout in candidates.items():
+            target = os.path.join(target_dir, f'{name}.raw')
+            started = time.monotonic()
+            try:
+                with open(target, 'wb') as f:
+                    if layout['preallocation'] == 'falloc':
+                        os.posix_fallocate(f.fileno(), 0, size)
+                with LocalFileReader(source) as reader, LocalFileWriter(target, zeroed=True) as writer:
+                    DiskTransfer(reader, writer, queue_depth=layout.get('queue_depth')).run()
+            except OSError as e:
+                logger.warning(f"Benchmark of {name} failed: {str(e)}")
+                continue
+            finally:
+                seconds = time.monotonic() - started
+                if os.path.exists(target):
+                    os.unlink(target)
+            results.append({
+                'name': name,
+                'seconds': round(seconds, 3),
+                'mbps': round(size_mb / seconds, 1) if seconds > 0 else None,
+                'selected': name == 'selected'
+            })
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    results.sort(key=lambda result: result['seconds'])
+    return results
@@ -0,0 +1,1044 @@
+"""Streaming disk transfer engine
+
+Moves a source disk to its target in bounded chunks. A reader thread fills a
+small queue of (offset, data) chunks while the calling thread drains it into
+the writer, so worker memory stays at roughly
+``(TRANSFER_QUEUE_DEPTH + 2) * CHUNK_SIZE_MB`` regardless of disk size.
+
+Transfers are sparse-aware: ranges the reader reports as unallocated are
+never read, and all-zero blocks are detected in the stream. Neither is sent
+to a target that already reads as zero, so thin targets stay thin.
+
+Whole-disk transfers also hash every chunk as it streams past, so the target
+can be verified against the source without reading the source twice.
+"""
+import errno
+import hashlib
+import os
+import queue
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from app.config import settings
+from app.services.progress_monitor import ProgressTracker
+
+logger = logging.getLogger(__name__)
+
+
+# Largest buffer used when zeroes have to be written out explicitly
+_ZERO_WRITE_SIZE = 4 * 1024 * 1024
+
+# Digests of all-zero chunks, by length
+_zero_digests: Dict[int, str] = {}
+_zero_digests_lock = threading.Lock()
+
+_DATASTORE_PATH_RE = re.compile(r'^\[(?P<datastore>[^\]]+)\]\s*(?P<path>.+)$')
+
+
+def datastore_path_to_flat(datastore_path: str) -> str:
+    """
+    Map a vSphere datastore path to the flat extent on the ESXi host
+
+    '[datastore1] web01/web01.vmdk' -> '/vmfs/volumes/datastore1/web01/web01-flat.vmdk'
+
+    The flat extent holds the raw guest blocks, so reading it is all the
+    conversion a VMFS disk needs before it can be written as a raw volume.
+    """
+    match = _DATASTORE_PATH_RE.match(datastore_path)
+    if not match:
+        raise ValueError(f"Not a datastore path: {datastore_path}")
+
+    path = match.group('path')
+    if path.endswith('.vmdk') and not path.endswith('-flat.vmdk'):
+        path = path[:-len('.vmdk')] + '-flat.vmdk'
+
+    return f"/vmfs/volumes/{match.group('datastore')}/{path}"
+
+
+def zero_digest(length: int) -> str:
+    """sha256 of a run of zero bytes, cached since holes repeat at chunk size"""
+    with _zero_digests_lock:
+        if length not in _zero_digests:
+            hasher = hashlib.sha256()
+            _update_zeroes(hasher, length)
+            _zero_digests[length] = hasher.hexdigest()
+        return _zero_digests[length]
+
+
+def disk_digest(chunk_digests: List[str]) -> str:
+    """Whole-disk digest: sha256 over the chunk digests in disk order"""
+    hasher = hashlib.sha256()
+    for digest in chunk_digests:
+        hasher.update(bytes.fromhex(digest))
+    return hasher.hexdigest()
+
+
+def _update_zeroes(hasher, length: int):
+    zeroes = bytes(min(length, _ZERO_WRITE_SIZE))
+    while length > 0:
+        size = min(length, len(zeroes))
+        hasher.update(zeroes[:size])
+        length -= size
+
+
+class DiskReader:
+    """Base class for source disk readers"""
+
+    def open(self):
+        """Open the source disk"""
+        raise NotImplementedError
+
+    def size(self) -> int:
+        """Size of the source disk in bytes"""
+        raise NotImplementedError
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read up to length bytes at offset"""
+        raise NotImplementedError
+
+    def extents(self, offset: int, length: int) -> List[Tuple[int, int, bool]]:
+        """
+        Map a range to (offset, length, allocated) extents
+
+        Readers that cannot query allocation report the whole range as
+        allocated; zero detection in the transfer catches the rest.
+        """
+        return [(offset, length, True)]
+
+    def abort(self):
+        """
+        Break off a read blocked in another thread, called by the stall
+        watchdog; readers that cannot do that leave the read hanging
+        """
+        pass
+
+    def close(self):
+        """Close the source disk"""
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DiskWriter:
+    """Base class for target disk writers"""
+
+    # True when every byte of the opened target already reads as zero,
+    # so zero ranges can be skipped instead of written
+    zeroed = False
+
+    def open(self, size: int):
+        """Open the target for a disk of the given size"""
+        raise NotImplementedError
+
+    def write(self, offset: int, data: bytes):
+        """Write data at offset"""
+        raise NotImplementedError
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read back written data, used to verify checkpoints"""
+        raise NotImplementedError
+
+    def write_zeroes(self, offset: int, length: int):
+        """Make a range read as zero"""
+        zeroes = bytes(min(length, _ZERO_WRITE_SIZE))
+        while length > 0:
+            size = min(length, len(zeroes))
+            self.write(offset, zeroes[:size])
+            offset += size
+            length -= size
+
+    def chunk_digests(self, size: int, chunk_size: int) -> List[str]:
+        """
+        sha256 of every chunk of the target, used to verify a transfer
+
+        The default reads the target back through read(); remote writers
+        hash on the target host so only digests cross the network.
+        """
+        digests = []
+        for offset in range(0, size, chunk_size):
+            length = min(chunk_size, size - offset)
+            hasher = hashlib.sha256()
+            pos = offset
+            while pos < offset + length:
+                data = self.read(pos, min(_ZERO_WRITE_SIZE, offset + length - pos))
+                if not data:
+                    # Past the end of the target reads as zero
+                    _update_zeroes(hasher, offset + length - pos)
+                    break
+                hasher.update(data)
+                pos += len(data)
+            digests.append(hasher.hexdigest())
+        return digests
+
+    def flush(self):
+        """Flush written data to stable storage"""
+        pass
+
+    def abort(self):
+        """Break off a write blocked in another thread, like DiskReader.abort"""
+        pass
+
+    def close(self):
+        """Close the target"""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class LocalFileReader(DiskReader):
+    """Reads a raw disk image from the local filesystem"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY)
+
+    def size(self) -> int:
+        return os.lseek(self.fd, 0, os.SEEK_END)
+
+    def read(self, offset: int, length: int) -> bytes:
+        return os.pread(self.fd, length, offset)
+
+    def extents(self, offset: int, length: int) -> List[Tuple[int, int, bool]]:
+        end = offset + length
+        extents = []
+        pos = offset
+        try:
+            while pos < end:
+                try:
+                    data_start = os.lseek(self.fd, pos, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    # No data past pos
+                    data_start = end
+                data_start = min(data_start, end)
+                if data_start > pos:
+                    extents.append((pos, data_start - pos, False))
+                if data_start >= end:
+                    break
+                data_end = min(os.lseek(self.fd, data_start, os.SEEK_HOLE), end)
+                extents.append((data_start, data_end - data_start, True))
+                pos = data_end
+        except (OSError, AttributeError):
+            # Filesystem or platform without SEEK_DATA/SEEK_HOLE
+            return [(offset, length, True)]
+        return extents
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LocalFileWriter(DiskWriter):
+    """Writes a raw disk image to a local file or block device"""
+
+    def __init__(self, path: str, zeroed: Optional[bool] = None):
+        self.path = path
+        self.fd = None
+        self._zeroed = zeroed
+
+    def open(self, size: int):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Regular files are sized up front so untouched ranges stay holes
+        if os.path.isfile(self.path):
+            current_size = os.fstat(self.fd).st_size
+            if self._zeroed is None:
+                self._zeroed = current_size == 0
+            if current_size < size:
+                os.ftruncate(self.fd, size)
+        self.zeroed = bool(self._zeroed)
+
+    def write(self, offset: int, data: bytes):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def read(self, offset: int, length: int) -> bytes:
+        return os.pread(self.fd, length, offset)
+
+    def flush(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Runs on the target host; prints the sha256 of each chunk of a disk image
+_CHUNK_HASHER = r'''
+import hashlib, os, sys
+path, size, chunk = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+fd = os.open(path, os.O_RDONLY)
+for offset in range(0, size, chunk):
+    end = min(offset + chunk, size)
+    hasher = hashlib.sha256()
+    pos = offset
+    while pos < end:
+        want = min(4 << 20, end - pos)
+        data = os.pread(fd, want, pos) or bytes(want)
+        hasher.update(data)
+        pos += len(data)
+    sys.stdout.write(hasher.hexdigest() + "\n")
+    sys.stdout.flush()
+'''
+
+
+class _SSHMixin:
+    """Shared paramiko connection handling for SSH readers and writers"""
+
+    def _connect(self, open_sftp: bool = True):
+        import paramiko
+
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(
+            self.host,
+            port=self.port,
+            username=self.user,
+            password=self.password,
+            key_filename=self.key_file,
+            allow_agent=self.key_file is None,
+            look_for_keys=self.key_file is None
+        )
+        transport = self.client.get_transport()
+        # Large windows keep the pipe full on high-latency links
+        transport.default_window_size = 2 ** 30
+        transport.packetizer.REKEY_BYTES = 2 ** 40
+        transport.packetizer.REKEY_PACKETS = 2 ** 40
+        if open_sftp:
+            self.sftp = self.client.open_sftp()
+
+    def _remote_chunk_digests(self, size: int, chunk_size: int) -> List[str]:
+        """Hash the chunks of self.path on the remote host"""
+        _, stdout, stderr = self.client.exec_command(
+            f"python3 -c {shlex.quote(_CHUNK_HASHER)} {shlex.quote(self.path)} {size} {chunk_size}"
+        )
+        digests = [line.strip() for line in stdout]
+        if stdout.channel.recv_exit_status() != 0:
+            raise IOError(f"Hashing {self.path} on {self.host} failed: {stderr.read().decode(errors='replace').strip()}")
+        return digests
+
+    def abort(self):
+        # Closing the transport fails every call waiting on its channels
+        if getattr(self, 'client', None) and self.client.get_transport() is not None:
+            self.client.get_transport().close()
+
+    def _disconnect(self):
+        if getattr(self, 'file', None):
+            self.file.close()
+            self.file = None
+        if getattr(self, 'sftp', None):
+            self.sftp.close()
+            self.sftp = None
+        if getattr(self, 'client', None):
+            self.client.close()
+            self.client = None
+
+
+class SSHReader(_SSHMixin, DiskReader):
+    """Reads a disk extent from a remote host over SFTP (e.g. an ESXi flat VMDK)"""
+
+    def __init__(self, host: str, path: str, user: str = 'root', password: Optional[str] = None,
+                 key_file: Optional[str] = None, port: int = 22):
+        self.host = host
+        self.path = path
+        self.user = user
+        self.password = password
+        self.key_file = key_file
+        self.port = port
+        self.client = None
+        self.sftp = None
+        self.file = None
+
+    def open(self):
+        self._connect()
+        self.file = self.sftp.open(self.path, 'rb')
+
+    def size(self) -> int:
+        return self.file.stat().st_size
+
+    def read(self, offset: int, length: int) -> bytes:
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        self._disconnect()
+
+
+class SSHFileWriter(_SSHMixin, DiskWriter):
+    """Writes a raw disk image to a path on a remote host over SFTP"""
+
+    def __init__(self, host: str, path: str, user: str = 'root', password: Optional[str] = None,
+                 key_file: Optional[str] = None, port: int = 22, zeroed: bool = False):
+        self.host = host
+        self.path = path
+        self.user = user
+        self.password = password
+        self.key_file = key_file
+        self.port = port
+        self.zeroed = zeroed
+        self.client = None
+        self.sftp = None
+        self.file = None
+
+    def open(self, size: int):
+        self._connect()
+        # The target volume is allocated beforehand, so never truncate it
+        self.file = self.sftp.open(self.path, 'r+b')
+        self.file.set_pipelined(True)
+
+    def write(self, offset: int, data: bytes):
+        self.file.seek(offset)
+        # paramiko only packs bytes, not memoryview slices
+        self.file.write(bytes(data))
+
+    def read(self, offset: int, length: int) -> bytes:
+        self.file.flush()
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def flush(self):
+        self.file.flush()
+
+    def chunk_digests(self, size: int, chunk_size: int) -> List[str]:
+        self.file.flush()
+        return self._remote_chunk_digests(size, chunk_size)
+
+    def close(self):
+        self._disconnect()
+
+
+class NBDReader(DiskReader):
+    """Reads a disk exported over NBD (e.g. nbdkit with the vddk plugin)"""
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.handle = None
+
+    def open(self):
+        try:
+            import nbd
+        except ImportError:
+            raise RuntimeError("NBD reader requires the libnbd Python bindings (python3-libnbd)")
+
+        self.handle = nbd.NBD()
+        self.handle.connect_uri(self.uri)
+
+    def size(self) -> int:
+        return self.handle.get_size()
+
+    def read(self, offset: int, length: int) -> bytes:
+        length = min(length, self.size() - offset)
+        return self.handle.pread(length, offset)
+
+    def extents(self, offset: int, length: int) -> List[Tuple[int, int, bool]]:
+        import nbd
+
+        if not self.handle.can_meta_context(nbd.CONTEXT_BASE_ALLOCATION):
+            return [(offset, length, True)]
+
+        extents = []
+
+        def collect(metacontext, entry_offset, entries, err):
+            if metacontext != nbd.CONTEXT_BASE_ALLOCATION:
+                return 0
+            pos = entry_offset
+            # entries is a flat list of (length, flags) pairs
+            for i in range(0, len(entries), 2):
+                extent_length, flags = entries[i], entries[i + 1]
+                extent_length = min(extent_length, offset + length - pos)
+                if extent_length <= 0:
+                    break
+                extents.append((pos, extent_length, not flags & nbd.STATE_HOLE))
+                pos += extent_length
+            return 0
+
+        pos = offset
+        while pos < offset + length:
+            before = len(extents)
+            self.handle.block_status(offset + length - pos, pos, collect)
+            if len(extents) == before:
+                break
+            pos = extents[-1][0] + extents[-1][1]
+
+        if pos < offset + length:
+            extents.append((pos, offset + length - pos, True))
+        return extents
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.shutdown()
+            self.handle = None
+
+
+class VDDKReader(NBDReader):
+    """
+    Reads a vSphere disk through nbdkit's VDDK plugin
+
+    With a snapshot the disk is read as it was when the snapshot was taken,
+    which is what lets a running VM be copied consistently.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        user: str,
+        password: str,
+        thumbprint: str,
+        vm_moref: str,
+        file_name: str,
+        snapshot_moref: Optional[str] = None
+    ):
+        super().__init__(uri=None)
+        self.server = server
+        self.user = user
+        self.password = password
+        self.thumbprint = thumbprint
+        self.vm_moref = vm_moref
+        self.file_name = file_name
+        self.snapshot_moref = snapshot_moref
+        self.process = None
+        self.workdir = None
+
+    def open(self):
+        self.workdir = tempfile.mkdtemp(prefix='vddk-')
+        socket_path = os.path.join(self.workdir, 'nbd.sock')
+        password_file = os.path.join(self.workdir, 'password')
+
+        # Keep the password off the command line
+        fd = os.open(password_file, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.password)
+
+        cmd = [
+            'nbdkit', '--exit-with-parent', '--readonly', '--foreground',
+            '--unix', socket_path,
+            'vddk',
+            f'server={self.server}',
+            f'user={self.user}',
+            f'password=+{password_file}',
+            f'thumbprint={self.thumbprint}',
+            f'vm=moref={self.vm_moref}',
+            f'file={self.file_name}'
+        ]
+        if self.snapshot_moref:
+            cmd.append(f'snapshot={self.snapshot_moref}')
+        if settings.VDDK_LIBDIR:
+            cmd.append(f'libdir={settings.VDDK_LIBDIR}')
+
+        self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        deadline = time.monotonic() + 60
+        while not os.path.exists(socket_path):
+            if self.process.poll() is not None:
+                error = self.process.stderr.read().decode(errors='replace')
+                raise ConnectionError(f"nbdkit failed to start: {error.strip()}")
+            if time.monotonic() > deadline:
+                raise TimeoutError("Timed out waiting for nbdkit to start")
+            time.sleep(0.1)
+
+        self.uri = f'nbd+unix:///?socket={socket_path}'
+        super().open()
+
+    def abort(self):
+        # A read waiting on nbdkit fails once the server is gone
+        if self.process is not None:
+            self.process.kill()
+
+    def close(self):
+        super().close()
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+
+class DiskTransfer:
+    """Copies a disk from a reader to a writer in bounded chunks"""
+
+    _DONE = object()
+
+    def __init__(
+        self,
+        reader: DiskReader,
+        writer: DiskWriter,
+        chunk_size: Optional[int] = None,
+        queue_depth: Optional[int] = None,
+        sparse: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        throttle: Optional[Callable[[int], None]] = None,
+        tracker: Optional[ProgressTracker] = None,
+        stall_timeout: Optional[float] = None
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.chunk_size = chunk_size or settings.CHUNK_SIZE_MB * 1024 * 1024
+        self.queue_depth = queue_depth or settings.TRANSFER_QUEUE_DEPTH
+        self.sparse = sparse
+        self.cancel_event = cancel_event
+        # Called with the size of every source read before it is made; may block
+        self.throttle = throttle
+        # Advanced with every byte done, whether written or skipped
+        self.tracker = tracker
+        # Seconds without a read or write before the transfer is aborted; 0 never
+        self.stall_timeout = settings.TRANSFER_STALL_TIMEOUT_SECONDS if stall_timeout is None else stall_timeout
+        self.block_size = settings.SPARSE_BLOCK_SIZE_KB * 1024
+        self.checkpoint_interval = settings.CHECKPOINT_INTERVAL_MB * 1024 * 1024
+        # sha256 per chunk of a whole-disk transfer, None where not streamed
+        self.chunk_digests: Optional[List[Optional[str]]] = None
+
+    def run(
+        self,
+        progress_callback: Callable[[int, str], None] = None,
+        checkpoint: Optional[Dict[str, Any]] = None,
+        checkpoint_callback: Callable[[int, Optional[Tuple[int, int, str]]], None] = None,
+        ranges: Optional[List[Tuple[int, int]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Run the transfer
+
+        checkpoint is a previously saved resume point; the transfer continues
+        from its committed offset if the target still holds the recorded last
+        chunk. checkpoint_callback(committed_offset, last_chunk) is called
+        after every CHECKPOINT_INTERVAL_MB of flushed data, with last_chunk an
+        (offset, length, sha256) tuple of the last data written or None.
+
+        ranges limits the transfer to (offset, length) ranges, e.g. the areas
+        changed since an earlier pass; everything else on the target is left
+        alone. Checkpointing and hashing only apply to whole-disk transfers.
+
+        A transfer that moves no bytes for stall_timeout seconds is aborted:
+        the reader and writer are told to break off their blocked calls and
+        TimeoutError is raised, without waiting for a read that ignores it.
+
+        Returns dict with byte counts, duration, throughput and the whole-disk
+        digest, which is None when part of the disk was copied by an earlier
+        attempt. Chunk digests are left in chunk_digests.
+        """
+        total = self.reader.size()
+        self.writer.open(total)
+
+        if ranges is None:
+            start_offset = self._resume_offset(checkpoint, total)
+            ranges = [(start_offset, total - start_offset)]
+            # Chunks copied by an earlier attempt never streamed past us
+            if start_offset % self.chunk_size == 0:
+                self.chunk_digests = [None] * (start_offset // self.chunk_size)
+            if self.tracker is not None:
+                self.tracker.advance(start_offset)
+        else:
+            start_offset = 0
+            checkpoint_callback = None
+        progress_total = start_offset + sum(length for _, length in ranges)
+
+        chunks = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        stalled = threading.Event()
+        errors = []
+        poll_interval = min(1.0, self.stall_timeout / 4) if self.stall_timeout else 1.0
+        self._last_progress = time.monotonic()
+        self._throttling = False
+
+        producer = threading.Thread(
+            target=self._produce,
+            args=(ranges, chunks, stop, errors),
+            name='disk-transfer-reader',
+            daemon=True
+        )
+        watchdog = threading.Thread(
+            target=self._watch,
+            args=(stop, stalled, poll_interval),
+            name='disk-transfer-watchdog',
+            daemon=True
+        )
+
+        start_time = time.monotonic()
+        bytes_done = 0
+        bytes_written = 0
+        bytes_skipped = 0
+        last_pct = -1
+        last_data = None
+        next_checkpoint = self.checkpoint_interval
+
+        producer.start()
+        if self.stall_timeout:
+            watchdog.start()
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=poll_interval)
+                except queue.Empty:
+                    if stalled.is_set():
+                        raise self._stall_error()
+                    continue
+                if stalled.is_set():
+                    raise self._stall_error()
+                if item is self._DONE:
+                    break
+
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise InterruptedError("Disk transfer cancelled")
+
+                offset, length, data = item
+                if data is not None:
+                    self.writer.write(offset, data)
+                    bytes_written += length
+                    last_data = (offset, data)
+                elif self.writer.zeroed:
+                    bytes_skipped += length
+                else:
+                    self.writer.write_zeroes(offset, length)
+                    bytes_written += length
+                bytes_done += length
+                self._last_progress = time.monotonic()
+                position = start_offset + bytes_done
+                if self.tracker is not None:
+                    self.tracker.advance(length)
+
+                # Checkpoints land on chunk boundaries so a resumed reader stays aligned
+                at_boundary = (position - start_offset) % self.chunk_size == 0 or position == total
+                if checkpoint_callback and at_boundary and bytes_done >= next_checkpoint:
+                    self.writer.flush()
+                    checkpoint_callback(position, self._chunk_digest(last_data))
+                    next_checkpoint = bytes_done + self.checkpoint_interval
+
+                pct = int(position * 100 / progress_total) if progress_total else 100
+                if pct != last_pct and progress_callback:
+                    last_pct = pct
+                    progress_callback(pct, f"{position // (1024**2)}/{progress_total // (1024**2)} MB")
+
+            if errors:
+                raise errors[0]
+
+            self.writer.flush()
+        except Exception as e:
+            # Calls broken off by the watchdog fail with their own errors
+            if stalled.is_set() and not isinstance(e, TimeoutError):
+                raise self._stall_error() from e
+            raise
+        finally:
+            stop.set()
+            # Unblock the reader if it is waiting on a full queue; a reader
+            # still stuck after a stall is left behind, it is a daemon thread
+            while producer.is_alive() and not stalled.is_set():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    producer.join(timeout=0.1)
+
+        duration = time.monotonic() - start_time
+        throughput_mbps = (bytes_done * 8 / 1_000_000) / duration if duration > 0 else 0
+
+        logger.info(
+            f"Transferred {bytes_done} bytes in {duration:.1f}s ({throughput_mbps:.0f} Mbit/s), "
+            f"{bytes_skipped} bytes skipped as sparse"
+        )
+
+        complete = self.chunk_digests is not None and None not in self.chunk_digests
+
+        return {
+            'size_bytes': total,
+            'resumed_from': start_offset,
+            'bytes_written': bytes_written,
+            'bytes_skipped': bytes_skipped,
+            'duration_seconds': duration,
+            'throughput_mbps': throughput_mbps,
+            'chunk_size': self.chunk_size,
+            'digest': disk_digest(self.chunk_digests) if complete else None
+        }
+
+    def _resume_offset(self, checkpoint: Optional[Dict[str, Any]], total: int) -> int:
+        """Offset to start from, after checking the target still matches the checkpoint"""
+        if not checkpoint:
+            return 0
+        # An earlier attempt wrote to the target, also past its last checkpoint,
+        # so zero ranges from here on must be written out
+        self.writer.zeroed = False
+        if not checkpoint.get('committed_offset'):
+            return 0
+
+        committed_offset = checkpoint['committed_offset']
+        # When the checkpoint cannot be trusted the target holds unknown data
+        # past it, so zero ranges must be written out on the restart
+        if committed_offset > total:
+            logger.warning(f"Checkpoint at {committed_offset} is past the end of the disk, restarting")
+            return 0
+
+        if checkpoint.get('last_chunk_hash'):
+            chunk_offset = checkpoint['last_chunk_offset']
+            chunk_length = checkpoint['last_chunk_length']
+            try:
+                digest = hashlib.sha256(self.writer.read(chunk_offset, chunk_length)).hexdigest()
+            except NotImplementedError:
+                logger.warning("Target cannot be read back to verify the checkpoint, restarting")
+                return 0
+            if digest != checkpoint['last_chunk_hash']:
+                logger.warning(f"Target no longer matches checkpoint at {chunk_offset}, restarting")
+                return 0
+
+        logger.info(f"Resuming transfer at offset {committed_offset}")
+        return committed_offset
+
+    @staticmethod
+    def _chunk_digest(last_data) -> Optional[Tuple[int, int, str]]:
+        """Describe the last data run written, for verification on resume"""
+        if last_data is None:
+            return None
+        offset, data = last_data
+        return (offset, len(data), hashlib.sha256(data).hexdigest())
+
+    def _watch(self, stop: threading.Event, stalled: threading.Event, poll_interval: float):
+        """Abort the reader and writer once no bytes moved for stall_timeout seconds"""
+        while not stop.wait(poll_interval):
+            if self._throttling:
+                # Waiting on the bandwidth limit is not a stall
+                self._last_progress = time.monotonic()
+                continue
+            idle = time.monotonic() - self._last_progress
+            if idle < self.stall_timeout:
+                continue
+            logger.error(f"Disk transfer made no progress for {int(idle)}s, aborting")
+            stalled.set()
+            for end in (self.reader, self.writer):
+                try:
+                    end.abort()
+                except Exception as e:
+                    logger.warning(f"Failed to abort {type(end).__name__}: {str(e)}")
+            return
+
+    def _stall_error(self) -> TimeoutError:
+        return TimeoutError(f"Disk transfer made no progress for {self.stall_timeout}s, aborted")
+
+    def _produce(self, ranges: List[Tuple[int, int]], chunks: queue.Queue, stop: threading.Event, errors: list):
+        """Read chunks of the given ranges into the queue"""
+        try:
+            for range_offset, range_length in ranges:
+                self._produce_range(range_offset, range_offset + range_length, chunks, stop)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._put(chunks, stop, self._DONE)
+
+    def _produce_range(self, offset: int, end: int, chunks: queue.Queue, stop: threading.Event):
+        """Read one range into the queue chunk by chunk"""
+        while offset < end and not stop.is_set():
+            length = min(self.chunk_size, end - offset)
+            extents = self.reader.extents(offset, length) if self.sparse else [(offset, length, True)]
+            # Hashing here overlaps with the writes; hashlib drops the GIL on large buffers
+            hasher = hashlib.sha256() if self.chunk_digests is not None else None
+            chunk_digest = None
+
+            for extent_offset, extent_length, allocated in extents:
+                if not allocated:
+                    # Unallocated ranges are never read from the source
+                    if extent_length == length:
+                        chunk_digest = zero_digest(length)
+                    elif hasher is not None:
+                        _update_zeroes(hasher, extent_length)
+                    self._put(chunks, stop, (extent_offset, extent_length, None))
+                    continue
+
+                if self.throttle is not None:
+                    self._throttling = True
+                    try:
+                        self.throttle(extent_length)
+                    finally:
+                        self._throttling = False
+                data = self.reader.read(extent_offset, extent_length)
+                self._last_progress = time.monotonic()
+                if len(data) != extent_length:
+                    raise IOError(f"Unexpected end of source disk at offset {extent_offset + len(data)}")
+                if hasher is not None:
+                    hasher.update(data)
+
+                if self.sparse:
+                    for item in self._split_zero_runs(extent_offset, data):
+                        self._put(chunks, stop, item)
+                else:
+                    self._put(chunks, stop, (extent_offset, extent_length, data))
+
+            if hasher is not None:
+                self.chunk_digests.append(chunk_digest or hasher.hexdigest())
+            offset += length
+
+    def _split_zero_runs(self, offset: int, data: bytes):
+        """Yield (offset, length, data) runs, with data None for all-zero runs"""
+        view = memoryview(data)
+        zero_block = bytes(self.block_size)
+        run_start = 0
+        run_is_zero = None
+
+        for pos in range(0, len(view), self.block_size):
+            block = view[pos:pos + self.block_size]
+            is_zero = block == zero_block[:len(block)]
+            if run_is_zero is None:
+                run_is_zero = is_zero
+            elif is_zero != run_is_zero:
+                yield self._run(offset, view, run_start, pos, run_is_zero)
+                run_start = pos
+                run_is_zero = is_zero
+
+        if run_start < len(view):
+            yield self._run(offset, view, run_start, len(view), run_is_zero)
+
+    @staticmethod
+    def _run(offset: int, view: memoryview, start: int, end: int, is_zero: bool):
+        """Build a queue item for a run of the chunk"""
+        return (offset + start, end - start, None if is_zero else view[start:end])
+
+    def _put(self, chunks: queue.Queue, stop: threading.Event, item):
+        """Put an item on the queue, giving up once the transfer is stopped"""
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+def verify_target(
+    reader: DiskReader,
+    writer: DiskWriter,
+    size: int,
+    chunk_size: int,
+    chunk_digests: List[Optional[str]]
+) -> Dict[str, Any]:
+    """
+    Verify a written target against the digests taken during its transfer
+
+    The target is hashed chunk by chunk where it lives. Chunks without a
+    stream digest, copied by an interrupted earlier attempt, are hashed from
+    the source instead; that is the only source data read a second time.
+
+    Returns dict with the target's disk digest and any mismatching chunks
+    """
+    start_time = time.monotonic()
+    target_digests = writer.chunk_digests(size, chunk_size)
+    if len(target_digests) != len(chunk_digests):
+        raise IOError(f"Expected {len(chunk_digests)} chunk digests from the target, got {len(target_digests)}")
+
+    mismatched = []
+    source_reread_bytes = 0
+    for index, actual in enumerate(target_digests):
+        offset = index * chunk_size
+        length = min(chunk_size, size - offset)
+        expected = chunk_digests[index]
+        if expected is None:
+            expected = _source_chunk_digest(reader, offset, length)
+            source_reread_bytes += length
+        if actual != expected:
+            mismatched.append(offset)
+
+    if mismatched:
+        logger.error(f"Target differs from source in {len(mismatched)} chunks, first at offset {mismatched[0]}")
+
+    return {
+        'passed': not mismatched,
+        'digest': disk_digest(target_digests),
+        'chunks': len(target_digests),
+        'mismatched_chunks': len(mismatched),
+        # Enough to locate the damage without bloating the result
+        'mismatched_offsets': mismatched[:100],
+        'source_reread_bytes': source_reread_bytes,
+        'duration_seconds': time.monotonic() - start_time
+    }
+
+
+def _source_chunk_digest(reader: DiskReader, offset: int, length: int) -> str:
+    """Hash a chunk of the source, without reading its unallocated ranges"""
+    extents = reader.extents(offset, length)
+    if len(extents) == 1 and not extents[0][2]:
+        return zero_digest(length)
+
+    hasher = hashlib.sha256()
+    for extent_offset, extent_length, allocated in extents:
+        if allocated:
+            hasher.update(reader.read(extent_offset, extent_length))
+        else:
+            _update_zeroes(hasher, extent_length)
+    return hasher.hexdigest()
+
+
+def create_reader(host: str, path: str) -> DiskReader:
+    """Create the configured source reader for a disk"""
+    kind = settings.TRANSFER_READER
+
+    if kind == 'ssh':
+        return SSHReader(
+            host,
+            path,
+            user=settings.SOURCE_SSH_USER,
+            password=settings.SOURCE_SSH_PASSWORD,
+            key_file=settings.SOURCE_SSH_KEY_FILE
+        )
+    if kind == 'nbd':
+        return NBDReader(f"nbd://{host}/{path.lstrip('/')}")
+    if kind == 'local':
+        return LocalFileReader(path)
+
+    raise ValueError(f"Unknown transfer reader: {kind}")
+
+
+def create_writer(host: str, path: str, zeroed: bool = False) -> DiskWriter:
+    """
+    Create the configured target writer for a disk
+
+    Pass zeroed=True for freshly allocated volumes, which read as zero and
+    can have zero ranges skipped.
+    """
+    kind = settings.TRANSFER_WRITER
+
+    if kind == 'ssh' and settings.TRANSFER_COMPRESSION != 'off':
+        from app.services.compression import CompressedSSHWriter
+
+        return CompressedSSHWriter(
+            host,
+            path,
+            user=settings.TARGET_SSH_USER,
+            password=settings.TARGET_SSH_PASSWORD,
+            key_file=settings.TARGET_SSH_KEY_FILE,
+            zeroed=zeroed,
+            codec=settings.TRANSFER_COMPRESSION
+        )
+    if kind == 'ssh':
+        return SSHFileWriter(
+            host,
+            path,
+            user=settings.TARGET_SSH_USER,
+            password=settings.TARGET_SSH_PASSWORD,
+            key_file=settings.TARGET_SSH_KEY_FILE,
+            zeroed=zeroed
+        )
+    if kind == 'local':
+        return LocalFileWriter(path, zeroed=zeroed)
+
+    raise ValueError(f"Unknown transfer writer: {kind}")
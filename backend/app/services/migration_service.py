@@ -1,16 +1,65 @@
 """Core migration service"""
-import subprocess
-import os
 import logging
-from typing import Dict, Any, Callable
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from typing import Dict, Any, Callable, List, Optional
 from datetime import datetime
 
-from app.connectors.vmware_connector import VMwareConnector
+from app.config import settings
+from app.connectors.vmware_connector import VMwareConnector, MIGRATION_SNAPSHOT_PREFIX
 from app.connectors.proxmox_connector import ProxmoxConnector
+from app.services.checkpoint_store import CheckpointStore
+from app.services.disk_transfer import (
+    DiskTransfer,
+    VDDKReader,
+    create_reader,
+    datastore_path_to_flat,
+    verify_target
+)
+from app.services.progress_monitor import ProgressTracker
+from app.services.storage_targets import storage_target
+from app.services.vm_spec import create_spec, disks_spec
+from app.services.warm_migration import WarmMigration
 
 logger = logging.getLogger(__name__)
 
 
+class DiskProgressAggregator:
+    """Combines progress of concurrently migrating disks into one value"""
+    
+    def __init__(self, disks: List[Dict[str, Any]], callback: Callable[[int, str], None]):
+        # Weight each disk by its size so big disks dominate the overall figure
+        sizes = [max(disk.get('size_gb') or 0, 0) for disk in disks]
+        total = sum(sizes)
+        self.weights = [size / total if total else 1 / len(disks) for size in sizes]
+        self.progress = [0] * len(disks)
+        self.callback = callback
+        self.lock = threading.Lock()
+    
+    def for_disk(self, disk_index: int) -> Callable[[int, str], None]:
+        """Get the progress callback for one disk"""
+        def update(percentage: int, message: str):
+            # The outer callback may write to a DB session, so serialize it
+            with self.lock:
+                self.progress[disk_index] = percentage
+                overall = sum(p * w for p, w in zip(self.progress, self.weights))
+                self.callback(
+                    int(overall),
+                    f"Disk {disk_index+1}/{len(self.progress)}: {message}"
+                )
+        return update
+
+
+class AnyEvent:
+    """Read-only event that is set as soon as any of the wrapped events is"""
+    
+    def __init__(self, *events: threading.Event):
+        self.events = [event for event in events if event is not None]
+    
+    def is_set(self) -> bool:
+        return any(event.is_set() for event in self.events)
+
+
 class MigrationService:
     """Handles VM migration from VMware to Proxmox"""
     
@@ -28,23 +77,59 @@ class MigrationService:
         # Target
         target_host: str,
         target_user: str,
-        target_password: str,
+        target_password: Optional[str],
         target_node: str,
         target_storage: str,
         # Config
         vm_config: Dict[str, Any] = None,
+        # Proxmox API token, used instead of target_password
+        target_token_name: Optional[str] = None,
+        target_token_value: Optional[str] = None,
+        # Resume and cancellation
+        checkpoint_store: CheckpointStore = None,
+        cancel_event: threading.Event = None,
+        # Validation
+        validate: bool = False,
+        # Source already snapshotted and powered off by the caller
+        source_prepared: bool = False,
+        # VMID reserved by the caller; asked from the cluster otherwise
+        target_vmid: Optional[int] = None,
+        # Bandwidth
+        throttle_factory: Callable[[str], Callable[[int], None]] = None,
         # Callbacks
+        tracker: Optional[ProgressTracker] = None,
         progress_callback: Callable[[int, str], None] = None
     ) -> Dict[str, Any]:
         """
         Migrate a single VM from VMware to Proxmox
         
+        With a checkpoint_store, a VM whose earlier attempt was interrupted is
+        resumed: the target VM and volumes are reused and every disk continues
+        from its last verified checkpoint. Warm migrations reuse them too but
+        start over with a full pass. Setting cancel_event stops running disk
+        transfers.
+        
+        With validate=True every transferred disk is verified against the
+        chunk digests taken while it streamed, or for warm migrations
+        against the cutover snapshot; the outcome is in the 'validation'
+        entry of each disk under result['disks'].
+        
+        With source_prepared the caller already powered off and snapshotted
+        the source VM, as a job's group cutover does, and both are skipped.
+        target_vmid is a VMID the caller reserved; without it the cluster's
+        next free ID is taken.
+        
+        throttle_factory(esxi_host) returns the throttle the disk streams
+        reading from that host go through. tracker, which may be shared with
+        other VMs, gets the VM's disk bytes added and advanced.
+        
         Returns dict with migration results
         """
         result = {
             'success': False,
             'vm_name': source_vm_name,
             'target_vmid': None,
+            'disks': [],
             'error': None,
             'start_time': datetime.now(),
             'end_time': None
@@ -58,76 +143,177 @@ class MigrationService:
             
             # Connect to Proxmox
             self._update_progress(progress_callback, 10, f"Connecting to Proxmox: {target_host}")
-            self.proxmox = ProxmoxConnector(target_host, target_user, target_password)
+            self.proxmox = ProxmoxConnector(
+                target_host,
+                target_user,
+                target_password,
+                token_name=target_token_name,
+                token_value=target_token_value
+            )
             self.proxmox.connect()
             
             # Get VM info
-            self._update_progress(progress_callback, 15, f"Getting VM information")
-            vm_info = None
-            for vm in self.vmware.list_vms():
-                if vm['name'] == source_vm_name:
-                    vm_info = vm
-                    break
-            
-            if not vm_info:
-                raise ValueError(f"VM not found: {source_vm_name}")
+            self._update_progress(progress_callback, 15, "Getting VM information")
+            vm_info = self.vmware.get_vm_info(source_vm_name)
             
             logger.info(f"Migrating VM: {source_vm_name} ({vm_info['disk_size_gb']} GB)")
             
-            # Create snapshot (optional)
-            self._update_progress(progress_callback, 20, "Creating snapshot")
-            snapshot_name = f"migration-backup-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-            try:
-                self.vmware.create_snapshot(source_vm_name, snapshot_name)
-            except Exception as e:
-                logger.warning(f"Snapshot creation failed: {str(e)}")
+            # Warm migrations copy while the source runs and power off at cutover
+            warm = (vm_config.get('migration_mode') if vm_config else None) == 'warm'
+            
+            # Pick up an interrupted attempt if its target VM is still there
+            checkpoints = checkpoint_store.get_vm(source_vm_name) if checkpoint_store else []
+            resuming = bool(checkpoints) and self.proxmox.vm_exists(target_node, checkpoints[0]['target_vmid'])
+            if checkpoints and not resuming:
+                checkpoints = []
+            
+            if resuming:
+                logger.info(f"Resuming migration of {source_vm_name} into VM {checkpoints[0]['target_vmid']}")
+            
+            # Only flat disks can be read directly; refuse the VM before it is powered off
+            if not warm and vm_info['disks']:
+                self._update_progress(progress_callback, 18, "Checking source disks")
+                source_disk_paths = self.vmware.get_frozen_disk_paths(source_vm_name)
             
             # Power off source VM
-            self._update_progress(progress_callback, 25, "Powering off source VM")
-            self.vmware.power_off_vm(source_vm_name)
+            if not warm and not source_prepared:
+                self._update_progress(progress_callback, 20, "Powering off source VM")
+                self.vmware.power_off_vm(source_vm_name)
+            
+            if not resuming and not warm and not source_prepared:
+                # Create snapshot (optional); taken once off, the files below it hold the whole disks
+                self._update_progress(progress_callback, 25, "Creating snapshot")
+                snapshot_name = f"{MIGRATION_SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+                try:
+                    self.vmware.create_snapshot(source_vm_name, snapshot_name, quiesce=False)
+                except Exception as e:
+                    logger.warning(f"Snapshot creation failed: {str(e)}")
             
             # Get next available VMID
-            target_vmid = self.proxmox.get_next_vmid()
+            if resuming:
+                target_vmid = checkpoints[0]['target_vmid']
+            elif target_vmid is None:
+                target_vmid = self.proxmox.get_next_vmid()
             result['target_vmid'] = target_vmid
             
             # Create VM on Proxmox
             self._update_progress(progress_callback, 30, f"Creating VM {target_vmid} on Proxmox")
             
-            # Merge VM config with defaults
-            cores = vm_config.get('cpu_cores', vm_info['cpu_cores']) if vm_config else vm_info['cpu_cores']
-            sockets = vm_config.get('cpu_sockets', 1) if vm_config else 1
-            memory = vm_config.get('memory_mb', vm_info['memory_mb']) if vm_config else vm_info['memory_mb']
-            bridge = vm_config.get('network_bridge', 'vmbr0') if vm_config else 'vmbr0'
-            
-            self.proxmox.create_vm(
-                node=target_node,
-                vmid=target_vmid,
-                name=source_vm_name,
-                cores=cores,
-                sockets=sockets,
-                memory=memory,
-                bridge=bridge,
-                ostype='l26'  # Linux
-            )
+            thin_provisioning = vm_config.get('thin_provisioning', True) if vm_config else True
+            
+            if not resuming:
+                # Hardware and every NIC in one call; the disks follow once copied
+                create_task = self.proxmox.create_vm(
+                    node=target_node,
+                    vmid=target_vmid,
+                    name=source_vm_name,
+                    **create_spec(vm_info, vm_config)
+                )
+                # Disks can only be allocated once the VM exists
+                self.proxmox.wait_for_task(create_task)
+                if checkpoint_store:
+                    checkpoint_store.start_vm(source_vm_name, target_vmid, len(vm_info['disks']))
             
             # Migrate disks
             self._update_progress(progress_callback, 35, "Starting disk migration")
             
-            for disk_idx, disk_info in enumerate(vm_info['disks']):
-                disk_name = f"disk-{disk_idx}"
-                self._migrate_disk(
+            disks = vm_info['disks']
+            disk_parallelism = vm_config.get('disk_parallelism') if vm_config else None
+            disk_parallelism = max(1, min(
+                disk_parallelism or settings.MAX_PARALLEL_DISKS_PER_VM,
+                len(disks) or 1
+            ))
+            
+            source_esxi_host = self.vmware.get_vm_host_name(source_vm_name) if disks else None
+            throttle = throttle_factory(source_esxi_host) if throttle_factory and disks else None
+            
+            if warm:
+                result['warm'] = self._migrate_disks_warm(
+                    source_host=source_host,
+                    source_user=source_user,
+                    source_password=source_password,
                     source_vm_name=source_vm_name,
-                    disk_index=disk_idx,
                     target_node=target_node,
                     target_vmid=target_vmid,
                     target_storage=target_storage,
-                    disk_name=disk_name,
-                    progress_callback=lambda p, m: self._update_progress(
-                        progress_callback, 
-                        35 + int(p * 0.5), 
-                        f"Disk {disk_idx+1}/{len(vm_info['disks'])}: {m}"
-                    )
+                    checkpoints=checkpoints,
+                    checkpoint_store=checkpoint_store,
+                    disk_parallelism=disk_parallelism,
+                    validate=validate,
+                    cancel_event=cancel_event,
+                    throttle=throttle,
+                    tracker=tracker,
+                    progress_callback=lambda p, m: self._update_progress(progress_callback, 35 + int(p * 0.5), m)
                 )
+                result['disks'] = result['warm']['disks']
+            elif disks:
+                aggregator = DiskProgressAggregator(
+                    disks,
+                    lambda p, m: self._update_progress(progress_callback, 35 + int(p * 0.5), m)
+                )
+                disks_cancelled = threading.Event()
+                checkpoints_by_disk = {cp['disk_index']: cp for cp in checkpoints}
+                
+                if tracker is not None:
+                    for disk_idx, disk in enumerate(disks):
+                        disk_bytes = int((disk.get('size_gb') or 0) * 1024**3)
+                        tracker.add_total(disk_bytes)
+                        if checkpoints_by_disk.get(disk_idx, {}).get('completed'):
+                            tracker.advance(disk_bytes)
+                
+                with ThreadPoolExecutor(
+                    max_workers=disk_parallelism,
+                    thread_name_prefix=f"disk-{source_vm_name}"
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            self._migrate_disk,
+                            source_esxi_host=source_esxi_host,
+                            source_disk_path=source_disk_paths[disk_idx],
+                            disk_index=disk_idx,
+                            target_node=target_node,
+                            target_vmid=target_vmid,
+                            target_storage=target_storage,
+                            disk_name=f"disk-{disk_idx}",
+                            sparse=thin_provisioning,
+                            source_vm_name=source_vm_name,
+                            checkpoint=checkpoints_by_disk.get(disk_idx),
+                            checkpoint_store=checkpoint_store,
+                            cancel_event=AnyEvent(disks_cancelled, cancel_event),
+                            validate=validate,
+                            throttle=throttle,
+                            tracker=tracker,
+                            progress_callback=aggregator.for_disk(disk_idx)
+                        )
+                        for disk_idx in range(len(disks))
+                        if not checkpoints_by_disk.get(disk_idx, {}).get('completed')
+                    ]
+                    
+                    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                    failed = [f for f in done if f.exception()]
+                    if failed:
+                        # Stop the remaining disks instead of finishing a doomed VM
+                        disks_cancelled.set()
+                        for future in futures:
+                            future.cancel()
+                        raise failed[0].exception()
+                
+                transferred = {f.result()['disk_index']: f.result() for f in futures}
+                result['disks'] = [
+                    transferred.get(disk_idx, {'disk_index': disk_idx, 'transferred_earlier': True})
+                    for disk_idx in range(len(disks))
+                ]
+                
+                # All disks in one config update, including those of an earlier attempt
+                self._update_progress(progress_callback, 87, "Attaching disks to VM")
+                volumes = {
+                    disk_idx: (transferred.get(disk_idx) or checkpoints_by_disk[disk_idx])['target_volid']
+                    for disk_idx in range(len(disks))
+                }
+                self.proxmox.update_vm_config(target_node, target_vmid, **disks_spec(volumes))
+                if checkpoint_store:
+                    for disk_idx in transferred:
+                        checkpoint_store.complete_disk(source_vm_name, disk_idx)
             
             self._update_progress(progress_callback, 90, "Migration complete")
             
@@ -144,109 +330,194 @@ class MigrationService:
         finally:
             if self.vmware:
                 self.vmware.disconnect()
+            if self.proxmox:
+                self.proxmox.disconnect()
             
         return result
     
     def _migrate_disk(
         self,
-        source_vm_name: str,
+        source_esxi_host: str,
+        source_disk_path: str,
         disk_index: int,
         target_node: str,
         target_vmid: int,
         target_storage: str,
         disk_name: str,
+        sparse: bool = True,
+        source_vm_name: str = None,
+        checkpoint: Dict[str, Any] = None,
+        checkpoint_store: CheckpointStore = None,
+        cancel_event: threading.Event = None,
+        validate: bool = False,
+        throttle: Callable[[int], None] = None,
+        tracker: Optional[ProgressTracker] = None,
         progress_callback: Callable[[int, str], None] = None
     ):
-        """Migrate a single disk"""
-        
-        # Get source disk path
-        source_disk_path = self.vmware.get_disk_path(source_vm_name, disk_index)
-        logger.info(f"Source disk: {source_disk_path}")
-        
-        # Target disk path
-        target_disk_path = self.proxmox.get_disk_path(
-            target_node, 
-            target_storage, 
-            target_vmid, 
-            disk_name
-        )
-        
-        self._update_progress(progress_callback, 10, "Converting disk format")
+        """
+        Migrate a single disk
         
-        # Convert disk using qemu-img
-        # This is a simplified version - in production, you'd use SSH/NBD streaming
-        interface = f"scsi{disk_index}"
+        With sparse=True unallocated and all-zero ranges are skipped and the
+        target stays thin; otherwise every block is written out. A checkpoint
+        from an interrupted attempt reuses its volume and resumes the transfer.
+        With validate=True the target is verified against the stream's chunk
+        digests. The caller attaches the volume, 'target_volid' of the result,
+        together with the VM's other disks.
+        """
         
-        # For now, we'll use a placeholder - actual implementation would:
-        # 1. SSH to VMware host
-        # 2. Stream disk via NBD or direct copy
-        # 3. Convert on-the-fly with qemu-img
-        # 4. Write to Proxmox storage
+        logger.info(f"Source disk: {source_disk_path} on {source_esxi_host}")
         
-        # Simulated conversion (replace with actual implementation)
-        logger.info(f"Converting: {source_disk_path} -> {target_disk_path}")
+        # Stream the flat extent straight into a raw volume on the target storage
+        reader = create_reader(source_esxi_host, datastore_path_to_flat(source_disk_path))
+        with reader, storage_target(self.proxmox, target_node, target_storage) as target:
+            if checkpoint and checkpoint['target_volid']:
+                target_volid = checkpoint['target_volid']
+            else:
+                self._update_progress(progress_callback, 5, "Allocating target disk")
+                target_volid = target.allocate(target_vmid, disk_name, reader.size())
+                checkpoint = None
+                if checkpoint_store:
+                    checkpoint_store.set_volume(source_vm_name, disk_index, target_volid, reader.size())
+            
+            logger.info(f"Transferring: {source_disk_path} -> {target_volid} ({type(target).__name__})")
+            self._update_progress(progress_callback, 10, "Writing disk to target storage")
+            
+            # Volumes allocated by this attempt read as zero on most storages, so holes
+            # need not be sent; a resumed volume holds whatever the last attempt wrote
+            with target.writer(target_volid, zeroed=checkpoint is None) as writer:
+                transfer = DiskTransfer(
+                    reader,
+                    writer,
+                    sparse=sparse,
+                    cancel_event=cancel_event,
+                    throttle=throttle,
+                    tracker=tracker,
+                    **target.transfer_options()
+                )
+                transfer_stats = transfer.run(
+                    progress_callback=lambda p, m: self._update_progress(
+                        progress_callback,
+                        10 + int(p * (0.7 if validate else 0.8)),
+                        f"Transferring disk: {m}"
+                    ),
+                    checkpoint=checkpoint,
+                    checkpoint_callback=(
+                        (lambda offset, last_chunk: checkpoint_store.save(
+                            source_vm_name, disk_index, offset, last_chunk
+                        ))
+                        if checkpoint_store else None
+                    )
+                )
+                
+                if validate:
+                    self._update_progress(progress_callback, 80, "Verifying target disk")
+                    transfer_stats['validation'] = verify_target(
+                        reader,
+                        writer,
+                        transfer_stats['size_bytes'],
+                        transfer_stats['chunk_size'],
+                        transfer.chunk_digests
+                    )
         
-        # Attach disk to VM
-        self._update_progress(progress_callback, 90, "Attaching disk to VM")
-        self.proxmox.attach_disk(target_node, target_vmid, target_disk_path, interface)
+        transfer_stats['disk_index'] = disk_index
+        transfer_stats['target_volid'] = target_volid
         
         self._update_progress(progress_callback, 100, "Disk migration complete")
+        
+        return transfer_stats
+    
+    def _migrate_disks_warm(
+        self,
+        source_host: str,
+        source_user: str,
+        source_password: str,
+        source_vm_name: str,
+        target_node: str,
+        target_vmid: int,
+        target_storage: str,
+        checkpoints: List[Dict[str, Any]] = None,
+        checkpoint_store: CheckpointStore = None,
+        disk_parallelism: int = 1,
+        validate: bool = False,
+        cancel_event: threading.Event = None,
+        throttle: Callable[[int], None] = None,
+        tracker: Optional[ProgressTracker] = None,
+        progress_callback: Callable[[int, str], None] = None
+    ) -> Dict[str, Any]:
+        """
+        Migrate all disks of a running VM with CBT passes, then cut over
+        
+        Snapshots are read through VDDK, so this needs nbdkit's vddk plugin
+        and VDDK_LIBDIR on the worker. With validate=True the targets are
+        verified against the cutover snapshot. The per-disk results under
+        'disks' carry the 'target_volid' of each disk.
+        
+        Volumes are recorded in checkpoint_store as they are allocated, and
+        those in checkpoints of an earlier attempt are overwritten instead of
+        allocating new ones.
+        """
+        vm_moref = self.vmware.get_vm_moref(source_vm_name)
+        thumbprint = self.vmware.get_thumbprint()
+        target = storage_target(self.proxmox, target_node, target_storage)
+        
+        volumes = {cp['disk_index']: cp['target_volid'] for cp in checkpoints or [] if cp['target_volid']}
+        reused_disks = set(volumes)
+        volumes_lock = threading.Lock()
+        
+        def reader_factory(disk_index: int, disk: Dict[str, Any], snapshot_moref: str):
+            return VDDKReader(
+                server=source_host,
+                user=source_user,
+                password=source_password,
+                thumbprint=thumbprint,
+                vm_moref=vm_moref,
+                file_name=disk['file_name'],
+                snapshot_moref=snapshot_moref
+            )
+        
+        def writer_factory(disk_index: int, disk: Dict[str, Any], zeroed: bool):
+            # Volumes are allocated on the first pass and reused by the deltas
+            with volumes_lock:
+                if disk_index not in volumes:
+                    volumes[disk_index] = target.allocate(target_vmid, f"disk-{disk_index}", disk['capacity_bytes'])
+                    if checkpoint_store:
+                        checkpoint_store.set_volume(
+                            source_vm_name, disk_index, volumes[disk_index], disk['capacity_bytes']
+                        )
+            return target.writer(volumes[disk_index], zeroed=zeroed)
+        
+        with target:
+            warm_result = WarmMigration(
+                self.vmware,
+                source_vm_name,
+                reader_factory,
+                writer_factory,
+                disk_parallelism=disk_parallelism,
+                validate=validate,
+                reused_disks=reused_disks,
+                transfer_options=target.transfer_options(),
+                cancel_event=cancel_event,
+                throttle=throttle,
+                tracker=tracker,
+                progress_callback=progress_callback
+            ).run()
+        
+        for disk in warm_result['disks']:
+            disk['target_volid'] = volumes[disk['disk_index']]
+        
+        self.proxmox.update_vm_config(target_node, target_vmid, **disks_spec(volumes))
+        if checkpoint_store:
+            for disk_index in volumes:
+                checkpoint_store.complete_disk(source_vm_name, disk_index)
+        
+        logger.info(
+            f"Warm migration of {source_vm_name} finished after {warm_result['passes']} passes, "
+            f"{warm_result['cutover_bytes']} bytes copied during cutover"
+        )
+        return warm_result
     
     def _update_progress(self, callback: Callable, percentage: int, message: str):
         """Update progress via callback"""
         if callback:
             callback(percentage, message)
         logger.info(f"Progress {percentage}%: {message}")
-
-
-def convert_disk_streaming(
-    source_host: str,
-    source_path: str,
-    target_path: str,
-    progress_callback: Callable[[int], None] = None
-) -> bool:
-    """
-    Convert disk from VMDK to qcow2 with streaming
-    
-    This uses qemu-img with SSH or NBD to stream the conversion
-    """
-    try:
-        # Example using SSH (requires passwordless SSH or sshpass)
-        cmd = [
-            'qemu-img', 'convert',
-            '-f', 'vmdk',
-            '-O', 'qcow2',
-            '-p',  # Progress
-            f'ssh://root@{source_host}{source_path}',
-            target_path
-        ]
-        
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-        
-        # Monitor progress
-        for line in process.stderr:
-            if '%' in line:
-                try:
-                    pct = int(line.split('(')[1].split('%')[0])
-                    if progress_callback:
-                        progress_callback(pct)
-                except:
-                    pass
-        
-        process.wait()
-        
-        if process.returncode == 0:
-            logger.info("Disk conversion successful")
-            return True
-        else:
-            logger.error(f"Disk conversion failed: {process.stderr}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Disk conversion error: {str(e)}")
-        raise
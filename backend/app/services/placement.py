@@ -0,0 +1,151 @@
+"""Capacity-aware placement of migrated VMs on a Proxmox cluster
+
+Jobs may name "auto" as target node, target storage or both. The placement
+engine reads the cluster's nodes and storages from one /cluster/resources
+call and assigns each VM a node and a storage:
+
+- the storage must hold VM images and have room for the VM's disks plus
+  PLACEMENT_DISK_HEADROOM;
+- among those, the engine prefers the most free disk and free memory left
+  after the VM is placed, and the fewest migrations already writing to the
+  node.
+
+VMs are placed largest first. Every placement reserves its disk and memory,
+so a batch spreads over the cluster instead of piling onto the node that
+looked emptiest before it started.
+"""
+import threading
+import time
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.config import settings
+from app.connectors.proxmox_connector import ProxmoxConnector
+
+logger = logging.getLogger(__name__)
+
+
+AUTO = "auto"
+
+
+class PlacementError(Exception):
+    """No node or storage can take a VM"""
+
+
+class PlacementEngine:
+    """Assigns VMs to nodes and storages by free capacity and load"""
+    
+    # Weights of the score terms; free capacity fractions and the I/O load are all 0..1
+    WEIGHT_DISK = 1.0
+    WEIGHT_MEMORY = 1.0
+    WEIGHT_IO = 1.0
+    
+    def __init__(self):
+        self._cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self.lock = threading.Lock()
+    
+    def resources(self, proxmox: ProxmoxConnector) -> List[Dict[str, Any]]:
+        """The cluster's /cluster/resources, reused for PLACEMENT_CACHE_SECONDS"""
+        with self.lock:
+            cached = self._cache.get(proxmox.host)
+            if cached and time.monotonic() - cached[0] < settings.PLACEMENT_CACHE_SECONDS:
+                return cached[1]
+        resources = proxmox.get_cluster_resources()
+        with self.lock:
+            self._cache[proxmox.host] = (time.monotonic(), resources)
+        return resources
+    
+    def place(
+        self,
+        proxmox: ProxmoxConnector,
+        vms: List[Dict[str, Any]],
+        node: str = AUTO,
+        storage: str = AUTO,
+        in_flight: Optional[Dict[str, float]] = None
+    ) -> Dict[str, Dict[str, str]]:
+        """
+        Assign every VM a node and a storage
+        
+        vms are dicts with 'name', 'memory_mb' and 'disk_bytes'. node and
+        storage are either fixed or AUTO. in_flight counts the migrations
+        other jobs are writing to each node. Returns {vm_name: {'node',
+        'storage'}}; raises PlacementError when a VM fits nowhere.
+        """
+        resources = self.resources(proxmox)
+        nodes = {
+            r['node']: r for r in resources
+            if r.get('type') == 'node' and r.get('status') == 'online'
+            and (node == AUTO or r['node'] == node)
+        }
+        storages = [
+            r for r in resources
+            if r.get('type') == 'storage' and r.get('node') in nodes
+            and r.get('status') == 'available'
+            and 'images' in (r.get('content') or '').split(',')
+            and (storage == AUTO or r['storage'] == storage)
+        ]
+        if not nodes or not storages:
+            raise PlacementError(f"No online node with a usable storage for node={node}, storage={storage}")
+        
+        # Running totals, so each placement sees the ones before it
+        free_memory = {name: r.get('maxmem', 0) - r.get('mem', 0) for name, r in nodes.items()}
+        free_disk = {}
+        for r in storages:
+            # Shared storage shows up once per node but has one pool of space
+            free_disk[self._storage_key(r)] = r.get('maxdisk', 0) - r.get('disk', 0)
+        load = {name: (in_flight or {}).get(name, 0.0) for name in nodes}
+        
+        placements = {}
+        for vm in sorted(vms, key=lambda vm: vm['disk_bytes'], reverse=True):
+            need_disk = vm['disk_bytes'] * (1 + settings.PLACEMENT_DISK_HEADROOM)
+            need_memory = vm['memory_mb'] * 1024**2
+            busiest = max(load.values()) + 1
+            
+            best = None
+            for r in storages:
+                key = self._storage_key(r)
+                if free_disk[key] < need_disk:
+                    continue
+                node_name = r['node']
+                memory_left = free_memory[node_name] - need_memory
+                maxmem = nodes[node_name].get('maxmem') or 1
+                score = (
+                    self.WEIGHT_DISK * (free_disk[key] - need_disk) / (r.get('maxdisk') or 1)
+                    + self.WEIGHT_MEMORY * memory_left / maxmem
+                    - self.WEIGHT_IO * load[node_name] / busiest
+                )
+                # Running out of memory is tolerated (the VM is created stopped), but ranked last
+                fits = memory_left >= 0
+                if best is None or (fits, score) > best[0]:
+                    best = ((fits, score), r)
+            
+            if best is None:
+                raise PlacementError(
+                    f"No storage has {need_disk / 1024**3:.1f} GiB free for VM {vm['name']}"
+                )
+            (fits, _), chosen = best
+            if not fits:
+                logger.warning(f"No node has {vm['memory_mb']} MB free for VM {vm['name']}, placing it anyway")
+            
+            free_disk[self._storage_key(chosen)] -= need_disk
+            free_memory[chosen['node']] -= need_memory
+            load[chosen['node']] += 1
+            placements[vm['name']] = {'node': chosen['node'], 'storage': chosen['storage']}
+            logger.info(f"Placed VM {vm['name']} on {chosen['node']}/{chosen['storage']}")
+        
+        return placements
+    
+    def invalidate(self, host: str):
+        """Forget a cluster's cached usage"""
+        with self.lock:
+            self._cache.pop(host, None)
+    
+    @staticmethod
+    def _storage_key(resource: Dict[str, Any]) -> str:
+        if resource.get('shared'):
+            return resource['storage']
+        return f"{resource['node']}/{resource['storage']}"
+
+
+# Shared by all jobs of this worker process
+engine = PlacementEngine()
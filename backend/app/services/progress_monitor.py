@@ -0,0 +1,61 @@
+"""Progress, rate and ETA accounting for disk transfers"""
+import threading
+import time
+from typing import Dict, Any
+
+
+class ProgressTracker:
+    """
+    Bytes done out of a total, with a smoothed rate and an ETA
+
+    Safe to share between the disk threads of a VM and the VM threads of a
+    job. The rate is an exponentially weighted moving average, sampled at
+    most once a second, so a burst of small updates does not skew it.
+    """
+
+    # Weight of the newest sample in the moving average
+    SMOOTHING = 0.2
+
+    def __init__(self):
+        self.total_bytes = 0
+        self.bytes_done = 0
+        self.rate_bps = 0.0
+        self.lock = threading.Lock()
+        self._sample_time = time.monotonic()
+        self._sample_bytes = 0
+
+    def add_total(self, nbytes: int):
+        """Add work to the total"""
+        with self.lock:
+            self.total_bytes += nbytes
+
+    def advance(self, nbytes: int):
+        """Account for bytes done"""
+        with self.lock:
+            self.bytes_done += nbytes
+            self._sample()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current bytes, rate in bytes per second and ETA in seconds (None if unknown)"""
+        with self.lock:
+            self._sample()
+            remaining = max(self.total_bytes - self.bytes_done, 0)
+            return {
+                'bytes_done': self.bytes_done,
+                'total_bytes': self.total_bytes,
+                'rate_bps': self.rate_bps,
+                'eta_seconds': int(remaining / self.rate_bps) if self.rate_bps > 0 else None
+            }
+
+    def _sample(self):
+        now = time.monotonic()
+        elapsed = now - self._sample_time
+        if elapsed < 1.0:
+            return
+        rate = (self.bytes_done - self._sample_bytes) / elapsed
+        self.rate_bps = rate if self.rate_bps == 0 else (
+            self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.rate_bps
+        )
+        self._sample_time = now
+        self._sample_bytes = self.bytes_done
+
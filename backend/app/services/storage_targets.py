@@ -0,0 +1,304 @@
+"""Target writers for the storage types of Proxmox
+
+Migrated disks are written as raw volumes, straight into where the storage
+keeps them: a sparse file on file storages, the block device of an LVM
+volume, ZFS zvol or RBD image otherwise. There is no intermediate image to
+import, so every byte is written to the target once.
+
+A StorageTarget knows how volumes of its storage types are allocated, made
+available on the node and let go of again, laid out as disk_layout picks
+for the storage type; the bytes go through the
+transport writer create_writer builds for the volume's path. Device
+handling runs as shell commands on the node over SSH, or locally with
+TRANSFER_WRITER=local, so a target can be pointed at a plain file or a loop
+device standing in for the volume.
+"""
+import shlex
+import subprocess
+import threading
+import logging
+from typing import Dict, Any, List, Optional
+
+from app.config import settings
+from app.connectors.proxmox_connector import ProxmoxConnector
+from app.services.disk_formats import disk_layout
+from app.services.disk_transfer import DiskWriter, _SSHMixin, create_writer
+
+logger = logging.getLogger(__name__)
+
+
+class _NodeShell(_SSHMixin):
+    """Runs commands on a Proxmox node over SSH"""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.user = settings.TARGET_SSH_USER
+        self.password = settings.TARGET_SSH_PASSWORD
+        self.key_file = settings.TARGET_SSH_KEY_FILE
+        self.port = 22
+        self.client = None
+
+    def run(self, command: str) -> str:
+        if self.client is None:
+            self._connect(open_sftp=False)
+        _, stdout, stderr = self.client.exec_command(command)
+        output = stdout.read().decode(errors='replace')
+        if stdout.channel.recv_exit_status() != 0:
+            raise IOError(f"{command} failed on {self.host}: {stderr.read().decode(errors='replace').strip()}")
+        return output
+
+    def close(self):
+        self._disconnect()
+
+
+class StorageTarget:
+    """Volumes of one Proxmox storage, written in place"""
+
+    # Storage types, as list_storage reports them, this target handles
+    types: tuple = ()
+
+    # Freshly allocated volumes read as zero, so zero ranges can be skipped
+    zeroed = True
+
+    # Longest wait for a volume's device node to show up
+    DEVICE_TIMEOUT_SECONDS = 30
+
+    def __init__(
+        self,
+        proxmox: ProxmoxConnector,
+        node: str,
+        storage: str,
+        config: Dict[str, Any],
+        storage_type: Optional[str] = None
+    ):
+        self.proxmox = proxmox
+        self.node = node
+        self.storage = storage
+        self.config = config
+        self.storage_type = storage_type or config.get('type') or self.types[0]
+        self.layout = disk_layout(self.storage_type)
+        self.node_host = proxmox.get_node_address(node)
+        self.shell = None
+        self.lock = threading.Lock()
+
+    def allocate(self, vmid: int, disk_name: str, size_bytes: int) -> str:
+        """Allocate a raw volume for a disk, returns its volume ID"""
+        return self.proxmox.allocate_disk(
+            self.node, self.storage, vmid, disk_name, size_bytes, fmt='raw', storage_type=self.storage_type
+        )
+
+    def transfer_options(self) -> Dict[str, Any]:
+        """DiskTransfer arguments the layout sets for volumes of this storage"""
+        return {'queue_depth': self.layout['queue_depth']}
+    
+    def writer(self, volid: str, zeroed: bool = False) -> DiskWriter:
+        """Writer for a volume; zeroed=True when it was just allocated"""
+        return VolumeWriter(self, volid, zeroed and self.zeroed)
+
+    def activate(self, volid: str) -> str:
+        """Make a volume writable on the node, returns its path there"""
+        return self.proxmox.get_volume_path(self.node, self.storage, volid)
+
+    def deactivate(self, volid: str, path: str):
+        """Let go of whatever activate() set up"""
+        pass
+
+    def run(self, command: str) -> str:
+        """Run a shell command on the node, returns its output"""
+        if settings.TRANSFER_WRITER == 'local':
+            process = subprocess.run(command, shell=True, capture_output=True, text=True)
+            if process.returncode != 0:
+                raise IOError(f"{command} failed: {process.stderr.strip()}")
+            return process.stdout
+        with self.lock:
+            if self.shell is None:
+                self.shell = _NodeShell(self.node_host)
+        return self.shell.run(command)
+
+    def wait_for_device(self, path: str):
+        """Wait until udev created a device node"""
+        tries = self.DEVICE_TIMEOUT_SECONDS * 5
+        self.run(
+            f"udevadm settle --timeout={self.DEVICE_TIMEOUT_SECONDS} 2>/dev/null; "
+            f"for i in $(seq {tries}); do [ -e {shlex.quote(path)} ] && exit 0; sleep 0.2; done; "
+            f"echo {shlex.quote(path)} did not appear >&2; exit 1"
+        )
+
+    @staticmethod
+    def volume_name(volid: str) -> str:
+        """The volume part of storage:volume"""
+        return volid.split(':', 1)[1]
+
+    def close(self):
+        """Close the connection to the node"""
+        with self.lock:
+            if self.shell is not None:
+                self.shell.close()
+                self.shell = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FileTarget(StorageTarget):
+    """Raw image files on a mounted storage; new ones are sparse and read as zero"""
+
+    types = ('dir', 'nfs', 'cifs', 'cephfs', 'btrfs')
+    
+    def allocate(self, vmid: int, disk_name: str, size_bytes: int) -> str:
+        volid = super().allocate(vmid, disk_name, size_bytes)
+        if self.layout['preallocation'] == 'falloc':
+            path = self.activate(volid)
+            try:
+                # Reserved blocks read as zero, so the volume still counts as zeroed
+                self.run(f"fallocate -l {size_bytes} {shlex.quote(path)}")
+            except IOError as e:
+                logger.warning(f"Could not preallocate {volid}, leaving it sparse: {str(e)}")
+        return volid
+
+
+class LvmThinTarget(StorageTarget):
+    """Thin LVs; unprovisioned blocks read as zero"""
+
+    types = ('lvmthin',)
+
+    def activate(self, volid: str) -> str:
+        path = super().activate(volid)
+        lv = f"{self.config['vgname']}/{self.volume_name(volid)}"
+        self.run(f"[ -e {shlex.quote(path)} ] || lvchange -ay {shlex.quote(lv)}")
+        self.wait_for_device(path)
+        return path
+
+
+class LvmTarget(LvmThinTarget):
+    """Thick LVs; they hold whatever the extents held before, so zeroes are written out"""
+
+    types = ('lvm',)
+    zeroed = False
+
+
+class ZfsTarget(StorageTarget):
+    """ZFS zvols; new ones read as zero"""
+
+    types = ('zfspool',)
+
+    def activate(self, volid: str) -> str:
+        path = super().activate(volid)
+        # zvol device nodes appear asynchronously after creation
+        self.wait_for_device(path)
+        return path
+
+
+class RbdTarget(StorageTarget):
+    """
+    Ceph RBD images, mapped through the kernel client while written
+
+    The API reports a librbd path for storages without krbd, which is no
+    device; images are mapped here either way and unmapped once written,
+    unless they were mapped already.
+    """
+
+    types = ('rbd',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mapped = set()
+
+    def activate(self, volid: str) -> str:
+        spec = '/'.join(filter(None, [
+            self.config.get('pool', 'rbd'),
+            self.config.get('namespace'),
+            self.volume_name(volid)
+        ]))
+        path = f'/dev/rbd/{spec}'
+
+        options = [f"--id {shlex.quote(self.config.get('username') or 'admin')}"]
+        if self.config.get('monhost'):
+            # External cluster; Proxmox keeps its keyring per storage
+            options.append(f"-m {shlex.quote(self.config['monhost'].replace(';', ','))}")
+            options.append(f"--keyring /etc/pve/priv/ceph/{shlex.quote(self.storage)}.keyring")
+        device = self.run(
+            f"[ -e {shlex.quote(path)} ] || rbd map {shlex.quote(spec)} {' '.join(options)}"
+        ).strip()
+        if device:
+            with self.lock:
+                self.mapped.add(path)
+            logger.info(f"Mapped {volid} as {device}")
+        self.wait_for_device(path)
+        return path
+
+    def deactivate(self, volid: str, path: str):
+        with self.lock:
+            if path not in self.mapped:
+                return
+            self.mapped.discard(path)
+        try:
+            self.run(f"rbd unmap {shlex.quote(path)}")
+        except Exception as e:
+            logger.warning(f"Failed to unmap {volid}: {str(e)}")
+
+
+class VolumeWriter(DiskWriter):
+    """Writes a volume of a StorageTarget through the configured transport"""
+
+    def __init__(self, target: StorageTarget, volid: str, zeroed: bool):
+        self.target = target
+        self.volid = volid
+        self._zeroed = zeroed
+        self.path = None
+        self.inner: Optional[DiskWriter] = None
+
+    def open(self, size: int):
+        self.path = self.target.activate(self.volid)
+        self.inner = create_writer(self.target.node_host, self.path, zeroed=self._zeroed)
+        self.inner.open(size)
+        self.zeroed = self.inner.zeroed
+
+    def write(self, offset: int, data: bytes):
+        self.inner.write(offset, data)
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self.inner.read(offset, length)
+
+    def write_zeroes(self, offset: int, length: int):
+        self.inner.write_zeroes(offset, length)
+
+    def chunk_digests(self, size: int, chunk_size: int) -> List[str]:
+        return self.inner.chunk_digests(size, chunk_size)
+
+    def flush(self):
+        self.inner.flush()
+
+    def abort(self):
+        if self.inner is not None:
+            self.inner.abort()
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+            self.inner = None
+        if self.path is not None:
+            self.target.deactivate(self.volid, self.path)
+            self.path = None
+
+
+# Storage type -> target; add a StorageTarget subclass here to support more
+TARGETS_BY_TYPE = {
+    storage_type: target
+    for target in (FileTarget, LvmThinTarget, LvmTarget, ZfsTarget, RbdTarget)
+    for storage_type in target.types
+}
+
+
+def storage_target(proxmox: ProxmoxConnector, node: str, storage: str) -> StorageTarget:
+    """The target for a storage, chosen by the type list_storage reports for it"""
+    entry = next((entry for entry in proxmox.list_storage(node) if entry.get('storage') == storage), None)
+    if entry is None:
+        raise ValueError(f"Storage {storage} is not available on node {node}")
+    target = TARGETS_BY_TYPE.get(entry.get('type'))
+    if target is None:
+        raise ValueError(f"Cannot write disks to storage {storage} of type {entry.get('type')}")
+    return target(proxmox, node, storage, proxmox.get_storage_config(storage), entry.get('type'))
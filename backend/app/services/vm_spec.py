@@ -0,0 +1,41 @@
+"""Proxmox configuration of a migrated VM
+
+Everything known before the disks are copied, CPU, memory and every NIC of
+the source, goes into the single qemu.create call. The disks only exist
+once copied; they follow together with the boot order in one config PUT.
+Each call takes the VM's config lock on the cluster once, however many
+disks and NICs the VM has.
+"""
+from typing import Dict, Any, Optional
+
+
+def create_spec(vm_info: Dict[str, Any], vm_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    qemu.create options for a VM, from get_vm_info and the job's overrides
+
+    Every source NIC becomes a netN on the job's bridge, keeping its MAC
+    address so DHCP reservations and guest interface names carry over.
+    """
+    vm_config = vm_config or {}
+    spec = {
+        'cores': vm_config.get('cpu_cores') or vm_info['cpu_cores'],
+        'sockets': vm_config.get('cpu_sockets') or 1,
+        'memory': vm_config.get('memory_mb') or vm_info['memory_mb'],
+        'ostype': 'l26'  # Linux
+    }
+
+    model = vm_config.get('network_type') or 'virtio'
+    bridge = vm_config.get('network_bridge') or 'vmbr0'
+    for index, network in enumerate(vm_info.get('networks') or []):
+        nic = f"{model}={network['mac']}" if network.get('mac') else model
+        spec[f'net{index}'] = f"{nic},bridge={bridge},firewall=1"
+    return spec
+
+
+def disks_spec(volumes: Dict[int, str]) -> Dict[str, Any]:
+    """Config options attaching volumes by disk index, booting from the first"""
+    spec = {f'scsi{disk_index}': volid for disk_index, volid in sorted(volumes.items())}
+    if spec:
+        # A VM created without disks would otherwise boot from the network
+        spec['boot'] = 'order=' + ';'.join(spec)
+    return spec
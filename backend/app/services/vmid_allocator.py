@@ -0,0 +1,215 @@
+"""VMIDs for new Proxmox VMs, reserved in blocks
+
+cluster/nextid only names the lowest free ID; it reserves nothing, so
+migrations asking at the same time get the same ID and all but one
+create_vm fails. The allocator instead lists the IDs in use once and
+leases a whole block of free ones in Redis, so the workers of every job
+share one view of which IDs are taken. A lease lasts until the VM exists
+on the cluster and the job releases it, or until it expires.
+"""
+import threading
+import logging
+from typing import Dict, List, Optional, Set
+
+from app.config import settings
+from app.connectors.proxmox_connector import ProxmoxConnector
+
+logger = logging.getLogger(__name__)
+
+
+# Leases IDs from the candidates until enough are held; returns those leased
+_REDIS_LEASE = """
+local wanted = tonumber(ARGV[1])
+local owner = ARGV[2]
+local ttl = tonumber(ARGV[3])
+local leased = {}
+for i = 4, #ARGV do
+    if #leased >= wanted then
+        break
+    end
+    if redis.call('SET', KEYS[1] .. ARGV[i], owner, 'NX', 'EX', ttl) then
+        leased[#leased + 1] = ARGV[i]
+    end
+end
+if #leased > 0 then
+    redis.call('SADD', KEYS[2], unpack(leased))
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+return leased
+"""
+
+# Drops the IDs' leases if the job still holds them
+_REDIS_RELEASE = """
+local released = 0
+for i = 2, #ARGV do
+    if redis.call('GET', KEYS[1] .. ARGV[i]) == ARGV[1] then
+        redis.call('DEL', KEYS[1] .. ARGV[i])
+        released = released + 1
+    end
+    redis.call('SREM', KEYS[2], ARGV[i])
+end
+return released
+"""
+
+
+class VMIDAllocator:
+    """
+    Leases of VMIDs on the Proxmox clusters migrations write to
+
+    Leases are kept in Redis under REDIS_URL. When Redis is unavailable they
+    fall back to this process, which still keeps its own jobs apart.
+    """
+
+    # Candidates offered to Redis per round, per ID still wanted
+    CANDIDATES_PER_ID = 4
+
+    def __init__(self):
+        self._redis = None
+        self._lease = None
+        self._release = None
+        # host -> {vmid: job_id}, used without Redis
+        self.local: Dict[str, Dict[int, int]] = {}
+        self.lock = threading.Lock()
+
+    def reserve(
+        self,
+        proxmox: ProxmoxConnector,
+        job_id: int,
+        count: int,
+        first: Optional[int] = None,
+        last: Optional[int] = None
+    ) -> List[int]:
+        """
+        Lease count free VMIDs between first and last for a job, lowest first
+
+        IDs the job already holds and that are still unused are handed out
+        again, so a retried job gets its block back. Raises ValueError when
+        the range has too few free IDs.
+        """
+        first = first or settings.PROXMOX_VMID_MIN
+        last = last or settings.PROXMOX_VMID_MAX
+        if count <= 0:
+            return []
+
+        used = {
+            int(resource['vmid']) for resource in proxmox.get_cluster_resources()
+            if resource.get('vmid') is not None
+        }
+        try:
+            vmids = self._reserve_redis(proxmox.host, job_id, count, first, last, used)
+        except Exception as e:
+            logger.warning(f"VMID leases unavailable in Redis, leasing in this process only: {str(e)}")
+            vmids = self._reserve_local(proxmox.host, job_id, count, first, last, used)
+
+        if len(vmids) < count:
+            self.release(proxmox.host, job_id, vmids)
+            raise ValueError(f"Only {len(vmids)} of {count} VMIDs free between {first} and {last}")
+        logger.info(f"Leased VMIDs {vmids} on {proxmox.host} for job {job_id}")
+        return vmids
+
+    def release(self, host: str, job_id: int, vmids: List[int]):
+        """Give back IDs the job holds, e.g. for a migration that failed"""
+        if not vmids:
+            return
+        with self.lock:
+            leases = self.local.get(host, {})
+            for vmid in vmids:
+                if leases.get(vmid) == job_id:
+                    del leases[vmid]
+        try:
+            self._client()
+            self._release(
+                keys=[self._prefix(host), self._job_key(host, job_id)],
+                args=[str(job_id), *vmids]
+            )
+        except Exception as e:
+            # The leases run out on their own
+            logger.warning(f"Failed to release VMIDs {vmids} on {host}: {str(e)}")
+
+    def release_job(self, host: str, job_id: int):
+        """Give back every ID the job still holds"""
+        with self.lock:
+            held = [vmid for vmid, owner in self.local.get(host, {}).items() if owner == job_id]
+        try:
+            held += [int(vmid) for vmid in self._client().smembers(self._job_key(host, job_id))]
+        except Exception as e:
+            logger.warning(f"Failed to list VMID leases of job {job_id}: {str(e)}")
+        self.release(host, job_id, sorted(set(held)))
+
+    def _reserve_redis(
+        self, host: str, job_id: int, count: int, first: int, last: int, used: Set[int]
+    ) -> List[int]:
+        client = self._client()
+        prefix = self._prefix(host)
+        job_key = self._job_key(host, job_id)
+
+        # A retried job picks up its own leases first
+        vmids = []
+        held = sorted(int(vmid) for vmid in client.smembers(job_key))
+        owners = client.mget([f'{prefix}{vmid}' for vmid in held]) if held else []
+        stale = []
+        for vmid, owner in zip(held, owners):
+            if owner is not None and owner.decode() == str(job_id) and vmid not in used and first <= vmid <= last:
+                vmids.append(vmid)
+            else:
+                stale.append(vmid)
+        if stale:
+            self.release(host, job_id, stale)
+        vmids = vmids[:count]
+
+        candidate = first
+        while len(vmids) < count and candidate <= last:
+            wanted = count - len(vmids)
+            candidates = []
+            while candidate <= last and len(candidates) < wanted * self.CANDIDATES_PER_ID:
+                if candidate not in used and candidate not in vmids:
+                    candidates.append(candidate)
+                candidate += 1
+            if not candidates:
+                break
+            leased = self._lease(
+                keys=[prefix, job_key],
+                args=[wanted, str(job_id), settings.PROXMOX_VMID_LEASE_SECONDS, *candidates]
+            )
+            vmids.extend(int(vmid) for vmid in leased)
+        return sorted(vmids)
+
+    def _reserve_local(
+        self, host: str, job_id: int, count: int, first: int, last: int, used: Set[int]
+    ) -> List[int]:
+        with self.lock:
+            leases = self.local.setdefault(host, {})
+            for vmid in [vmid for vmid in leases if vmid in used]:
+                # Created since; the cluster tracks it now
+                del leases[vmid]
+            vmids = sorted(vmid for vmid, owner in leases.items() if owner == job_id and first <= vmid <= last)
+            vmids = vmids[:count]
+            candidate = first
+            while len(vmids) < count and candidate <= last:
+                if candidate not in used and candidate not in leases:
+                    leases[candidate] = job_id
+                    vmids.append(candidate)
+                candidate += 1
+            return sorted(vmids)
+
+    @staticmethod
+    def _prefix(host: str) -> str:
+        return f'proxmox:vmid:{host}:'
+
+    @staticmethod
+    def _job_key(host: str, job_id: int) -> str:
+        return f'proxmox:vmids:{host}:job:{job_id}'
+
+    def _client(self):
+        if self._redis is None:
+            import redis
+
+            client = redis.Redis.from_url(settings.REDIS_URL)
+            self._lease = client.register_script(_REDIS_LEASE)
+            self._release = client.register_script(_REDIS_RELEASE)
+            self._redis = client
+        return self._redis
+
+
+# Shared by all jobs of this worker process
+allocator = VMIDAllocator()
@@ -0,0 +1,237 @@
+"""Shared VMware inventory cache
+
+The VM information list_vms reports is cached in Redis per vCenter and
+user, so every API worker answers the VM picker from the same copy instead
+of crawling vCenter. The cache is kept current from the inventory feed of
+the refreshing worker's session: after the first full load only created,
+changed and deleted VMs are fetched and written.
+
+A copy older than VMWARE_INVENTORY_MAX_AGE_SECONDS is still served, and
+refreshed in the background; the age is reported with it. Only a missing
+cache or a forced refresh makes the caller wait for vCenter. A Redis lock
+keeps workers from refreshing the same inventory at once.
+
+Listings are filtered and paged on the server. Pages are cut by an opaque
+cursor holding the sort key of the last VM served, so a page boundary
+stays put while VMs come and go.
+"""
+import base64
+import fnmatch
+import json
+import threading
+import time
+import logging
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+from app.config import settings
+from app.connectors.vmware_connector import VMwareConnector
+
+logger = logging.getLogger(__name__)
+
+
+def sort_key(vm: Dict[str, Any]) -> Tuple[str, str]:
+    """Order VMs are listed and paged in"""
+    return vm['name'], vm['id']
+
+
+def filter_vms(
+    vms: Iterable[Dict[str, Any]],
+    name: Optional[str] = None,
+    power_state: Optional[str] = None,
+    folder: Optional[str] = None,
+    cluster: Optional[str] = None,
+    min_disk_gb: Optional[float] = None,
+    max_disk_gb: Optional[float] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    VMs matching every given filter
+    
+    name is a case-insensitive shell pattern (web-*); without wildcards it
+    matches anywhere in the name. The other filters match exactly, and the
+    disk sizes are the VM's total.
+    """
+    if name is not None:
+        pattern = name.lower()
+        if not any(c in pattern for c in '*?['):
+            pattern = f'*{pattern}*'
+    for vm in vms:
+        if name is not None and not fnmatch.fnmatchcase(vm['name'].lower(), pattern):
+            continue
+        if power_state is not None and vm.get('status') != power_state:
+            continue
+        if folder is not None and vm.get('folder') != folder:
+            continue
+        if cluster is not None and vm.get('cluster') != cluster:
+            continue
+        if min_disk_gb is not None and vm['disk_size_gb'] < min_disk_gb:
+            continue
+        if max_disk_gb is not None and vm['disk_size_gb'] > max_disk_gb:
+            continue
+        yield vm
+
+
+def encode_cursor(vm: Dict[str, Any]) -> str:
+    """Cursor resuming after vm"""
+    return base64.urlsafe_b64encode(json.dumps(sort_key(vm)).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Sort key a cursor resumes after; raises ValueError for a malformed cursor"""
+    try:
+        name, moid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(name), str(moid)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def paginate(
+    vms: List[Dict[str, Any]],
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of sorted VMs after cursor, and the cursor of the next page (None on the last)"""
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        vms = [vm for vm in vms if sort_key(vm) > after]
+    if limit is None or len(vms) <= limit:
+        return vms, None
+    page = vms[:limit]
+    return page, encode_cursor(page[-1])
+
+
+class InventoryCache:
+    """VM inventories of the vCenters this deployment talks to"""
+    
+    # Forget inventories nobody asked for in a day
+    KEY_TTL_SECONDS = 86400
+    
+    # Longest a refresh may hold the lock
+    LOCK_TIMEOUT_SECONDS = 300
+    
+    def __init__(self):
+        self._redis = None
+        self._refreshing = set()
+        self.lock = threading.Lock()
+    
+    def list_vms(
+        self,
+        connector: VMwareConnector,
+        force_refresh: bool = False,
+        wait: bool = True
+    ) -> Tuple[Iterable[Dict[str, Any]], Optional[float]]:
+        """
+        VMs of the connector's vCenter and the age of the data in seconds
+        
+        Cached VMs come as a list in sort_key order. When the cache has to be
+        filled or refreshed first and wait is false, the cache is refreshed
+        in the background instead, and the VMs come straight from the crawl,
+        unordered, as it runs; the age is None then. The same happens when
+        Redis is unavailable.
+        
+        The connector must be connected; its session proves the credentials
+        before anything cached is handed out. A live iterator needs it until
+        exhausted.
+        """
+        key = self._key(connector)
+        try:
+            vms, refreshed_at = self._read(key)
+            if refreshed_at is None or force_refresh:
+                if not wait:
+                    self._refresh_in_background(connector, key)
+                    return connector.iter_vms(), None
+                self._refresh(connector, key, wait=True)
+                vms, refreshed_at = self._read(key)
+            elif time.time() - refreshed_at >= settings.VMWARE_INVENTORY_MAX_AGE_SECONDS:
+                self._refresh_in_background(connector, key)
+        except Exception as e:
+            logger.warning(f"VMware inventory cache unavailable, listing live: {str(e)}")
+            return connector.iter_vms(), None
+        
+        if refreshed_at is None:
+            # Another worker's refresh did not finish in time
+            return connector.iter_vms(), None
+        return vms, max(0.0, time.time() - refreshed_at)
+    
+    def _read(self, key: str) -> Tuple[List[Dict[str, Any]], Optional[float]]:
+        pipe = self._client().pipeline()
+        pipe.hget(f'{key}:meta', 'refreshed_at')
+        pipe.hvals(key)
+        refreshed_at, values = pipe.execute()
+        vms = sorted((json.loads(value) for value in values), key=sort_key)
+        return vms, float(refreshed_at) if refreshed_at is not None else None
+    
+    def _refresh(self, connector: VMwareConnector, key: str, wait: bool):
+        client = self._client()
+        lock = client.lock(f'{key}:lock', timeout=self.LOCK_TIMEOUT_SECONDS)
+        if not lock.acquire(blocking=wait, blocking_timeout=self.LOCK_TIMEOUT_SECONDS if wait else None):
+            return
+        try:
+            if not client.exists(f'{key}:meta'):
+                # Deltas only make sense on top of a cache; start the feed over
+                connector.reset_inventory_feed()
+            started = time.time()
+            full, updated, removed = connector.inventory_changes()
+            
+            pipe = client.pipeline(transaction=True)
+            if full:
+                pipe.delete(key)
+            if updated:
+                pipe.hset(key, mapping={moid: json.dumps(info) for moid, info in updated.items()})
+            if removed:
+                pipe.hdel(key, *removed)
+            pipe.hset(f'{key}:meta', mapping={'refreshed_at': started})
+            pipe.expire(key, self.KEY_TTL_SECONDS)
+            pipe.expire(f'{key}:meta', self.KEY_TTL_SECONDS)
+            pipe.execute()
+            
+            logger.info(
+                f"VMware inventory of {connector.host} refreshed "
+                f"({'full' if full else 'delta'}, {len(updated)} updated, {len(removed)} removed) "
+                f"in {time.time() - started:.2f}s"
+            )
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                logger.debug(f"Inventory lock already released: {str(e)}")
+    
+    def _refresh_in_background(self, connector: VMwareConnector, key: str):
+        with self.lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        
+        def run():
+            try:
+                # A connector of its own; the caller's is returned to the pool meanwhile
+                with VMwareConnector(
+                    host=connector.host,
+                    user=connector.user,
+                    password=connector.password,
+                    port=connector.port,
+                    verify_ssl=connector.verify_ssl
+                ) as background:
+                    self._refresh(background, key, wait=False)
+            except Exception as e:
+                logger.warning(f"Background refresh of VMware inventory {key} failed: {str(e)}")
+            finally:
+                with self.lock:
+                    self._refreshing.discard(key)
+        
+        threading.Thread(target=run, name='vmware-inventory-refresh', daemon=True).start()
+    
+    @staticmethod
+    def _key(connector: VMwareConnector) -> str:
+        # Per user, since vCenter permissions decide which VMs a user sees
+        return f'vmware:inventory:{connector.host}:{connector.port}:{connector.user}'
+    
+    def _client(self):
+        if self._redis is None:
+            import redis
+            
+            self._redis = redis.Redis.from_url(settings.REDIS_URL)
+        return self._redis
+
+
+# Shared by all requests of this API process
+inventory = InventoryCache()
@@ -0,0 +1,284 @@
+"""Warm migration: copy a running VM, then cut over with a short delta
+
+The first pass copies every allocated area of each disk from a snapshot
+while the VM keeps running. Each following pass takes a new snapshot and
+copies only the areas VMware Changed Block Tracking reports as changed since
+the previous one. Once a pass is small enough, or the pass budget is spent,
+the VM is powered off and one last delta is copied. With validate, every
+target is then checked against the snapshot the cutover copied from.
+
+A run that fails removes the snapshots it took and, if it got as far as
+powering the VM off, powers it back on, so the source keeps running as
+before and the migration can be retried.
+"""
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, Callable, Collection, List, Optional, Tuple
+
+from app.config import settings
+from app.connectors.vmware_connector import MIGRATION_SNAPSHOT_PREFIX
+from app.services.disk_transfer import DiskReader, DiskWriter, DiskTransfer, verify_target
+from app.services.progress_monitor import ProgressTracker
+
+logger = logging.getLogger(__name__)
+
+
+# CBT change ID that selects every allocated area of a disk
+ALL_ALLOCATED = '*'
+
+
+class WarmMigration:
+    """
+    Copies the disks of a running VM in CBT-driven passes
+
+    vmware is a VMwareConnector, or any object with the same snapshot and
+    CBT methods. reader_factory(disk_index, disk, snapshot_moref) returns a
+    reader for a disk as of a snapshot, where disk is an entry of
+    get_snapshot_disks(). writer_factory(disk_index, disk, zeroed) returns a
+    writer for the disk's target; zeroed is only True for the first pass.
+    Both factories may be called from disk threads. With validate, each
+    target is hashed after the cutover and compared with the cutover
+    snapshot, which is read whole. reused_disks are the indexes of disks
+    whose targets hold data of an earlier attempt; their first pass writes
+    the whole disk, zeroes included, instead of the allocated areas onto a
+    zeroed target. transfer_options are passed on to every DiskTransfer,
+    e.g. the target's queue_depth. throttle, if given, is
+    called with the size of every source read; tracker gets each pass's
+    bytes added as the pass starts.
+    """
+
+    def __init__(
+        self,
+        vmware,
+        vm_name: str,
+        reader_factory: Callable[[int, Dict[str, Any], str], DiskReader],
+        writer_factory: Callable[[int, Dict[str, Any], bool], DiskWriter],
+        max_passes: Optional[int] = None,
+        cutover_threshold_bytes: Optional[int] = None,
+        disk_parallelism: int = 1,
+        validate: bool = False,
+        reused_disks: Collection[int] = (),
+        transfer_options: Optional[Dict[str, Any]] = None,
+        cancel_event: threading.Event = None,
+        throttle: Callable[[int], None] = None,
+        tracker: Optional[ProgressTracker] = None,
+        progress_callback: Callable[[int, str], None] = None
+    ):
+        self.vmware = vmware
+        self.vm_name = vm_name
+        self.reader_factory = reader_factory
+        self.writer_factory = writer_factory
+        self.max_passes = max(2, max_passes or settings.WARM_MAX_PASSES)
+        self.cutover_threshold_bytes = (
+            cutover_threshold_bytes if cutover_threshold_bytes is not None
+            else settings.WARM_CUTOVER_THRESHOLD_MB * 1024 * 1024
+        )
+        self.disk_parallelism = max(1, disk_parallelism)
+        self.validate = validate
+        self.reused_disks = set(reused_disks)
+        self.transfer_options = transfer_options or {}
+        self.cancel_event = cancel_event
+        self.throttle = throttle
+        self.tracker = tracker
+        self.progress_callback = progress_callback
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run all passes and the cutover
+
+        Returns dict with the bytes copied per pass, the name of the
+        snapshot kept as backup of the powered-off source and per-disk
+        results under 'disks', with a 'validation' entry when validated
+        """
+        self.vmware.enable_change_tracking(self.vm_name)
+
+        pass_bytes = []
+        change_ids = None
+        previous_snapshot = None
+        last_pass = self.max_passes
+        # What a failed run has to undo on the source
+        snapshots = []
+        powered_off = False
+
+        try:
+            for pass_number in range(1, self.max_passes + 1):
+                final = pass_number == last_pass
+                if final:
+                    self._report(90, "Powering off source VM for cutover")
+                    powered_off = True
+                    self.vmware.power_off_vm(self.vm_name)
+                    snapshot_name = f"{MIGRATION_SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+                else:
+                    snapshot_name = f"migration-warm-{pass_number}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+                # A running VM is quiesced; a powered-off one has nothing to flush
+                self.vmware.create_snapshot(self.vm_name, snapshot_name, quiesce=not final)
+                snapshots.append(snapshot_name)
+                disks = self.vmware.get_snapshot_disks(self.vm_name, snapshot_name)
+
+                copied = self._copy_pass(pass_number, final, snapshot_name, disks, change_ids)
+                pass_bytes.append(copied)
+                logger.info(f"Warm pass {pass_number} for {self.vm_name} copied {copied} bytes")
+
+                change_ids = [disk['change_id'] for disk in disks]
+                if previous_snapshot:
+                    self.vmware.remove_snapshot(self.vm_name, previous_snapshot)
+                    snapshots.remove(previous_snapshot)
+                previous_snapshot = snapshot_name
+
+                if final:
+                    break
+                # A small delta means the next one, taken with the VM off, will be small too
+                if pass_number > 1 and copied <= self.cutover_threshold_bytes:
+                    last_pass = pass_number + 1
+
+            if self.validate:
+                self._report(99, "Verifying target disks")
+                results = self._verify(previous_snapshot, disks)
+            else:
+                results = [
+                    {'disk_index': disk_index, 'size_bytes': disk['capacity_bytes'], 'warm': True}
+                    for disk_index, disk in enumerate(disks)
+                ]
+        except Exception:
+            self._roll_back(snapshots, powered_off)
+            raise
+        self._report(100, "Cutover complete")
+
+        return {
+            'passes': len(pass_bytes),
+            'pass_bytes': pass_bytes,
+            'cutover_bytes': pass_bytes[-1],
+            'backup_snapshot': previous_snapshot,
+            'disks': results
+        }
+
+    def _copy_pass(
+        self,
+        pass_number: int,
+        final: bool,
+        snapshot_name: str,
+        disks: List[Dict[str, Any]],
+        change_ids: Optional[List[str]]
+    ) -> int:
+        """Copy the changed areas of all disks for one pass, returns bytes copied"""
+        full = change_ids is None
+        areas = [
+            # A reused target may hold stale data anywhere, so it is overwritten whole
+            [(0, disk['capacity_bytes'])] if full and disk_index in self.reused_disks
+            else self.vmware.query_changed_areas(
+                self.vm_name,
+                snapshot_name,
+                disk['key'],
+                ALL_ALLOCATED if full else change_ids[disk_index],
+                disk['capacity_bytes']
+            )
+            for disk_index, disk in enumerate(disks)
+        ]
+
+        snapshot_moref = self.vmware.get_snapshot_moref(self.vm_name, snapshot_name)
+
+        total = sum(length for disk_areas in areas for _, length in disk_areas)
+        if self.tracker is not None:
+            self.tracker.add_total(total)
+        done = [0] * len(disks)
+        lock = threading.Lock()
+
+        # The full pass takes the bulk of the time, deltas and cutover share the rest
+        if full:
+            band = (0, 75)
+        elif final:
+            band = (90, 100)
+        else:
+            band = (75, 90)
+
+        def disk_progress(disk_index: int, disk_total: int):
+            def update(percentage: int, message: str):
+                with lock:
+                    done[disk_index] = disk_total * percentage // 100
+                    overall = sum(done) / total if total else 1
+                    self._report(
+                        band[0] + int(overall * (band[1] - band[0])),
+                        f"Warm pass {pass_number}: {sum(done) // (1024**2)}/{total // (1024**2)} MB"
+                    )
+            return update
+
+        def copy_disk(disk_index: int) -> int:
+            disk_areas = self._merge(areas[disk_index])
+            # The full pass always opens the writer so every target gets allocated
+            if not disk_areas and not full:
+                return 0
+            disk_total = sum(length for _, length in disk_areas)
+            zeroed = full and disk_index not in self.reused_disks
+            reader = self.reader_factory(disk_index, disks[disk_index], snapshot_moref)
+            with reader, self.writer_factory(disk_index, disks[disk_index], zeroed) as writer:
+                DiskTransfer(
+                    reader,
+                    writer,
+                    cancel_event=self.cancel_event,
+                    throttle=self.throttle,
+                    tracker=self.tracker,
+                    **self.transfer_options
+                ).run(
+                    progress_callback=disk_progress(disk_index, disk_total),
+                    ranges=disk_areas
+                )
+            return disk_total
+
+        with ThreadPoolExecutor(max_workers=min(self.disk_parallelism, len(disks)) or 1) as executor:
+            return sum(executor.map(copy_disk, range(len(disks))))
+
+    def _verify(self, snapshot_name: str, disks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Compare every target with the snapshot, returns per-disk results"""
+        snapshot_moref = self.vmware.get_snapshot_moref(self.vm_name, snapshot_name)
+        chunk_size = settings.CHUNK_SIZE_MB * 1024 * 1024
+
+        def verify_disk(disk_index: int) -> Dict[str, Any]:
+            size = disks[disk_index]['capacity_bytes']
+            reader = self.reader_factory(disk_index, disks[disk_index], snapshot_moref)
+            with reader, self.writer_factory(disk_index, disks[disk_index], False) as writer:
+                writer.open(size)
+                # Passes only stream changed areas, so no chunk has a stream digest
+                validation = verify_target(reader, writer, size, chunk_size, [None] * -(-size // chunk_size))
+            return {
+                'disk_index': disk_index,
+                'size_bytes': size,
+                'chunk_size': chunk_size,
+                'validation': validation,
+                'warm': True
+            }
+
+        with ThreadPoolExecutor(max_workers=min(self.disk_parallelism, len(disks)) or 1) as executor:
+            return list(executor.map(verify_disk, range(len(disks))))
+
+    def _roll_back(self, snapshots: List[str], powered_off: bool):
+        """Remove the snapshots of a failed run and restart a VM it powered off"""
+        for snapshot_name in snapshots:
+            try:
+                self.vmware.remove_snapshot(self.vm_name, snapshot_name)
+            except Exception as e:
+                logger.error(f"Failed to remove snapshot {snapshot_name} of {self.vm_name}: {str(e)}")
+        if powered_off:
+            logger.warning(f"Cutover of {self.vm_name} failed, powering the source back on")
+            try:
+                self.vmware.power_on_vm(self.vm_name)
+            except Exception as e:
+                logger.error(f"Failed to power {self.vm_name} back on: {str(e)}")
+
+    @staticmethod
+    def _merge(areas: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Sort areas and merge the ones that touch or overlap"""
+        merged = []
+        for start, length in sorted(areas):
+            if merged and start <= merged[-1][0] + merged[-1][1]:
+                last_start, last_length = merged[-1]
+                merged[-1] = (last_start, max(last_length, start + length - last_start))
+            else:
+                merged.append((start, length))
+        return merged
+
+    def _report(self, percentage: int, message: str):
+        if self.progress_callback:
+            self.progress_callback(percentage, message)
@@ -1,24 +1,91 @@
 """Celery tasks for migrations"""
-from celery import current_task
+from celery.exceptions import Retry, SoftTimeLimitExceeded
 from app.celery_app import celery_app
+from app.config import settings
+from app.connectors.proxmox_connector import ProxmoxConnector
+from app.connectors.vmware_connector import VMwareConnector, MIGRATION_SNAPSHOT_PREFIX
+from app.services.bandwidth import ThroughputMeter, limiter
+from app.services.checkpoint_store import CheckpointStore
 from app.services.migration_service import MigrationService
+from app.services.placement import AUTO, engine as placement_engine
+from app.services.vmid_allocator import allocator as vmid_allocator
+from app.services.progress_monitor import ProgressTracker
 from app.database import SessionLocal
-from app.models.migration_job import MigrationJob, JobStatus
+from app.models.migration_job import MigrationJob, JobStatus, ValidationResult
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
+from typing import Dict, Any, List, Optional
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 
-@celery_app.task(bind=True)
+class JobProgress:
+    """Tracks per-VM progress of a job whose VMs migrate concurrently"""
+    
+    def __init__(self, vm_names: List[str]):
+        self.progress = {vm_name: 0 for vm_name in vm_names}
+        self.running = []
+        self.lock = threading.Lock()
+    
+    def start(self, vm_name: str):
+        """Mark a VM as running"""
+        with self.lock:
+            self.running.append(vm_name)
+    
+    def finish(self, vm_name: str):
+        """Mark a VM as done, whatever the outcome"""
+        with self.lock:
+            self.progress[vm_name] = 100
+            if vm_name in self.running:
+                self.running.remove(vm_name)
+    
+    def update(self, vm_name: str, percentage: int) -> int:
+        """Record a VM's progress and return the overall job progress"""
+        with self.lock:
+            self.progress[vm_name] = max(self.progress[vm_name], percentage)
+            return self.overall()
+    
+    def overall(self) -> int:
+        """Overall job progress, each VM weighing the same"""
+        return int(sum(self.progress.values()) / len(self.progress))
+    
+    def current_vms(self) -> Optional[str]:
+        """Comma-separated list of running VMs, sized for the current_vm column"""
+        with self.lock:
+            return ", ".join(self.running)[:255] or None
+
+
+@celery_app.task(bind=True, max_retries=settings.MIGRATION_MAX_RETRIES)
 def run_migration_job(self, job_id: int):
     """
     Run a migration job
     
+    Up to MAX_CONCURRENT_MIGRATIONS VMs of the job are migrated at once.
+    Disk transfers are checkpointed, so a retried or redelivered task skips
+    finished VMs and resumes the others from their last checkpoint. The job's
+    bandwidth limit is re-read while it runs, so it can be changed on the fly.
+    With group_cutover, all cold-migrated VMs are snapshotted and powered off
+    together before the first copy starts, instead of one by one. An "auto"
+    target node or storage is resolved per VM before anything is touched,
+    and VMIDs for all new target VMs are leased in one block up front.
+    
+    The job is claimed with a lock in Redis while it runs. A delivery of a
+    job another worker holds is dropped; the lock outlives the task time
+    limit only briefly, so a job whose worker died is picked up again.
+    
     Args:
         job_id: Database ID of the migration job
     """
+    claim = _claim_job(job_id)
+    if claim is None:
+        logger.warning(f"Migration job {job_id} is running on another worker, dropping this delivery")
+        return {'job_id': job_id, 'status': 'already_running'}
+    
     db = SessionLocal()
+    vmid_host = None
     
     try:
         # Get job from database
@@ -26,88 +93,139 @@ def run_migration_job(self, job_id: int):
         if not job:
             raise ValueError(f"Job {job_id} not found")
         
+        checkpoint_store = CheckpointStore(job_id)
+        vm_names = list(job.source_vms)
+        progress = JobProgress(vm_names)
+        
+        # A retry or a redelivery after a worker died finds the job running
+        resuming = self.request.retries > 0 or job.status == JobStatus.RUNNING
+        finished_vms = []
+        if resuming:
+            finished_vms = [vm_name for vm_name in checkpoint_store.completed_vms() if vm_name in vm_names]
+            for vm_name in finished_vms:
+                progress.finish(vm_name)
+            # Counters are rebuilt; interrupted VMs are counted again when they finish
+            job.completed_vms = len(finished_vms)
+            job.failed_vms = 0
+            job.error_message = None
+            logger.info(f"Resuming migration job {job_id}: {len(finished_vms)} VMs already migrated")
+        else:
+            job.started_at = datetime.now()
+            logger.info(f"Starting migration job {job_id}: {job.name}")
+        
         # Update job status
         job.status = JobStatus.RUNNING
-        job.started_at = datetime.now()
+        job.progress_percentage = progress.overall()
         db.commit()
         
-        logger.info(f"Starting migration job {job_id}: {job.name}")
+        max_workers = max(1, min(settings.MAX_CONCURRENT_MIGRATIONS, len(vm_names)))
+        cancel_event = threading.Event()
         
-        # Create migration service
-        migration_service = MigrationService()
+        # The task request is thread-local, so pass the ID to the VM threads
+        task_id = self.request.id
         
-        # Migrate each VM
-        for idx, vm_name in enumerate(job.source_vms):
-            logger.info(f"Migrating VM {idx+1}/{len(job.source_vms)}: {vm_name}")
-            
-            job.current_vm = vm_name
-            db.commit()
-            
-            # Get VM-specific config
-            vm_config = None
-            if job.vm_configs and vm_name in job.vm_configs:
-                vm_config = job.vm_configs[vm_name]
-            
-            def progress_callback(percentage: int, message: str):
-                """Update job progress"""
-                # Calculate overall progress
-                vm_progress = (idx / len(job.source_vms)) * 100
-                current_vm_progress = (percentage / 100) * (100 / len(job.source_vms))
-                overall_progress = int(vm_progress + current_vm_progress)
-                
-                job.progress_percentage = overall_progress
-                db.commit()
-                
-                # Update Celery task state
-                self.update_state(
-                    state='PROGRESS',
-                    meta={
-                        'current': overall_progress,
-                        'total': 100,
-                        'status': message,
-                        'current_vm': vm_name
-                    }
-                )
-            
-            try:
-                # Migrate VM
-                result = migration_service.migrate_vm(
-                    source_host=job.source_host,
-                    source_user=job.source_user,
-                    source_password=job.source_password,  # Note: Should be encrypted
-                    source_vm_name=vm_name,
-                    target_host=job.target_host,
-                    target_user=job.target_user,
-                    target_password=job.target_password,  # Note: Should be encrypted
-                    target_node=job.target_node,
-                    target_storage=job.target_storage,
-                    vm_config=vm_config,
-                    progress_callback=progress_callback
+        # Pick node and storage for "auto" targets before touching the sources
+        if AUTO in (job.target_node, job.target_storage):
+            _place_job_vms(db, job, [vm_name for vm_name in vm_names if vm_name not in finished_vms])
+        
+        # Snapshot and power off the whole group in one go
+        prepared_vms = set()
+        if job.group_cutover:
+            pending_vms = [vm_name for vm_name in vm_names if vm_name not in finished_vms]
+            prepared_vms, cutover_failures = _group_cutover(job, pending_vms, checkpoint_store)
+            for vm_name, error in cutover_failures.items():
+                # Copying a VM that is still running would not be consistent
+                progress.finish(vm_name)
+                finished_vms.append(vm_name)
+            if cutover_failures:
+                job.failed_vms += len(cutover_failures)
+                job.error_message = "; ".join(
+                    f"{vm_name}: {error}" for vm_name, error in cutover_failures.items()
                 )
-                
-                if result['success']:
-                    job.completed_vms += 1
-                    logger.info(f"VM {vm_name} migrated successfully")
-                else:
-                    job.failed_vms += 1
-                    logger.error(f"VM {vm_name} migration failed: {result.get('error')}")
-                
-            except Exception as e:
-                logger.error(f"Exception during migration of {vm_name}: {str(e)}")
-                job.failed_vms += 1
-                job.error_message = str(e)
-            
-            db.commit()
+                job.progress_percentage = progress.overall()
+                db.commit()
+        
+        # VMs resuming into their checkpointed target VM keep its VMID
+        vmid_host = job.target_host
+        fresh_vms = [
+            vm_name for vm_name in vm_names
+            if vm_name not in finished_vms and not checkpoint_store.get_vm(vm_name)
+        ]
+        vmids = _reserve_vmids(job, fresh_vms)
+        
+        limiter.set_job_limit(job_id, job.bandwidth_limit_mbps)
+        meter = ThroughputMeter()
+        tracker = ProgressTracker()
+        transfer_started = time.monotonic()
+        
+        # Migrate VMs, each in its own thread with its own connectors and session
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"job-{job_id}")
+        futures = [
+            executor.submit(
+                _migrate_job_vm,
+                self,
+                task_id,
+                job_id,
+                vm_name,
+                idx,
+                progress,
+                checkpoint_store,
+                cancel_event,
+                meter,
+                tracker,
+                vm_name in prepared_vms,
+                vmids.get(vm_name)
+            )
+            for idx, vm_name in enumerate(vm_names)
+            if vm_name not in finished_vms
+        ]
+        try:
+            _monitor_job(db, job_id, futures, meter, tracker)
+        except SoftTimeLimitExceeded:
+            # Stop the transfers at their next chunk and retry from the checkpoints
+            logger.warning(f"Migration job {job_id} hit the time limit, retrying from checkpoints")
+            cancel_event.set()
+            wait(futures)
+            raise self.retry(countdown=settings.MIGRATION_RETRY_DELAY_SECONDS)
+        finally:
+            # VM threads still write to the job and the targets; stop them and
+            # wait, so the job is not marked failed and released under them
+            if not all(future.done() for future in futures):
+                cancel_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+        
+        # Pick up the counters the VM threads wrote
+        db.refresh(job)
         
         # Mark job as completed
         job.status = JobStatus.COMPLETED if job.failed_vms == 0 else JobStatus.FAILED
+        if job.validate_transfer:
+            validations = db.query(ValidationResult).filter(ValidationResult.job_id == job_id).all()
+            job.validation_results = {
+                row.vm_name: {
+                    'level1_passed': row.level1_passed,
+                    'level2_passed': row.level2_passed,
+                    'critical_issues': len(row.critical_issues or [])
+                }
+                for row in validations
+            }
+            if job.failed_vms == 0 and any(not row.level2_passed for row in validations):
+                job.status = JobStatus.VALIDATION_FAILED
         job.completed_at = datetime.now()
         job.progress_percentage = 100
         job.current_vm = None
+        # Average over the whole run rather than the last window
+        elapsed = time.monotonic() - transfer_started
+        job.transfer_speed_mbps = int(meter.total_bytes * 8 / 1_000_000 / elapsed) if elapsed > 0 else 0
+        job.total_size_gb = tracker.total_bytes // 1024**3
+        job.transferred_size_gb = tracker.bytes_done // 1024**3
         db.commit()
         
         logger.info(f"Migration job {job_id} completed. Success: {job.completed_vms}, Failed: {job.failed_vms}")
         
+        # Resume points are only needed while the job can still be retried
+        checkpoint_store.clear()
+        
         # Send notification if configured
         if job.send_notification and job.notification_email:
             send_notification.delay(job_id)
@@ -119,10 +237,14 @@ def run_migration_job(self, job_id: int):
             'failed_vms': job.failed_vms
         }
         
+    except Retry:
+        raise
+    
     except Exception as e:
         logger.error(f"Migration job {job_id} failed: {str(e)}")
         
         # Update job status
+        db.rollback()
         job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
         if job:
             job.status = JobStatus.FAILED
@@ -133,7 +255,322 @@ def run_migration_job(self, job_id: int):
         raise
     
     finally:
+        limiter.release_job(job_id)
+        if vmid_host:
+            # Created VMs hold their IDs on the cluster; the rest are free again
+            vmid_allocator.release_job(vmid_host, job_id)
         db.close()
+        _release_job(claim)
+
+
+_redis = None
+
+
+def _claim_job(job_id: int):
+    """Take the job's lock, or None if another worker holds it"""
+    global _redis
+    if _redis is None:
+        import redis
+        
+        _redis = redis.Redis.from_url(settings.REDIS_URL)
+    lock = _redis.lock(f'migration:job:{job_id}', timeout=settings.MIGRATION_TIME_LIMIT_SECONDS + 300)
+    return lock if lock.acquire(blocking=False) else None
+
+
+def _release_job(lock):
+    try:
+        lock.release()
+    except Exception as e:
+        logger.warning(f"Job lock {lock.name} already released: {str(e)}")
+
+
+def _monitor_job(db, job_id: int, futures: list, meter: ThroughputMeter, tracker: ProgressTracker):
+    """
+    Wait for the VM threads
+    
+    Every PROGRESS_UPDATE_INTERVAL_SECONDS the job's bandwidth limit is
+    re-read and its byte counts and throughput are written, so the job row
+    sees one write per interval however many disks are streaming.
+    """
+    while True:
+        _, pending = wait(futures, timeout=settings.PROGRESS_UPDATE_INTERVAL_SECONDS)
+        if not pending:
+            return
+        
+        limit = db.query(MigrationJob.bandwidth_limit_mbps).filter(MigrationJob.id == job_id).scalar()
+        limiter.set_job_limit(job_id, limit)
+        
+        stats = tracker.snapshot()
+        _update_job(
+            db,
+            job_id,
+            total_size_gb=stats['total_bytes'] // 1024**3,
+            transferred_size_gb=stats['bytes_done'] // 1024**3,
+            transfer_speed_mbps=int(meter.mbps())
+        )
+
+
+def _migrate_job_vm(
+    task,
+    task_id: str,
+    job_id: int,
+    vm_name: str,
+    idx: int,
+    progress: JobProgress,
+    checkpoint_store: CheckpointStore,
+    cancel_event: threading.Event,
+    meter: ThroughputMeter,
+    tracker: ProgressTracker,
+    source_prepared: bool = False,
+    target_vmid: Optional[int] = None
+):
+    """Migrate one VM of a job; runs on a job worker thread"""
+    db = SessionLocal()
+    
+    try:
+        job = db.query(MigrationJob).filter(MigrationJob.id == job_id).first()
+        logger.info(f"Migrating VM {idx+1}/{job.total_vms}: {vm_name}")
+        
+        progress.start(vm_name)
+        _update_job(db, job_id, current_vm=progress.current_vms())
+        
+        # Get VM-specific config
+        vm_config = None
+        if job.vm_configs and vm_name in job.vm_configs:
+            vm_config = job.vm_configs[vm_name]
+        
+        # Where the placement engine put the VM, for "auto" targets
+        target = (job.placements or {}).get(vm_name, {})
+        
+        def progress_callback(percentage: int, message: str):
+            """Update job progress"""
+            overall_progress = progress.update(vm_name, percentage)
+            _update_job(db, job_id, progress_percentage=overall_progress)
+            
+            # Update Celery task state
+            stats = tracker.snapshot()
+            task.update_state(
+                task_id=task_id,
+                state='PROGRESS',
+                meta={
+                    'current': overall_progress,
+                    'total': 100,
+                    'status': message,
+                    'current_vm': vm_name,
+                    'transferred_bytes': stats['bytes_done'],
+                    'total_bytes': stats['total_bytes'],
+                    'rate_mbps': int(stats['rate_bps'] * 8 / 1_000_000),
+                    'eta_seconds': stats['eta_seconds']
+                }
+            )
+        
+        error = None
+        try:
+            # Migrate VM
+            result = MigrationService().migrate_vm(
+                source_host=job.source_host,
+                source_user=job.source_user,
+                source_password=job.source_password,  # Note: Should be encrypted
+                source_vm_name=vm_name,
+                target_host=job.target_host,
+                target_user=job.target_user,
+                target_password=job.target_password,  # Note: Should be encrypted
+                target_token_name=job.target_token_name,
+                target_token_value=job.target_token_value,
+                target_node=target.get('node', job.target_node),
+                target_storage=target.get('storage', job.target_storage),
+                vm_config=vm_config,
+                checkpoint_store=checkpoint_store,
+                cancel_event=cancel_event,
+                validate=job.validate_transfer,
+                source_prepared=source_prepared,
+                target_vmid=target_vmid,
+                throttle_factory=lambda esxi_host: limiter.throttle(esxi_host, job_id, meter),
+                tracker=tracker,
+                progress_callback=progress_callback
+            )
+            
+            succeeded = result['success']
+            if succeeded:
+                logger.info(f"VM {vm_name} migrated successfully")
+                if job.validate_transfer:
+                    # Runs inline: the disk results are already at hand
+                    validate_migration(job_id, vm_name, result['disks'])
+            else:
+                logger.error(f"VM {vm_name} migration failed: {result.get('error')}")
+            
+        except Exception as e:
+            logger.error(f"Exception during migration of {vm_name}: {str(e)}")
+            db.rollback()
+            succeeded = False
+            error = str(e)
+        
+        if not succeeded and target_vmid is not None:
+            # Let other migrations have the ID; a VM left behind still holds it on the cluster
+            vmid_allocator.release(job.target_host, job_id, [target_vmid])
+        
+        progress.finish(vm_name)
+        
+        # Increment in SQL so concurrent VMs never lose an update
+        counter = MigrationJob.completed_vms if succeeded else MigrationJob.failed_vms
+        values = {
+            counter: counter + 1,
+            MigrationJob.progress_percentage: progress.overall(),
+            MigrationJob.current_vm: progress.current_vms()
+        }
+        if error:
+            values[MigrationJob.error_message] = error
+        db.query(MigrationJob).filter(MigrationJob.id == job_id).update(values, synchronize_session=False)
+        db.commit()
+        
+    except Exception as e:
+        logger.error(f"Failed to record migration of {vm_name}: {str(e)}")
+        
+    finally:
+        db.close()
+
+
+def _place_job_vms(db, job: MigrationJob, vm_names: List[str]):
+    """
+    Choose node and storage for the VMs of a job with "auto" targets
+    
+    Placements are stored on the job, so a retried job finds its VMs, and
+    their checkpoints, where the first attempt put them.
+    """
+    placements = dict(job.placements or {})
+    unplaced = [vm_name for vm_name in vm_names if vm_name not in placements]
+    if not unplaced:
+        return
+    
+    vm_configs = job.vm_configs or {}
+    vms = []
+    with VMwareConnector(job.source_host, job.source_user, job.source_password) as vmware:
+        for vm_name in unplaced:
+            info = vmware.get_vm_info(vm_name)
+            vms.append({
+                'name': vm_name,
+                'memory_mb': (vm_configs.get(vm_name) or {}).get('memory_mb') or info['memory_mb'],
+                'disk_bytes': int(sum(disk['size_gb'] for disk in info['disks']) * 1024**3)
+            })
+    
+    with ProxmoxConnector(
+        job.target_host,
+        job.target_user,
+        job.target_password,
+        token_name=job.target_token_name,
+        token_value=job.target_token_value
+    ) as proxmox:
+        placements.update(placement_engine.place(
+            proxmox,
+            vms,
+            node=job.target_node,
+            storage=job.target_storage,
+            in_flight=_in_flight_by_node(db, job)
+        ))
+    
+    job.placements = placements
+    db.commit()
+
+
+def _reserve_vmids(job: MigrationJob, vm_names: List[str]) -> Dict[str, int]:
+    """Lease a VMID for each VM in one block, from the job's range if it has one"""
+    if not vm_names:
+        return {}
+    with ProxmoxConnector(
+        job.target_host,
+        job.target_user,
+        job.target_password,
+        token_name=job.target_token_name,
+        token_value=job.target_token_value
+    ) as proxmox:
+        vmids = vmid_allocator.reserve(
+            proxmox,
+            job.id,
+            len(vm_names),
+            first=job.vmid_range_start,
+            last=job.vmid_range_end
+        )
+    return dict(zip(vm_names, vmids))
+
+
+def _in_flight_by_node(db, job: MigrationJob) -> Dict[str, float]:
+    """
+    Migrations other running jobs are writing to each node of the job's cluster
+    
+    A job migrates at most MAX_CONCURRENT_MIGRATIONS VMs at once; with
+    "auto" targets they are spread over its placements in proportion.
+    """
+    counts: Dict[str, float] = {}
+    others = db.query(MigrationJob).filter(
+        MigrationJob.status == JobStatus.RUNNING,
+        MigrationJob.id != job.id,
+        MigrationJob.target_host == job.target_host
+    ).all()
+    for other in others:
+        remaining = max((other.total_vms or 0) - (other.completed_vms or 0) - (other.failed_vms or 0), 0)
+        active = min(remaining, settings.MAX_CONCURRENT_MIGRATIONS)
+        if not active:
+            continue
+        if other.target_node != AUTO:
+            counts[other.target_node] = counts.get(other.target_node, 0.0) + active
+        elif other.placements:
+            share = active / len(other.placements)
+            for placement in other.placements.values():
+                counts[placement['node']] = counts.get(placement['node'], 0.0) + share
+    return counts
+
+
+def _group_cutover(job: MigrationJob, vm_names: List[str], checkpoint_store: CheckpointStore):
+    """
+    Power off and snapshot the cold-migrated VMs of a job together
+    
+    Returns the set of VMs that are now off and {vm_name: error} for those
+    that could not be powered off, including VMs whose disks cannot be
+    read directly, which are left running. Warm VMs keep running until
+    their own cutover; VMs with checkpoints were snapshotted by the earlier
+    attempt. A failed snapshot is only logged, as in a single VM's migration.
+    """
+    vm_configs = job.vm_configs or {}
+    cold = [
+        vm_name for vm_name in vm_names
+        if (vm_configs.get(vm_name) or {}).get('migration_mode') != 'warm'
+    ]
+    if not cold:
+        return set(), {}
+    fresh = [vm_name for vm_name in cold if not checkpoint_store.get_vm(vm_name)]
+    
+    logger.info(f"Group cutover of job {job.id}: {len(cold)} VMs")
+    with VMwareConnector(job.source_host, job.source_user, job.source_password) as vmware:
+        failures = {}
+        for vm_name in cold:
+            try:
+                vmware.get_frozen_disk_paths(vm_name)
+            except Exception as e:
+                failures[vm_name] = str(e)
+        cold = [vm_name for vm_name in cold if vm_name not in failures]
+        
+        outcomes = vmware.power_off_vms(cold) if cold else {}
+        prepared = {vm_name for vm_name, outcome in outcomes.items() if outcome['success']}
+        failures.update({
+            vm_name: f"power-off failed: {outcome['error']}"
+            for vm_name, outcome in outcomes.items() if not outcome['success']
+        })
+        
+        # Snapshots of VMs already off leave the whole disks in the files below them
+        fresh = [vm_name for vm_name in fresh if vm_name in prepared]
+        if fresh:
+            snapshot_name = f"{MIGRATION_SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            for vm_name, outcome in vmware.create_snapshots(fresh, snapshot_name, quiesce=False).items():
+                if not outcome['success']:
+                    logger.warning(f"Snapshot creation failed for {vm_name}: {outcome['error']}")
+    
+    return prepared, failures
+
+
+def _update_job(db, job_id: int, **values):
+    """Write job columns without loading the row, safe across job threads"""
+    db.query(MigrationJob).filter(MigrationJob.id == job_id).update(values, synchronize_session=False)
+    db.commit()
 
 
 @celery_app.task
@@ -161,8 +598,88 @@ def send_notification(job_id: int):
 
 
 @celery_app.task
-def validate_migration(job_id: int, vm_name: str):
-    """Validate a migrated VM"""
-    # TODO: Implement validation logic
+def validate_migration(job_id: int, vm_name: str, disks: Optional[List[Dict[str, Any]]] = None):
+    """
+    Record the validation of a migrated VM
+    
+    disks are the per-disk results of MigrationService.migrate_vm. Level 1
+    passes when every disk was transferred whole, level 2 when every target
+    disk matched the chunk digests taken from the transfer stream, or for
+    warm migrations the cutover snapshot. A VM without disks passes with a
+    warning, as there is nothing to verify.
+    
+    Args:
+        job_id: Database ID of the migration job
+        vm_name: Name of the migrated VM
+        disks: Per-disk transfer results, with their 'validation' entries
+    """
     logger.info(f"Validating VM {vm_name} for job {job_id}")
-    pass
+    
+    checks = {'disks': []}
+    critical_issues = []
+    warnings = []
+    
+    if not disks:
+        warnings.append({'message': "VM has no disks to validate"})
+    
+    for disk in disks or []:
+        disk_index = disk['disk_index']
+        verification = disk.get('validation')
+        checks['disks'].append({
+            'disk_index': disk_index,
+            'target_volid': disk.get('target_volid'),
+            'size_bytes': disk.get('size_bytes'),
+            'chunk_size': disk.get('chunk_size'),
+            'stream_digest': disk.get('digest'),
+            'verification': verification
+        })
+        
+        if disk.get('transferred_earlier'):
+            warnings.append({
+                'disk_index': disk_index,
+                'message': "Disk was transferred by an earlier attempt and not verified again"
+            })
+        elif verification is None:
+            critical_issues.append({'disk_index': disk_index, 'message': "Disk was not verified"})
+        elif not verification['passed']:
+            critical_issues.append({
+                'disk_index': disk_index,
+                'message': f"{verification['mismatched_chunks']} chunks differ from the source",
+                'offsets': verification['mismatched_offsets']
+            })
+        elif verification['source_reread_bytes'] and not disk.get('warm'):
+            warnings.append({
+                'disk_index': disk_index,
+                'message': f"{verification['source_reread_bytes']} bytes copied before a resume were re-read from the source"
+            })
+    
+    transferred = [disk for disk in disks or [] if not disk.get('transferred_earlier')]
+    level1_passed = all(disk.get('size_bytes') is not None for disk in transferred)
+    level2_passed = level1_passed and not critical_issues
+    
+    db = SessionLocal()
+    try:
+        # A retried job validates its VMs again
+        db.query(ValidationResult).filter(
+            ValidationResult.job_id == job_id,
+            ValidationResult.vm_name == vm_name
+        ).delete(synchronize_session=False)
+        db.add(ValidationResult(
+            job_id=job_id,
+            vm_name=vm_name,
+            level1_passed=level1_passed,
+            level2_passed=level2_passed,
+            checks=checks,
+            critical_issues=critical_issues,
+            warnings=warnings
+        ))
+        db.commit()
+    finally:
+        db.close()
+    
+    if critical_issues:
+        logger.error(f"Validation of {vm_name} failed: {critical_issues}")
+    else:
+        logger.info(f"Validation of {vm_name} passed")
+    
+    return {'vm_name': vm_name, 'level1_passed': level1_passed, 'level2_passed': level2_passed}
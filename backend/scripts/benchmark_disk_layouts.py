@@ -0,0 +1,29 @@
+"""Benchmark disk layouts on a storage mount
+
+Times a disk transfer into a directory of the storage with every candidate
+layout and the one selected for the storage type. Run from backend/ with
+the worker's environment:
+
+    python -m scripts.benchmark_disk_layouts /mnt/pve/nfs-vms --storage-type nfs
+"""
+import argparse
+
+from app.services.disk_formats import benchmark, disk_layout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark disk layouts on a storage mount")
+    parser.add_argument('directory', help="Directory on the storage to write to")
+    parser.add_argument('--storage-type', help="Proxmox storage type, e.g. nfs, dir or btrfs")
+    parser.add_argument('--size-mb', type=int, default=256)
+    args = parser.parse_args()
+
+    print(f"Selected for {args.storage_type}: {disk_layout(args.storage_type)}")
+    for result in benchmark(args.directory, args.storage_type, args.size_mb):
+        marker = '*' if result['selected'] else ' '
+        mbps = f"{result['mbps']:>8}" if result['mbps'] is not None else f"{'-':>8}"
+        print(f"{marker} {result['name']:<20} {result['seconds']:>8.2f}s {mbps} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Shared fixtures for the backend tests"""
+import os
+import tempfile
+
+import pytest
+
+# Settings are read when app.config is imported; the tests need no real services
+os.environ.setdefault('SECRET_KEY', 'test')
+# A file database, as in-memory SQLite takes no pool settings; nothing connects to it
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='backend-tests-'), 'test.db')}")
+
+def write_image(path, layout):
+    """
+    Write a raw disk image from (kind, length) runs
+
+    'data' runs are random bytes, 'zero' runs are written zero bytes and
+    'hole' runs are left unallocated. Returns the image's contents.
+    """
+    contents = bytearray()
+    with open(path, 'wb') as f:
+        for kind, length in layout:
+            if kind == 'hole':
+                f.seek(length, os.SEEK_CUR)
+                contents += bytes(length)
+                continue
+            data = os.urandom(length) if kind == 'data' else bytes(length)
+            f.write(data)
+            contents += data
+        f.truncate(len(contents))
+    return bytes(contents)
+
+
+@pytest.fixture
+def image(tmp_path):
+    """Factory for raw disk images under the test's temp directory"""
+    def make(name, layout):
+        path = str(tmp_path / name)
+        return path, write_image(path, layout)
+    return make
@@ -0,0 +1,134 @@
+"""In-memory stand-in for the proxmoxer API, checking requests like PVE does"""
+import os
+import re
+from types import SimpleNamespace
+
+from app.connectors.proxmox_connector import FILE_STORAGE_TYPES, ProxmoxConnector
+
+
+class APIError(Exception):
+    """What PVE answers with 400 for a parameter that fails its schema"""
+
+
+class _Resource:
+    """A path of the API, built like proxmoxer builds it: api.nodes('pve1').storage.get()"""
+
+    def __init__(self, api, path):
+        self._api = api
+        self._path = path
+
+    def __getattr__(self, name):
+        return _Resource(self._api, self._path + (name,))
+
+    def __call__(self, *segments):
+        return _Resource(self._api, self._path + tuple(str(segment) for segment in segments))
+
+    def get(self, **params):
+        return self._api.handle('GET', self._path, params)
+
+    def post(self, **params):
+        return self._api.handle('POST', self._path, params)
+
+    def put(self, **params):
+        return self._api.handle('PUT', self._path, params)
+
+    def delete(self, **params):
+        return self._api.handle('DELETE', self._path, params)
+
+
+class FakeProxmoxAPI:
+    """
+    A cluster whose volumes are files in a directory
+
+    Handlers are registered per method and path pattern, with * matching
+    one path segment; route() adds more for a test. Every request is kept
+    in requests as (method, path, params).
+    """
+
+    def __init__(self, directory, nodes=None, storages=None):
+        self.directory = directory
+        self.nodes_by_name = nodes or {'pve1': '192.0.2.10'}
+        # storage -> config, as GET /storage/{storage} returns it
+        self.storages = storages or {}
+        self.requests = []
+        self.routes = []
+        self.route('GET', 'cluster/status', self._cluster_status)
+        self.route('GET', 'storage/*', self._storage_config)
+        self.route('GET', 'nodes/*/storage', self._list_storage)
+        self.route('POST', 'nodes/*/storage/*/content', self._allocate)
+        self.route('GET', 'nodes/*/storage/*/content/*', self._volume)
+
+    def __getattr__(self, name):
+        return _Resource(self, (name,))
+
+    def route(self, method, pattern, handler):
+        """handler(params, *wildcards) answers method on paths matching pattern"""
+        self.routes.insert(0, (method, pattern.split('/'), handler))
+
+    def handle(self, method, path, params):
+        self.requests.append((method, '/'.join(path), params))
+        for route_method, pattern, handler in self.routes:
+            if route_method != method or len(pattern) != len(path):
+                continue
+            if all(part == '*' or part == segment for part, segment in zip(pattern, path)):
+                return handler(params, *[segment for part, segment in zip(pattern, path) if part == '*'])
+        raise APIError(f"No handler for {method} /{'/'.join(path)}")
+
+    def volume_path(self, volid):
+        """Where a volume's data lives; block volumes are plain files standing in for devices"""
+        storage, name = volid.split(':', 1)
+        if self.storages[storage]['type'] in FILE_STORAGE_TYPES:
+            return os.path.join(self.directory, storage, 'images', name)
+        return os.path.join(self.directory, storage, name)
+
+    def _cluster_status(self, params):
+        return [{'type': 'cluster', 'name': 'lab'}] + [
+            {'type': 'node', 'name': name, 'ip': ip} for name, ip in self.nodes_by_name.items()
+        ]
+
+    def _storage_config(self, params, storage):
+        return {'storage': storage, **self.storages[storage]}
+
+    def _list_storage(self, params, node):
+        return [{'storage': name, 'type': config['type']} for name, config in self.storages.items()]
+
+    def _allocate(self, params, node, storage):
+        # The checks of PVE's schema for POST /nodes/{node}/storage/{storage}/content
+        size = params['size']
+        match = re.fullmatch(r'(\d+)([MG]?)', str(size))
+        if not match:
+            raise APIError(f"size: value does not match the regex pattern: {size}")
+        size_bytes = int(match.group(1)) * {'': 1024, 'M': 1024**2, 'G': 1024**3}[match.group(2)]
+
+        vmid = params['vmid']
+        filename = params['filename']
+        storage_type = self.storages[storage]['type']
+        if storage_type in FILE_STORAGE_TYPES:
+            match = re.fullmatch(rf'vm-{vmid}-\S+\.(raw|qcow2|vmdk)', filename)
+            if not match:
+                raise APIError(f"illegal name '{filename}' - should be 'vm-{vmid}-*.raw|qcow2|vmdk'")
+            if match.group(1) != params.get('format', 'raw'):
+                raise APIError(f"extension of '{filename}' does not match format {params.get('format')}")
+            volid = f'{storage}:{vmid}/{filename}'
+        else:
+            if not re.fullmatch(rf'vm-{vmid}-[\w\-]+', filename):
+                raise APIError(f"illegal name '{filename}' - should be 'vm-{vmid}-*'")
+            if params.get('format', 'raw') != 'raw':
+                raise APIError(f"unsupported format '{params['format']}'")
+            volid = f'{storage}:{filename}'
+
+        path = self.volume_path(volid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.truncate(size_bytes)
+        return volid
+
+    def _volume(self, params, node, storage, volid):
+        return {'volid': volid, 'path': self.volume_path(volid)}
+
+
+def connector(api, host='pve.example'):
+    """A ProxmoxConnector talking to api, as if leased from the pool"""
+    proxmox = ProxmoxConnector(host, 'root@pam', password='secret')
+    proxmox._session = SimpleNamespace(api=api, leases=1, last_used=0)
+    return proxmox
@@ -0,0 +1,156 @@
+"""Token buckets and throttles of disk streams, on a simulated clock"""
+import threading
+
+import pytest
+
+from app.config import settings
+from app.services import bandwidth
+from app.services.bandwidth import BandwidthLimiter, RedisTokenBucket, Throttle, ThroughputMeter, TokenBucket
+
+MB = 1_000_000
+
+
+class Clock:
+    """Stands in for the time module; sleeping moves the clock forward"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bandwidth, 'time', clock)
+    return clock
+
+
+def test_bucket_starts_with_a_burst_then_runs_into_debt(clock):
+    bucket = TokenBucket(10 * MB, burst_seconds=1.0)
+
+    assert bucket.take(10 * MB) == 0.0
+    # Taken in full, paid back at the rate
+    assert bucket.take(5 * MB) == pytest.approx(0.5)
+    assert bucket.take(5 * MB) == pytest.approx(1.0)
+
+    clock.now += 1.0
+    assert bucket.take(1 * MB) == pytest.approx(0.1)
+
+
+def test_idle_bucket_refills_up_to_the_burst_only(clock):
+    bucket = TokenBucket(10 * MB, burst_seconds=2.0)
+    bucket.take(20 * MB)
+
+    clock.now += 60
+    assert bucket.take(20 * MB) == 0.0
+    assert bucket.take(1 * MB) == pytest.approx(0.1)
+
+
+def test_unlimited_bucket_never_waits(clock):
+    bucket = TokenBucket(None)
+
+    assert bucket.take(10 ** 12) == 0.0
+
+
+def test_lower_rate_caps_saved_up_tokens(clock):
+    bucket = TokenBucket(100 * MB, burst_seconds=1.0)
+
+    bucket.set_rate(10 * MB)
+
+    assert bucket.take(10 * MB) == 0.0
+    assert bucket.take(10 * MB) == pytest.approx(1.0)
+
+
+def test_throttled_stream_holds_the_limit(clock):
+    meter = ThroughputMeter()
+    throttle = Throttle([TokenBucket(10 * MB, burst_seconds=1.0)], meter)
+    started = clock.now
+
+    for _ in range(100):
+        throttle(1 * MB)
+
+    # The first second's worth came out of the burst
+    assert clock.now - started == pytest.approx(9.0)
+    assert meter.total_bytes == 100 * MB
+
+
+def test_slowest_bucket_decides_the_wait(clock):
+    fast = TokenBucket(100 * MB, burst_seconds=1.0)
+    slow = TokenBucket(10 * MB, burst_seconds=1.0)
+    throttle = Throttle([fast, slow])
+
+    throttle(30 * MB)
+
+    assert clock.slept == [pytest.approx(2.0)]
+    # Both were charged
+    assert fast.tokens == pytest.approx(70 * MB)
+
+
+def test_concurrent_takes_are_all_charged(clock):
+    # The clock stands still, so nothing refills while the threads run
+    bucket = TokenBucket(1.0, burst_seconds=1.0)
+
+    def take():
+        for _ in range(1000):
+            bucket.take(1)
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bucket.tokens == 1.0 - 8000
+
+
+def test_streams_of_a_job_share_its_bucket(clock, monkeypatch):
+    monkeypatch.setattr(settings, 'BANDWIDTH_LIMIT_MBPS', 0)
+    monkeypatch.setattr(settings, 'BANDWIDTH_HOST_LIMITS_MBPS', {'esx01': 800})
+    monkeypatch.setattr(settings, 'BANDWIDTH_HOST_DEFAULT_MBPS', 0)
+    limiter = BandwidthLimiter()
+    limiter.set_job_limit(7, 80)
+
+    first = limiter.throttle('esx01', job_id=7)
+    second = limiter.throttle('esx02', job_id=7)
+
+    assert first.buckets[2] is second.buckets[2]
+    assert first.buckets[1].rate == 100 * MB and second.buckets[1].rate is None
+
+    # 80 Mbit/s is 10 MB/s, whichever stream reads
+    first(10 * MB)
+    second(10 * MB)
+    assert sum(clock.slept) == pytest.approx(1.0)
+
+
+def test_job_limit_changes_apply_to_running_streams(clock):
+    limiter = BandwidthLimiter()
+    limiter.set_job_limit(7, 80)
+    throttle = limiter.throttle(job_id=7)
+    throttle(10 * MB)
+
+    limiter.set_job_limit(7, None)
+    throttle(100 * MB)
+
+    assert clock.slept == []
+    limiter.release_job(7)
+    assert 'job:7' not in limiter.buckets
+
+
+class BrokenRedis:
+    def register_script(self, script):
+        def take(keys, args):
+            raise ConnectionError("Connection refused")
+        return take
+
+
+def test_redis_bucket_fails_open():
+    bucket = RedisTokenBucket(BrokenRedis(), 'bandwidth:global', 10 * MB)
+
+    assert bucket.take(100 * MB) == 0.0
@@ -0,0 +1,74 @@
+"""BlockingExecutor streams, with blocking producers"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.api.blocking import BlockingExecutor
+
+
+def collect(stream, limit=None):
+    async def run():
+        items = []
+        async for item in stream:
+            items.append(item)
+            if len(items) == limit:
+                await stream.aclose()
+                break
+        return items
+    return asyncio.run(run())
+
+
+def test_stream_iterates_on_the_pool():
+    executor = BlockingExecutor(workers=2, max_pending=4)
+    threads = []
+
+    def items():
+        for number in range(200):
+            threads.append(threading.current_thread().name)
+            time.sleep(0.001)
+            yield number
+
+    assert collect(executor.stream('crawl', items())) == list(range(200))
+    assert set(name.split('_')[0] for name in threads) == {'api-blocking'}
+    metrics = executor.metrics()
+    assert metrics['endpoints']['crawl']['calls'] == 1
+    assert metrics['pending'] == 0
+
+
+def test_abandoned_stream_stops_and_closes_its_producer():
+    executor = BlockingExecutor(workers=1, max_pending=4)
+    produced = []
+    closed = threading.Event()
+
+    def items():
+        try:
+            for number in range(10_000):
+                produced.append(number)
+                yield number
+        finally:
+            closed.set()
+
+    assert collect(executor.stream('crawl', items()), limit=3) == [0, 1, 2]
+    assert closed.wait(5)
+    # Held back by the queue, not run to the end
+    assert len(produced) <= 3 + BlockingExecutor.STREAM_QUEUE_DEPTH + 1
+
+
+def test_stream_raises_producer_errors_after_its_items():
+    executor = BlockingExecutor(workers=1, max_pending=4)
+
+    def items():
+        yield 'first'
+        raise ConnectionError("vCenter went away")
+
+    async def run():
+        received = []
+        with pytest.raises(ConnectionError):
+            async for item in executor.stream('crawl', items()):
+                received.append(item)
+        return received
+
+    assert asyncio.run(run()) == ['first']
+    assert executor.metrics()['endpoints']['crawl']['errors'] == 1
@@ -0,0 +1,175 @@
+"""Adaptive compression, and CompressedSSHWriter against its receiver run locally"""
+import collections
+import os
+import subprocess
+import sys
+import zlib
+
+import pytest
+
+from app.services import compression
+from app.services.compression import (
+    FRAME_SIZE,
+    OP_LZ4,
+    OP_RAW,
+    OP_ZLIB,
+    OP_ZSTD,
+    AdaptiveCompressor,
+    CompressedSSHWriter,
+)
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def idle_cpu(monkeypatch):
+    monkeypatch.setattr(compression, 'cpu_headroom', lambda: 1.0)
+
+
+def run_windows(compressor, windows, rate):
+    """Feed windows of frames that move at rate(level) bytes per second; returns the levels"""
+    levels = []
+    for _ in range(windows):
+        for _ in range(compressor.WINDOW):
+            compressor.record(MIB, MIB // 2, MIB / rate(compressor.level))
+        levels.append(compressor.level)
+    return levels
+
+
+def test_compressible_frames_are_compressed():
+    compressor = AdaptiveCompressor(OP_ZLIB, min_ratio=0.9)
+    data = b'disk block ' * 10000
+
+    op, payload = compressor.compress(memoryview(data))
+
+    assert op == OP_ZLIB
+    assert zlib.decompress(payload) == data
+
+
+def test_incompressible_frames_back_off_exponentially():
+    compressor = AdaptiveCompressor(OP_ZLIB, min_ratio=0.9)
+    calls = []
+    real = compressor._compressor(compressor.level)
+    compressor._compressors[compressor.level] = lambda data: calls.append(len(data)) or real(data)
+    noise = os.urandom(64 * 1024)
+
+    ops = [compressor.compress(noise)[0] for _ in range(8)]
+
+    assert ops == [OP_RAW] * 8
+    # Tried on frames 1, 3 and 6: skipping 1, then 2, then 4 frames
+    assert len(calls) == 3
+
+
+def test_compressible_frame_resets_the_backoff():
+    compressor = AdaptiveCompressor(OP_ZLIB, min_ratio=0.9)
+    noise = os.urandom(64 * 1024)
+    for _ in range(4):
+        compressor.compress(noise)
+
+    # Skipped frames pass through raw until the backoff runs out
+    while compressor._skip_frames:
+        assert compressor.compress(bytes(64 * 1024))[0] == OP_RAW
+    assert compressor.compress(bytes(64 * 1024))[0] == OP_ZLIB
+    assert compressor._skip_backoff == 1
+
+
+def test_level_climbs_to_the_best_throughput(idle_cpu):
+    compressor = AdaptiveCompressor(OP_ZSTD)
+
+    # Throughput peaks at level 4 and falls off on both sides
+    levels = run_windows(compressor, 60, lambda level: 100 - 5 * (level - 4) ** 2)
+
+    assert levels[:3] == [2, 3, 4]
+    assert set(levels[10:]) <= {3, 4, 5}
+    assert collections.Counter(levels[10:]).most_common(1)[0][0] == 4
+
+
+def test_level_stays_at_the_top_while_more_compression_pays(idle_cpu):
+    compressor = AdaptiveCompressor(OP_ZLIB)
+
+    levels = run_windows(compressor, 20, lambda level: 10 * level)
+
+    assert max(levels) == 9
+    assert levels[-1] >= 8
+
+
+def test_level_backs_off_without_cpu_headroom(monkeypatch):
+    monkeypatch.setattr(compression, 'cpu_headroom', lambda: 0.0)
+    compressor = AdaptiveCompressor(OP_ZSTD)
+    compressor.level = 8
+
+    levels = run_windows(compressor, 10, lambda level: 100)
+
+    assert levels[:3] == [7, 6, 5]
+    assert levels[-1] == 1
+
+
+def test_codec_choice_prefers_what_both_ends_have(monkeypatch):
+    monkeypatch.setattr(compression, 'local_codecs', lambda: [OP_ZLIB, OP_ZSTD, OP_LZ4])
+
+    assert CompressedSSHWriter('pve1', '/dev/null')._choose_codec({OP_ZLIB, OP_LZ4, OP_ZSTD}) == OP_ZSTD
+    assert CompressedSSHWriter('pve1', '/dev/null')._choose_codec({OP_ZLIB, OP_LZ4}) == OP_LZ4
+    assert CompressedSSHWriter('pve1', '/dev/null', codec='zlib')._choose_codec({OP_ZLIB, OP_ZSTD}) == OP_ZLIB
+    # Asked for a codec the target lacks
+    assert CompressedSSHWriter('pve1', '/dev/null', codec='lz4')._choose_codec({OP_ZLIB}) == OP_ZLIB
+
+
+class PipeChannel:
+    """The parts of a paramiko channel the writer uses, over a local process"""
+
+    def __init__(self, process):
+        self.process = process
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def recv(self, length):
+        return self.process.stdout.read1(length)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait(timeout=10)
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    """A CompressedSSHWriter whose receiver runs here, on a 16 MiB target"""
+    target = tmp_path / 'target.raw'
+    target.write_bytes(b'\xee' * 16 * MIB)
+    process = subprocess.Popen(
+        [sys.executable, '-c', compression._RECEIVER, str(target)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE
+    )
+    writer = CompressedSSHWriter('pve1', str(target), codec='zlib')
+    writer.channel = PipeChannel(process)
+    writer.compressor = AdaptiveCompressor(writer._choose_codec({
+        int(codec) for codec in writer._read_line().split(',')
+    }))
+    yield writer, target
+    writer.close()
+
+
+def test_receiver_applies_compressed_raw_and_zero_frames(receiver):
+    writer, target = receiver
+    # Spans two frames
+    text = (b'compressible ' * ((FRAME_SIZE + MIB) // 13 + 1))[:FRAME_SIZE + MIB]
+    noise = os.urandom(MIB)
+
+    writer.write(0, text)
+    writer.write(8 * MIB, noise)
+    writer.write_zeroes(10 * MIB, 2 * MIB)
+    writer.flush()
+
+    contents = target.read_bytes()
+    assert contents[:FRAME_SIZE + MIB] == text
+    assert contents[8 * MIB:9 * MIB] == noise
+    assert contents[10 * MIB:12 * MIB] == bytes(2 * MIB)
+    assert contents[12 * MIB:] == b'\xee' * 4 * MIB
+    assert writer.read(8 * MIB, 4096) == noise[:4096]
+    # The text went out compressed, the noise as it was
+    assert writer.compressor.ratio() > 2
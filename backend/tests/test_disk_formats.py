@@ -0,0 +1,103 @@
+"""Disk layouts per storage type, applied by the storage targets"""
+import os
+
+import pytest
+
+from app.config import settings
+from app.services.disk_formats import BENCHMARK_CANDIDATES, benchmark, disk_layout
+from app.services.disk_transfer import DiskTransfer, LocalFileReader
+from app.services.storage_targets import storage_target
+from fake_proxmox import FakeProxmoxAPI, connector
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def local_writer(monkeypatch):
+    monkeypatch.setattr(settings, 'TRANSFER_WRITER', 'local')
+
+
+@pytest.fixture
+def api(tmp_path):
+    return FakeProxmoxAPI(str(tmp_path), storages={
+        'local': {'type': 'dir', 'path': '/var/lib/vz'},
+        'share': {'type': 'nfs', 'server': '192.0.2.20'},
+        'ceph': {'type': 'rbd', 'pool': 'rbd'},
+    })
+
+
+def allocated_bytes(path):
+    return os.stat(path).st_blocks * 512
+
+
+def test_layout_depends_on_storage_type():
+    assert disk_layout('dir')['preallocation'] == 'falloc'
+    assert disk_layout('nfs') == {'format': 'raw', 'preallocation': 'off', 'queue_depth': 4}
+    assert disk_layout('rbd')['queue_depth'] == 4
+    assert disk_layout('lvmthin')['preallocation'] == 'off'
+    # Unknown storages keep the configured queue depth
+    assert disk_layout('iscsi') == {'format': 'raw', 'preallocation': 'off', 'queue_depth': None}
+
+
+def test_overrides_apply_per_storage_type(monkeypatch):
+    monkeypatch.setattr(settings, 'DISK_LAYOUT_OVERRIDES', {'dir': {'preallocation': 'off', 'queue_depth': 8}})
+
+    assert disk_layout('dir') == {'format': 'raw', 'preallocation': 'off', 'queue_depth': 8}
+    assert disk_layout('nfs')['queue_depth'] == 4
+
+
+@pytest.mark.parametrize('override, message', [
+    ({'format': 'qcow2'}, 'raw'),
+    ({'preallocation': 'full'}, 'preallocation'),
+])
+def test_overrides_the_writers_cannot_follow_are_rejected(monkeypatch, override, message):
+    monkeypatch.setattr(settings, 'DISK_LAYOUT_OVERRIDES', {'dir': override})
+
+    with pytest.raises(ValueError, match=message):
+        disk_layout('dir')
+
+
+def test_dir_volumes_are_preallocated_and_still_skip_holes(api, image):
+    source, contents = image('source.raw', [('data', MIB), ('hole', 3 * MIB)])
+
+    with storage_target(connector(api), 'pve1', 'local') as target, LocalFileReader(source) as reader:
+        volid = target.allocate(120, 'disk-0', reader.size())
+        path = api.volume_path(volid)
+        assert allocated_bytes(path) >= 4 * MIB
+
+        with target.writer(volid, zeroed=True) as writer:
+            stats = DiskTransfer(reader, writer, chunk_size=MIB, **target.transfer_options()).run()
+
+    with open(path, 'rb') as f:
+        assert f.read() == contents
+    assert stats['bytes_skipped'] == 3 * MIB
+
+
+def test_network_file_volumes_stay_sparse(api):
+    with storage_target(connector(api), 'pve1', 'share') as target:
+        volid = target.allocate(120, 'disk-0', 4 * MIB)
+
+        assert allocated_bytes(api.volume_path(volid)) == 0
+        assert target.transfer_options() == {'queue_depth': 4}
+
+
+def test_failed_preallocation_leaves_the_volume_sparse(api, monkeypatch):
+    target = storage_target(connector(api), 'pve1', 'local')
+
+    def run(command):
+        raise IOError(f"{command} failed: Operation not supported")
+
+    monkeypatch.setattr(target, 'run', run)
+    volid = target.allocate(120, 'disk-0', 4 * MIB)
+
+    assert allocated_bytes(api.volume_path(volid)) == 0
+
+
+def test_benchmark_times_every_candidate_and_the_selection(tmp_path):
+    results = benchmark(str(tmp_path), 'nfs', size_mb=4)
+
+    assert {result['name'] for result in results} == set(BENCHMARK_CANDIDATES) | {'selected'}
+    assert [result['selected'] for result in results].count(True) == 1
+    assert [result['seconds'] for result in results] == sorted(result['seconds'] for result in results)
+    # Targets are cleaned up
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,195 @@
+"""DiskTransfer between local raw images"""
+import hashlib
+import threading
+import time
+
+import pytest
+
+from app.config import settings
+from app.services.disk_transfer import DiskTransfer, LocalFileReader, LocalFileWriter, verify_target
+
+MIB = 1024 * 1024
+
+# Data, a hole, data with a written zero run inside, then written zeroes
+LAYOUT = [
+    ('data', MIB),
+    ('hole', MIB),
+    ('data', MIB // 2), ('zero', 256 * 1024), ('data', 256 * 1024),
+    ('zero', MIB),
+]
+
+
+def transfer(source, target, zeroed, checkpoint=None, checkpoint_callback=None, **kwargs):
+    with LocalFileReader(source) as reader, LocalFileWriter(target, zeroed=zeroed) as writer:
+        engine = DiskTransfer(reader, writer, chunk_size=MIB, **kwargs)
+        stats = engine.run(checkpoint=checkpoint, checkpoint_callback=checkpoint_callback)
+        validation = verify_target(reader, writer, stats['size_bytes'], stats['chunk_size'], engine.chunk_digests)
+    return stats, validation, engine.chunk_digests
+
+
+class HangingReader(LocalFileReader):
+    """Stops answering after the first chunk, like an SFTP read on a dead link"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.released = threading.Event()
+
+    def read(self, offset, length):
+        if offset >= MIB:
+            self.released.wait()
+            raise ConnectionError("Connection closed")
+        return super().read(offset, length)
+
+    def abort(self):
+        self.released.set()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_skips_holes_and_zero_blocks_on_zeroed_target(image, tmp_path):
+    source, contents = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+
+    stats, validation, _ = transfer(source, target, zeroed=True)
+
+    assert read(target) == contents
+    assert stats['bytes_skipped'] == MIB + 256 * 1024 + MIB
+    assert stats['bytes_written'] == MIB + MIB // 2 + 256 * 1024
+    assert validation['passed']
+    assert validation['digest'] == stats['digest']
+
+
+def test_writes_zeroes_out_on_used_target(image, tmp_path):
+    source, contents = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+    with open(target, 'wb') as f:
+        f.write(b'\xff' * len(contents))
+
+    stats, validation, _ = transfer(source, target, zeroed=False)
+
+    assert read(target) == contents
+    assert stats['bytes_skipped'] == 0
+    assert validation['passed']
+
+
+def test_non_sparse_transfer_writes_every_byte(image, tmp_path):
+    source, contents = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+
+    stats, _, _ = transfer(source, target, zeroed=True, sparse=False)
+
+    assert read(target) == contents
+    assert stats['bytes_written'] == len(contents)
+
+
+def test_checkpoints_describe_flushed_data(image, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'CHECKPOINT_INTERVAL_MB', 1)
+    source, contents = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+    checkpoints = []
+
+    transfer(source, target, zeroed=True, checkpoint_callback=lambda *args: checkpoints.append(args))
+
+    assert [offset for offset, _ in checkpoints] == [MIB, 2 * MIB, 3 * MIB, 4 * MIB]
+    for offset, last_chunk in checkpoints:
+        assert last_chunk is not None and last_chunk[0] + last_chunk[1] <= offset
+        chunk_offset, chunk_length, digest = last_chunk
+        assert hashlib.sha256(contents[chunk_offset:chunk_offset + chunk_length]).hexdigest() == digest
+
+
+def _checkpoint(contents, committed_offset):
+    """Checkpoint as CheckpointStore returns it, after the data chunk ending at committed_offset"""
+    return {
+        'committed_offset': committed_offset,
+        'last_chunk_offset': 0,
+        'last_chunk_length': MIB,
+        'last_chunk_hash': hashlib.sha256(contents[:MIB]).hexdigest()
+    }
+
+
+def test_resumes_from_checkpoint_and_writes_zeroes_past_it(image, tmp_path):
+    source, contents = image('source.raw', LAYOUT)
+    # The interrupted attempt copied the first chunk and left garbage after it,
+    # also where the source has holes and zeroes
+    target = str(tmp_path / 'target.raw')
+    with open(target, 'wb') as f:
+        f.write(contents[:MIB] + b'\xff' * (len(contents) - MIB))
+
+    # Callers may still claim the volume reads as zero; a checkpoint overrides that
+    stats, validation, chunk_digests = transfer(source, target, zeroed=True, checkpoint=_checkpoint(contents, MIB))
+
+    assert stats['resumed_from'] == MIB
+    assert stats['bytes_skipped'] == 0
+    assert stats['digest'] is None
+    assert chunk_digests[0] is None and None not in chunk_digests[1:]
+    assert read(target) == contents
+    assert validation['passed']
+    assert validation['source_reread_bytes'] == MIB
+
+
+def test_restarts_when_target_no_longer_matches_checkpoint(image, tmp_path):
+    source, contents = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+    with open(target, 'wb') as f:
+        f.write(b'\xff' * len(contents))
+
+    stats, validation, _ = transfer(source, target, zeroed=True, checkpoint=_checkpoint(contents, MIB))
+
+    assert stats['resumed_from'] == 0
+    assert read(target) == contents
+    assert validation['passed']
+    assert validation['source_reread_bytes'] == 0
+
+
+def test_verify_target_reports_mismatched_chunks(image, tmp_path):
+    source, contents = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+
+    with LocalFileReader(source) as reader, LocalFileWriter(target, zeroed=True) as writer:
+        engine = DiskTransfer(reader, writer, chunk_size=MIB)
+        stats = engine.run()
+        writer.write(2 * MIB + 10, b'corrupt')
+        validation = verify_target(reader, writer, stats['size_bytes'], MIB, engine.chunk_digests)
+
+    assert not validation['passed']
+    assert validation['mismatched_chunks'] == 1
+    assert validation['mismatched_offsets'] == [2 * MIB]
+
+
+def test_verify_target_rejects_digest_count_mismatch(image, tmp_path):
+    source, _ = image('source.raw', LAYOUT)
+    target = str(tmp_path / 'target.raw')
+
+    with LocalFileReader(source) as reader, LocalFileWriter(target, zeroed=True) as writer:
+        stats = DiskTransfer(reader, writer, chunk_size=MIB).run()
+        with pytest.raises(IOError):
+            verify_target(reader, writer, stats['size_bytes'], MIB, [])
+
+
+def test_stalled_transfer_is_aborted(image, tmp_path):
+    source, contents = image('source.raw', [('data', 4 * MIB)])
+    target = str(tmp_path / 'target.raw')
+
+    with HangingReader(source) as reader, LocalFileWriter(target, zeroed=True) as writer:
+        started = time.monotonic()
+        with pytest.raises(TimeoutError, match='no progress'):
+            DiskTransfer(reader, writer, chunk_size=MIB, stall_timeout=0.3).run()
+
+    assert time.monotonic() - started < 5
+    assert reader.released.is_set()
+    assert read(target)[:MIB] == contents[:MIB]
+
+
+def test_slow_transfer_within_stall_timeout_completes(image, tmp_path):
+    source, contents = image('source.raw', [('data', 4 * MIB)])
+    target = str(tmp_path / 'target.raw')
+
+    # Waiting on the bandwidth limit for longer than the timeout is not a stall
+    stats, validation, _ = transfer(source, target, zeroed=True, stall_timeout=0.5,
+                                    throttle=lambda length: time.sleep(0.8))
+
+    assert read(target) == contents
+    assert validation['passed']
@@ -0,0 +1,75 @@
+"""MigrationService.migrate_vm against fake connectors"""
+import pytest
+
+from app.services import migration_service
+from app.services.migration_service import MigrationService
+
+
+class FakeVMware:
+    """A source VM whose disks may sit on snapshot deltas"""
+
+    def __init__(self, delta=False):
+        self.delta = delta
+        self.calls = []
+
+    def __call__(self, host, user, password):
+        return self
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def get_vm_info(self, vm_name):
+        return {'disk_size_gb': 2, 'disks': [{'size_gb': 1}, {'size_gb': 1}]}
+
+    def get_frozen_disk_paths(self, vm_name):
+        if self.delta:
+            raise ValueError(f"Disk 1 of VM {vm_name} is a snapshot delta")
+        return ['[ds1] web/web.vmdk', '[ds1] web/web_1.vmdk']
+
+    def power_off_vm(self, vm_name):
+        self.calls.append(('power_off_vm', vm_name))
+
+    def create_snapshot(self, vm_name, snapshot_name, quiesce=True):
+        self.calls.append(('create_snapshot', vm_name))
+
+
+class FakeProxmox:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def migrate(monkeypatch, vmware, **kwargs):
+    monkeypatch.setattr(migration_service, 'VMwareConnector', vmware)
+    monkeypatch.setattr(migration_service, 'ProxmoxConnector', FakeProxmox)
+    return MigrationService().migrate_vm(
+        'vcenter.example', 'admin', 'secret', 'web',
+        'pve.example', 'root@pam', 'secret', 'pve1', 'local',
+        **kwargs
+    )
+
+
+def test_snapshot_delta_is_refused_before_the_source_is_touched(monkeypatch):
+    vmware = FakeVMware(delta=True)
+
+    with pytest.raises(ValueError, match='snapshot delta'):
+        migrate(monkeypatch, vmware)
+
+    assert vmware.calls == []
+
+
+def test_prepared_source_with_delta_is_refused(monkeypatch):
+    vmware = FakeVMware(delta=True)
+
+    with pytest.raises(ValueError, match='snapshot delta'):
+        migrate(monkeypatch, vmware, source_prepared=True)
+
+    assert vmware.calls == []
@@ -0,0 +1,181 @@
+"""PlacementEngine on a described cluster"""
+import pytest
+
+from app.config import settings
+from app.services.placement import AUTO, PlacementEngine, PlacementError
+
+GIB = 1024 ** 3
+
+
+class Cluster:
+    """Answers get_cluster_resources like a ProxmoxConnector, counting the calls"""
+
+    host = 'pve.example'
+
+    def __init__(self, resources):
+        self.resources = resources
+        self.calls = 0
+
+    def get_cluster_resources(self):
+        self.calls += 1
+        return self.resources
+
+
+def node(name, maxmem_gb=64, mem_gb=0, status='online'):
+    return {'type': 'node', 'node': name, 'status': status, 'maxmem': maxmem_gb * GIB, 'mem': mem_gb * GIB}
+
+
+def storage(node_name, name, maxdisk_gb, disk_gb=0, content='images,rootdir', shared=0, status='available'):
+    return {
+        'type': 'storage', 'node': node_name, 'storage': name, 'status': status, 'content': content,
+        'maxdisk': maxdisk_gb * GIB, 'disk': disk_gb * GIB, 'shared': shared
+    }
+
+
+def vm(name, disk_gb, memory_mb=4096):
+    return {'name': name, 'disk_bytes': disk_gb * GIB, 'memory_mb': memory_mb}
+
+
+@pytest.fixture(autouse=True)
+def headroom(monkeypatch):
+    monkeypatch.setattr(settings, 'PLACEMENT_DISK_HEADROOM', 0.1)
+
+
+def test_vm_goes_to_the_storage_with_the_most_room():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        storage('pve1', 'local-lvm', 1000, disk_gb=900),
+        storage('pve2', 'local-lvm', 1000, disk_gb=100),
+    ])
+
+    placements = PlacementEngine().place(cluster, [vm('web', 50)])
+
+    assert placements == {'web': {'node': 'pve2', 'storage': 'local-lvm'}}
+
+
+def test_batch_spreads_because_placements_reserve_capacity():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        storage('pve1', 'local-lvm', 1000),
+        storage('pve2', 'local-lvm', 1000),
+    ])
+
+    placements = PlacementEngine().place(cluster, [vm(f'vm{n}', 300) for n in range(4)])
+
+    nodes = [placement['node'] for placement in placements.values()]
+    assert sorted(nodes) == ['pve1', 'pve1', 'pve2', 'pve2']
+
+
+def test_storage_without_room_for_disks_and_headroom_is_skipped():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        # 100 GiB free is not enough for 95 GiB plus 10%
+        storage('pve1', 'fast', 100),
+        storage('pve2', 'slow', 2000, disk_gb=1800),
+    ])
+
+    placements = PlacementEngine().place(cluster, [vm('db', 95)])
+
+    assert placements['db'] == {'node': 'pve2', 'storage': 'slow'}
+
+
+def test_largest_vms_are_placed_first():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        storage('pve1', 'a', 600),
+        storage('pve2', 'b', 300),
+    ])
+
+    # Placed in the given order the small VM would take the big storage
+    placements = PlacementEngine().place(cluster, [vm('small', 200), vm('big', 500)])
+
+    assert placements['big']['storage'] == 'a'
+    assert placements['small']['storage'] == 'b'
+
+
+def test_shared_storage_is_one_pool_of_space():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        storage('pve1', 'ceph', 1000, shared=1),
+        storage('pve2', 'ceph', 1000, shared=1),
+    ])
+
+    # Two VMs take 880 GiB of the pool, whichever nodes they land on
+    assert len(PlacementEngine().place(cluster, [vm('a', 400), vm('b', 400)])) == 2
+    # A third does not fit, though each node sees 1000 GiB of it
+    with pytest.raises(PlacementError):
+        PlacementEngine().place(cluster, [vm('a', 400), vm('b', 400), vm('c', 400)])
+
+
+def test_busy_nodes_are_avoided():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        storage('pve1', 'local-lvm', 1000),
+        storage('pve2', 'local-lvm', 1000),
+    ])
+
+    placements = PlacementEngine().place(cluster, [vm('web', 10)], in_flight={'pve1': 3})
+
+    assert placements['web']['node'] == 'pve2'
+
+
+def test_node_short_of_memory_is_ranked_last():
+    cluster = Cluster([
+        node('pve1', maxmem_gb=64, mem_gb=62), node('pve2', maxmem_gb=64, mem_gb=30),
+        storage('pve1', 'local-lvm', 4000),
+        storage('pve2', 'local-lvm', 1000, disk_gb=800),
+    ])
+
+    placements = PlacementEngine().place(cluster, [vm('app', 50, memory_mb=8192)])
+
+    assert placements['app']['node'] == 'pve2'
+
+
+def test_fixed_node_and_storage_limit_the_choice():
+    cluster = Cluster([
+        node('pve1'), node('pve2'),
+        storage('pve1', 'local-lvm', 1000),
+        storage('pve1', 'nfs', 5000),
+        storage('pve2', 'nfs', 5000),
+    ])
+
+    assert PlacementEngine().place(cluster, [vm('web', 10)], node='pve1', storage=AUTO) == {
+        'web': {'node': 'pve1', 'storage': 'nfs'}
+    }
+    assert PlacementEngine().place(cluster, [vm('web', 10)], node=AUTO, storage='local-lvm') == {
+        'web': {'node': 'pve1', 'storage': 'local-lvm'}
+    }
+
+
+def test_offline_nodes_and_storages_without_images_are_ignored():
+    cluster = Cluster([
+        node('pve1', status='offline'), node('pve2'),
+        storage('pve1', 'local-lvm', 5000),
+        storage('pve2', 'iso', 5000, content='iso,vztmpl'),
+        storage('pve2', 'local-lvm', 500),
+    ])
+
+    placements = PlacementEngine().place(cluster, [vm('web', 10)])
+
+    assert placements['web'] == {'node': 'pve2', 'storage': 'local-lvm'}
+
+
+def test_vm_that_fits_nowhere_fails_placement():
+    cluster = Cluster([node('pve1'), storage('pve1', 'local-lvm', 100)])
+
+    with pytest.raises(PlacementError, match='huge'):
+        PlacementEngine().place(cluster, [vm('huge', 500)])
+
+
+def test_resources_are_cached_until_invalidated(monkeypatch):
+    monkeypatch.setattr(settings, 'PLACEMENT_CACHE_SECONDS', 60)
+    cluster = Cluster([node('pve1'), storage('pve1', 'local-lvm', 1000)])
+    engine = PlacementEngine()
+
+    engine.place(cluster, [vm('a', 10)])
+    engine.place(cluster, [vm('b', 10)])
+    assert cluster.calls == 1
+
+    engine.invalidate(cluster.host)
+    engine.place(cluster, [vm('c', 10)])
+    assert cluster.calls == 2
@@ -0,0 +1,94 @@
+"""Ticket renewal of pooled Proxmox sessions, against a fake ticket endpoint"""
+import itertools
+
+import pytest
+import requests
+from proxmoxer import ProxmoxAPI
+from proxmoxer.backends import https
+
+from app.connectors.proxmox_pool import PooledProxmoxSession
+
+
+class TicketResponse:
+    status_code = 200
+
+    def __init__(self, number):
+        self.number = number
+
+    def json(self):
+        return {'data': {'ticket': f'PVE:ticket-{self.number}', 'CSRFPreventionToken': f'csrf-{self.number}'}}
+
+
+@pytest.fixture
+def ticket_requests(monkeypatch):
+    """Every POST to /access/ticket hands out the next ticket; returns the posted forms"""
+    posted = []
+    numbers = itertools.count(1)
+
+    def post(url, data=None, **kwargs):
+        assert url.endswith('/access/ticket')
+        posted.append(data)
+        return TicketResponse(next(numbers))
+
+    monkeypatch.setattr(https.requests, 'post', post)
+    return posted
+
+
+@pytest.fixture
+def session(ticket_requests):
+    session = PooledProxmoxSession('pve.example', 'root@pam', 8006, False, password='secret')
+    session.login()
+    yield session
+    session.close()
+
+
+def test_proxmoxer_internals_the_pool_relies_on(ticket_requests):
+    # Private attributes of proxmoxer, see the note on its import in proxmox_pool
+    api = ProxmoxAPI('pve.example', user='root@pam', password='secret', verify_ssl=False)
+
+    assert isinstance(api._store['session'], requests.Session)
+    auth = api._backend.auth
+    assert isinstance(auth, https.ProxmoxHTTPAuth)
+    assert api._store['session'].auth is auth
+    assert isinstance(auth.renew_age, int) and isinstance(auth.birth_time, float)
+    auth._get_new_tokens()
+    assert auth.get_tokens() == ('PVE:ticket-2', 'csrf-2')
+    assert ticket_requests[-1]['password'] == 'PVE:ticket-1'
+
+
+def test_renewal_swaps_auth_without_replacing_the_http_session(session, ticket_requests):
+    http_session = session.api._store['session']
+    adapter = http_session.get_adapter('https://pve.example')
+    old_auth = session.api._backend.auth
+
+    session.renew()
+
+    auth = session.api._backend.auth
+    assert auth is not old_auth and http_session.auth is auth
+    assert session.api._store['session'] is http_session
+    assert http_session.get_adapter('https://pve.example') is adapter
+    assert auth.get_tokens() == ('PVE:ticket-2', 'csrf-2')
+    # Requests already holding the old auth still send a matching pair
+    assert old_auth.get_tokens() == ('PVE:ticket-1', 'csrf-1')
+    # Renewed with the ticket, not the password
+    assert ticket_requests[-1]['password'] == 'PVE:ticket-1'
+
+
+def test_login_again_keeps_the_http_session(session, ticket_requests):
+    api = session.api
+    http_session = api._store['session']
+
+    session.login()
+
+    assert session.api is api and api._store['session'] is http_session
+    assert http_session.auth.get_tokens() == ('PVE:ticket-2', 'csrf-2')
+    assert ticket_requests[-1]['password'] == 'secret'
+    assert session.logins == 2
+
+
+def test_refresh_renews_old_tickets(session, monkeypatch):
+    monkeypatch.setattr(session.api._backend.auth, 'birth_time', session.api._backend.auth.birth_time - 4000)
+
+    assert session.refresh() == 'renewal'
+    assert session.refresh() == 'reuse'
+    assert session.renewals == 1
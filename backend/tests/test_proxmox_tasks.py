@@ -0,0 +1,202 @@
+"""ProxmoxTaskWaiter against the task endpoints of an in-memory cluster"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import settings
+from app.connectors.proxmox_tasks import ProxmoxTask, ProxmoxTaskWaiter
+from fake_proxmox import FakeProxmoxAPI
+
+
+class Tasks:
+    """
+    The tasks of a cluster, answering GET /nodes/{node}/tasks and
+    GET /nodes/{node}/tasks/{upid}/status like PVE: the listing is newest
+    first and cut at limit.
+    """
+
+    def __init__(self, api):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.listed_at = []
+        self.failing = False
+        api.route('GET', 'nodes/*/tasks', self._list)
+        api.route('GET', 'nodes/*/tasks/*/status', self._status)
+
+    def start(self, node='pve1', vmid=100, started_at=None):
+        started_at = int(time.time()) if started_at is None else started_at
+        with self.lock:
+            upid = f'UPID:{node}:{len(self.entries):08X}:00000000:{started_at:08X}:qmstart:{vmid}:root@pam:'
+            self.entries[upid] = {'upid': upid, 'node': node, 'starttime': started_at}
+        return ProxmoxTask(upid)
+
+    def finish(self, task, status='OK'):
+        with self.lock:
+            self.entries[task.upid].update(status=status, endtime=int(time.time()))
+
+    def _list(self, params, node):
+        with self.lock:
+            self.listed_at.append(time.monotonic())
+            if self.failing:
+                raise ConnectionError("Connection refused")
+            entries = sorted(
+                (entry for entry in self.entries.values()
+                 if entry['node'] == node and entry['starttime'] >= params['since']),
+                key=lambda entry: entry['starttime'],
+                reverse=True
+            )
+            return [dict(entry) for entry in entries[:params['limit']]]
+
+    def _status(self, params, node, upid):
+        with self.lock:
+            entry = self.entries[upid]
+            if 'endtime' in entry:
+                return {'upid': upid, 'status': 'stopped', 'exitstatus': entry['status']}
+            return {'upid': upid, 'status': 'running'}
+
+
+@pytest.fixture
+def api(tmp_path):
+    return FakeProxmoxAPI(str(tmp_path))
+
+
+@pytest.fixture
+def tasks(api):
+    return Tasks(api)
+
+
+@pytest.fixture
+def waiter(api, monkeypatch):
+    monkeypatch.setattr(settings, 'PROXMOX_TASK_POLL_MIN_SECONDS', 0.05)
+    monkeypatch.setattr(settings, 'PROXMOX_TASK_POLL_MAX_SECONDS', 0.4)
+    waiter = ProxmoxTaskWaiter(SimpleNamespace(api=api))
+    yield waiter
+    waiter.close()
+
+
+def later(seconds, action, *args, **kwargs):
+    timer = threading.Timer(seconds, action, args, kwargs)
+    timer.start()
+    return timer
+
+
+def status_lookups(api):
+    return [path for method, path, params in api.requests if path.endswith('/status')]
+
+
+def test_upid_is_parsed():
+    task = ProxmoxTask('UPID:pve2:0001B3A1:0A2C51F0:6717C0DE:qmcreate:105:root@pam:')
+
+    assert (task.node, task.type, task.id) == ('pve2', 'qmcreate', '105')
+    assert task.started_at == 0x6717C0DE
+
+    with pytest.raises(ValueError):
+        ProxmoxTask('pve2:qmcreate:105')
+
+
+def test_wait_returns_once_the_task_stops(waiter, tasks):
+    task = tasks.start()
+    later(0.2, tasks.finish, task)
+
+    outcome = waiter.wait(task, timeout=5)
+
+    assert outcome['status'] == 'OK'
+    assert outcome['error'] is None
+    assert outcome['duration_seconds'] >= 0
+
+
+def test_failed_task_raises_and_warnings_do_not(waiter, tasks):
+    failing = tasks.start(vmid=100)
+    warning = tasks.start(vmid=101)
+    tasks.finish(failing, status="command 'qm start' failed: exit code 1")
+    tasks.finish(warning, status='WARNINGS: 2')
+
+    with pytest.raises(Exception, match='exit code 1'):
+        waiter.wait(failing, timeout=5)
+    assert waiter.wait(warning, timeout=5)['status'] == 'WARNINGS: 2'
+
+
+def test_tasks_of_a_node_are_polled_with_one_listing(waiter, tasks, api):
+    batch = [tasks.start(vmid=100 + n) for n in range(20)]
+    for n, task in enumerate(batch):
+        later(0.05 + 0.02 * n, tasks.finish, task)
+
+    outcomes = waiter.wait_many(batch, timeout=5)
+
+    assert all(outcome['status'] == 'OK' for outcome in outcomes)
+    # A listing per round, never a lookup per task
+    assert len(tasks.listed_at) < len(batch)
+    assert status_lookups(api) == []
+
+
+def test_nodes_are_listed_separately(waiter, tasks, api):
+    first = tasks.start(node='pve1')
+    second = tasks.start(node='pve2')
+    tasks.finish(first)
+    tasks.finish(second)
+
+    waiter.wait_many([first, second], timeout=5)
+
+    listed = {path for method, path, params in api.requests if path.endswith('/tasks')}
+    assert listed == {'nodes/pve1/tasks', 'nodes/pve2/tasks'}
+
+
+def test_task_beyond_the_listing_is_looked_up(waiter, tasks, api, monkeypatch):
+    monkeypatch.setattr(ProxmoxTaskWaiter, 'LIST_LIMIT', 3)
+    now = int(time.time())
+    old = tasks.start(started_at=now - 60)
+    for n in range(5):
+        tasks.start(started_at=now + n)
+    tasks.finish(old)
+
+    outcome = waiter.wait(old, timeout=5)
+
+    assert outcome['status'] == 'OK'
+    assert status_lookups(api) == [f'nodes/pve1/tasks/{old.upid}/status']
+
+
+def test_polling_backs_off_while_nothing_finishes(waiter, tasks):
+    task = tasks.start()
+
+    outcome = waiter.wait_many([task], timeout=1.5)[0]
+
+    assert isinstance(outcome['error'], TimeoutError)
+    gaps = [b - a for a, b in zip(tasks.listed_at, tasks.listed_at[1:])]
+    # 0.1, 0.2, then the 0.4 cap
+    assert gaps[0] < 0.2
+    assert gaps[-1] == pytest.approx(0.4, abs=0.1)
+    assert max(gaps) < 0.6
+    assert len(tasks.listed_at) <= 8
+
+
+def test_new_task_is_looked_at_promptly(waiter, tasks):
+    waiter.wait_many([tasks.start(vmid=100)], timeout=1.2)
+    task = tasks.start(vmid=101)
+    tasks.finish(task)
+
+    started = time.monotonic()
+    waiter.wait(task, timeout=5)
+
+    assert time.monotonic() - started < 0.2
+
+
+def test_polling_errors_are_retried(waiter, tasks):
+    task = tasks.start()
+    tasks.failing = True
+    later(0.3, setattr, tasks, 'failing', False)
+    later(0.3, tasks.finish, task)
+
+    assert waiter.wait(task, timeout=5)['status'] == 'OK'
+
+
+def test_idle_waiter_stops_its_thread(waiter, tasks):
+    task = tasks.start()
+    tasks.finish(task)
+    waiter.wait(task, timeout=5)
+
+    deadline = time.monotonic() + 2
+    while waiter.thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert waiter.thread is None
@@ -0,0 +1,115 @@
+"""Storage targets writing volumes as local files, with TRANSFER_WRITER=local"""
+import pytest
+
+from app.config import settings
+from app.services.disk_transfer import DiskTransfer, LocalFileReader
+from app.services.storage_targets import FileTarget, LvmTarget, VolumeWriter, storage_target
+from fake_proxmox import APIError, FakeProxmoxAPI, connector
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def local_writer(monkeypatch):
+    monkeypatch.setattr(settings, 'TRANSFER_WRITER', 'local')
+
+
+@pytest.fixture
+def api(tmp_path):
+    return FakeProxmoxAPI(str(tmp_path), storages={
+        'local': {'type': 'dir', 'path': '/var/lib/vz'},
+        'vg': {'type': 'lvm', 'vgname': 'pve'},
+        'cold': {'type': 'glusterfs'},
+    })
+
+
+@pytest.fixture
+def proxmox(api):
+    return connector(api)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_storage_target_picks_target_by_storage_type(proxmox):
+    assert type(storage_target(proxmox, 'pve1', 'local')) is FileTarget
+    assert type(storage_target(proxmox, 'pve1', 'vg')) is LvmTarget
+    with pytest.raises(ValueError, match='glusterfs'):
+        storage_target(proxmox, 'pve1', 'cold')
+    with pytest.raises(ValueError, match='not available'):
+        storage_target(proxmox, 'pve1', 'missing')
+
+
+@pytest.mark.parametrize('storage, volid', [
+    ('local', 'local:120/vm-120-disk-0.raw'),
+    ('vg', 'vg:vm-120-disk-0'),
+])
+def test_allocate_disk_meets_the_api_contract(proxmox, api, storage, volid):
+    # 3 MiB and a byte: the size is rounded up to whole KiB, sent without unit
+    assert proxmox.allocate_disk('pve1', storage, 120, 'disk-0', 3 * MIB + 1) == volid
+
+    _, _, params = api.requests[-1]
+    assert params['size'] == str(3 * 1024 + 1)
+    assert params['format'] == 'raw'
+
+
+def test_allocate_disk_looks_up_the_storage_type(proxmox, api):
+    proxmox.allocate_disk('pve1', 'local', 120, 'disk-0', MIB)
+
+    assert [path for _, path, _ in api.requests] == ['storage/local', 'nodes/pve1/storage/local/content']
+
+
+def test_fake_api_rejects_what_pve_rejects(api):
+    with pytest.raises(APIError, match='size'):
+        api.nodes('pve1').storage('vg').content.post(vmid=120, filename='vm-120-disk-0', size='1024K', format='raw')
+    with pytest.raises(APIError, match='illegal name'):
+        api.nodes('pve1').storage('local').content.post(vmid=120, filename='vm-120-disk-0', size='1024', format='raw')
+
+
+def test_file_target_writes_allocated_volume_in_place(proxmox, api, image):
+    source, contents = image('source.raw', [('data', MIB), ('hole', 2 * MIB), ('data', MIB)])
+
+    with storage_target(proxmox, 'pve1', 'local') as target, LocalFileReader(source) as reader:
+        volid = target.allocate(120, 'disk-0', reader.size())
+        with target.writer(volid, zeroed=True) as writer:
+            stats = DiskTransfer(reader, writer, chunk_size=MIB).run()
+            digests = writer.chunk_digests(stats['size_bytes'], MIB)
+
+    assert volid == 'local:120/vm-120-disk-0.raw'
+    assert read(api.volume_path(volid)) == contents
+    assert stats['bytes_skipped'] == 2 * MIB
+    assert len(digests) == 4
+
+
+def test_volume_writer_releases_volume_on_close(proxmox, api):
+    target = storage_target(proxmox, 'pve1', 'local')
+    volid = target.allocate(120, 'disk-0', MIB)
+    writer = target.writer(volid)
+    assert isinstance(writer, VolumeWriter)
+
+    writer.open(MIB)
+    assert writer.path == api.volume_path(volid)
+    writer.close()
+    assert writer.path is None and writer.inner is None
+    # Closing twice is harmless
+    writer.close()
+
+
+def test_thick_lvm_volumes_are_never_treated_as_zeroed(proxmox):
+    target = storage_target(proxmox, 'pve1', 'vg')
+    volid = target.allocate(121, 'disk-0', MIB)
+
+    # The volume's path exists, so activation neither runs lvchange nor waits
+    with target.writer(volid, zeroed=True) as writer:
+        writer.open(MIB)
+        assert not writer.zeroed
+
+
+def test_run_executes_locally_and_raises_on_failure(proxmox):
+    target = storage_target(proxmox, 'pve1', 'local')
+
+    assert target.run('echo ready').strip() == 'ready'
+    with pytest.raises(IOError, match='failed'):
+        target.run('echo broken >&2; exit 3')
@@ -0,0 +1,70 @@
+"""Proxmox options of a migrated VM, from its vCenter description"""
+from app.services.vm_spec import create_spec, disks_spec
+
+
+def vm_info(**overrides):
+    info = {
+        'name': 'web-01',
+        'cpu_cores': 4,
+        'memory_mb': 8192,
+        'networks': [
+            {'name': 'Network adapter 1', 'mac': '00:50:56:aa:bb:01'},
+            {'name': 'Network adapter 2', 'mac': '00:50:56:aa:bb:02'},
+        ]
+    }
+    info.update(overrides)
+    return info
+
+
+def test_create_spec_carries_the_source_hardware():
+    assert create_spec(vm_info()) == {
+        'cores': 4,
+        'sockets': 1,
+        'memory': 8192,
+        'ostype': 'l26',
+        'net0': 'virtio=00:50:56:aa:bb:01,bridge=vmbr0,firewall=1',
+        'net1': 'virtio=00:50:56:aa:bb:02,bridge=vmbr0,firewall=1',
+    }
+
+
+def test_job_overrides_win():
+    spec = create_spec(vm_info(), {
+        'cpu_cores': 2, 'cpu_sockets': 2, 'memory_mb': 4096,
+        'network_type': 'e1000', 'network_bridge': 'vmbr1'
+    })
+
+    assert (spec['cores'], spec['sockets'], spec['memory']) == (2, 2, 4096)
+    assert spec['net0'] == 'e1000=00:50:56:aa:bb:01,bridge=vmbr1,firewall=1'
+    assert spec['net1'] == 'e1000=00:50:56:aa:bb:02,bridge=vmbr1,firewall=1'
+
+
+def test_empty_overrides_fall_back_to_the_source():
+    spec = create_spec(vm_info(), {'cpu_cores': None, 'memory_mb': 0, 'network_bridge': ''})
+
+    assert (spec['cores'], spec['memory']) == (4, 8192)
+    assert spec['net0'].endswith('bridge=vmbr0,firewall=1')
+
+
+def test_nic_without_a_mac_gets_a_generated_one():
+    spec = create_spec(vm_info(networks=[{'name': 'Network adapter 1', 'mac': None}]))
+
+    assert spec['net0'] == 'virtio,bridge=vmbr0,firewall=1'
+
+
+def test_vm_without_nics_gets_none():
+    for networks in ([], None):
+        spec = create_spec(vm_info(networks=networks))
+
+        assert not [option for option in spec if option.startswith('net')]
+
+
+def test_disks_are_attached_in_index_order_and_booted_in_it():
+    spec = disks_spec({2: 'ceph:vm-105-disk-2', 0: 'ceph:vm-105-disk-0', 1: 'ceph:vm-105-disk-1'})
+
+    assert list(spec) == ['scsi0', 'scsi1', 'scsi2', 'boot']
+    assert spec['scsi1'] == 'ceph:vm-105-disk-1'
+    assert spec['boot'] == 'order=scsi0;scsi1;scsi2'
+
+
+def test_no_volumes_set_no_boot_order():
+    assert disks_spec({}) == {}
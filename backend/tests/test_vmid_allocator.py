@@ -0,0 +1,190 @@
+"""VMID leases of concurrent jobs, against an in-memory Redis running the lease scripts"""
+import threading
+
+import pytest
+
+from app.config import settings
+from app.services.vmid_allocator import _REDIS_LEASE, _REDIS_RELEASE, VMIDAllocator
+
+
+class FakeRedis:
+    """
+    The key and set commands the allocator uses, with its two scripts
+    done in Python; a script runs as one step, as it does in Redis.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.mutex = threading.RLock()
+        self.down = False
+
+    def register_script(self, script):
+        run = {_REDIS_LEASE: self._lease, _REDIS_RELEASE: self._release}[script]
+
+        def call(keys, args):
+            if self.down:
+                raise ConnectionError("Connection refused")
+            with self.mutex:
+                return run(keys, [str(arg) for arg in args])
+        return call
+
+    def smembers(self, key):
+        if self.down:
+            raise ConnectionError("Connection refused")
+        with self.mutex:
+            return {member.encode() for member in self.sets.get(key, set())}
+
+    def mget(self, keys):
+        with self.mutex:
+            return [self.values[key].encode() if key in self.values else None for key in keys]
+
+    def _lease(self, keys, args):
+        prefix, job_key = keys
+        wanted, owner = int(args[0]), args[1]
+        leased = []
+        for vmid in args[3:]:
+            if len(leased) >= wanted:
+                break
+            if prefix + vmid not in self.values:
+                self.values[prefix + vmid] = owner
+                leased.append(vmid)
+        self.sets.setdefault(job_key, set()).update(leased)
+        return [vmid.encode() for vmid in leased]
+
+    def _release(self, keys, args):
+        prefix, job_key = keys
+        released = 0
+        for vmid in args[1:]:
+            if self.values.get(prefix + vmid) == args[0]:
+                del self.values[prefix + vmid]
+                released += 1
+            self.sets.get(job_key, set()).discard(vmid)
+        return released
+
+
+class Cluster:
+    """A ProxmoxConnector's view of the VMs on a cluster"""
+
+    host = 'pve.example'
+
+    def __init__(self, vmids, barrier=None):
+        self.vmids = set(vmids)
+        self.barrier = barrier
+
+    def get_cluster_resources(self):
+        resources = [{'type': 'node', 'node': 'pve1'}] + [
+            {'type': 'qemu', 'vmid': vmid, 'node': 'pve1'} for vmid in sorted(self.vmids)
+        ]
+        if self.barrier is not None:
+            # Every job has listed the cluster before any leases
+            self.barrier.wait(5)
+        return resources
+
+
+@pytest.fixture(autouse=True)
+def vmid_range(monkeypatch):
+    monkeypatch.setattr(settings, 'PROXMOX_VMID_MIN', 100)
+    monkeypatch.setattr(settings, 'PROXMOX_VMID_MAX', 999)
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+def worker(redis):
+    """The allocator of one worker process, sharing redis with the others"""
+    allocator = VMIDAllocator()
+    allocator._redis = redis
+    allocator._lease = redis.register_script(_REDIS_LEASE)
+    allocator._release = redis.register_script(_REDIS_RELEASE)
+    return allocator
+
+
+def test_free_ids_are_leased_lowest_first(redis):
+    cluster = Cluster({100, 101, 103})
+
+    assert worker(redis).reserve(cluster, job_id=1, count=3) == [102, 104, 105]
+
+
+def test_jobs_listing_the_cluster_together_get_different_ids(redis):
+    jobs = 8
+    cluster = Cluster({100, 102}, barrier=threading.Barrier(jobs))
+    results = {}
+
+    def reserve(job_id):
+        # Each job on a worker of its own
+        results[job_id] = worker(redis).reserve(cluster, job_id=job_id, count=5)
+
+    threads = [threading.Thread(target=reserve, args=(job_id,)) for job_id in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    leased = [vmid for vmids in results.values() for vmid in vmids]
+    assert len(results) == jobs
+    assert len(set(leased)) == jobs * 5
+    assert not set(leased) & cluster.vmids
+
+
+def test_retried_job_gets_its_block_back(redis):
+    cluster = Cluster(set())
+    first = worker(redis).reserve(cluster, job_id=1, count=3)
+    worker(redis).reserve(cluster, job_id=2, count=2)
+
+    # Its first VM was created before the retry
+    cluster.vmids.add(first[0])
+    again = worker(redis).reserve(cluster, job_id=1, count=3)
+
+    assert first == [100, 101, 102]
+    assert again == [101, 102, 105]
+
+
+def test_released_ids_are_free_again(redis):
+    cluster = Cluster(set())
+    allocator = worker(redis)
+    allocator.reserve(cluster, job_id=1, count=3)
+
+    allocator.release(cluster.host, 1, [100])
+    # Another job's lease is not the job's to give back
+    allocator.release(cluster.host, 2, [101])
+
+    assert allocator.reserve(cluster, job_id=2, count=2) == [100, 103]
+
+
+def test_release_job_gives_back_every_lease(redis):
+    cluster = Cluster(set())
+    allocator = worker(redis)
+    allocator.reserve(cluster, job_id=1, count=4)
+
+    allocator.release_job(cluster.host, 1)
+
+    assert worker(redis).reserve(cluster, job_id=2, count=4) == [100, 101, 102, 103]
+
+
+def test_too_few_free_ids_fails_without_keeping_any(redis):
+    cluster = Cluster({100, 102})
+    allocator = worker(redis)
+
+    with pytest.raises(ValueError, match='Only 3 of 5'):
+        allocator.reserve(cluster, job_id=1, count=5, first=100, last=104)
+
+    assert redis.values == {}
+
+
+def test_without_redis_jobs_of_the_process_are_kept_apart(redis):
+    redis.down = True
+    cluster = Cluster({101})
+    allocator = worker(redis)
+
+    first = allocator.reserve(cluster, job_id=1, count=2)
+    second = allocator.reserve(cluster, job_id=2, count=2)
+    # Created since, so no longer leased
+    cluster.vmids.add(first[0])
+    again = allocator.reserve(cluster, job_id=1, count=2)
+
+    assert first == [100, 102]
+    assert second == [103, 104]
+    assert again == [102, 105]
@@ -0,0 +1,299 @@
+"""Inventory filtering, cursor paging and the shared cache, against an in-memory Redis"""
+import threading
+import time
+
+import pytest
+
+from app.config import settings
+from app.services import vmware_inventory
+from app.services.vmware_inventory import InventoryCache, decode_cursor, filter_vms, paginate, sort_key
+
+
+def vm(moid, name, status='poweredOn', disk_size_gb=10, folder='prod', cluster='c1'):
+    return {
+        'id': moid, 'name': name, 'status': status, 'disk_size_gb': disk_size_gb,
+        'folder': folder, 'cluster': cluster
+    }
+
+
+class FakeLock:
+    def __init__(self, redis, name):
+        self.redis = redis
+        self.name = name
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        deadline = time.monotonic() + (blocking_timeout or 5)
+        while True:
+            with self.redis.mutex:
+                if self.name not in self.redis.locks:
+                    self.redis.locks.add(self.name)
+                    return True
+            if not blocking or time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+
+    def release(self):
+        with self.redis.mutex:
+            self.redis.locks.discard(self.name)
+
+
+class FakePipeline:
+    """Queues commands and runs them together on execute(), like a MULTI"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.redis.mutex:
+            return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeRedis:
+    """The hash, key and lock commands the inventory cache uses"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.locks = set()
+        self.mutex = threading.RLock()
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        if self.down:
+            raise ConnectionError("Redis is down")
+        return FakePipeline(self)
+
+    def lock(self, name, timeout=None):
+        return FakeLock(self, name)
+
+    def exists(self, key):
+        return int(key in self.hashes)
+
+    def hget(self, key, field):
+        value = self.hashes.get(key, {}).get(field)
+        return str(value).encode() if value is not None else None
+
+    def hvals(self, key):
+        return list(self.hashes.get(key, {}).values())
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes.get(key, {}).pop(field, None)
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def expire(self, key, seconds):
+        pass
+
+
+class FakeConnector:
+    """
+    A vCenter session with an inventory feed
+
+    The feed's first changes after a reset are the whole inventory; after
+    that, what the test queued with change().
+    """
+
+    def __init__(self, vms):
+        self.host = 'vcenter.example'
+        self.user = 'admin'
+        self.password = 'secret'
+        self.port = 443
+        self.verify_ssl = False
+        self.vms = {item['id']: item for item in vms}
+        self.deltas = []
+        self.fed = False
+        self.full_loads = 0
+        self.live_listings = 0
+
+    def __call__(self, **kwargs):
+        # Background refreshes open a connector of their own
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def change(self, updated=(), removed=()):
+        for item in updated:
+            self.vms[item['id']] = item
+        for moid in removed:
+            self.vms.pop(moid)
+        self.deltas.append(({item['id']: item for item in updated}, list(removed)))
+
+    def reset_inventory_feed(self):
+        self.fed = False
+
+    def inventory_changes(self):
+        if not self.fed:
+            self.fed = True
+            self.deltas = []
+            self.full_loads += 1
+            return True, dict(self.vms), []
+        updated, removed = {}, []
+        for delta_updated, delta_removed in self.deltas:
+            updated.update(delta_updated)
+            removed.extend(delta_removed)
+        self.deltas = []
+        return False, updated, removed
+
+    def iter_vms(self):
+        self.live_listings += 1
+        yield from self.vms.values()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(InventoryCache, '_client', lambda self: redis)
+    return redis
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    connector = FakeConnector([vm('vm-3', 'web-02'), vm('vm-1', 'db-01'), vm('vm-2', 'web-01')])
+    monkeypatch.setattr(vmware_inventory, 'VMwareConnector', connector)
+    return connector
+
+
+def settle(cache):
+    """Wait for background refreshes to finish"""
+    deadline = time.monotonic() + 5
+    while cache._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not cache._refreshing
+
+
+def names(vms):
+    return [item['name'] for item in vms]
+
+
+def test_pages_cover_every_vm_once_in_order():
+    vms = sorted([vm(f'vm-{n}', f'host-{n % 4}') for n in range(11)], key=sort_key)
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = paginate(vms, limit=3, cursor=cursor)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [3, 3, 3, 2]
+    assert [item for page in pages for item in page] == vms
+
+
+def test_page_boundary_stays_put_while_vms_come_and_go():
+    vms = sorted([vm('vm-1', 'a'), vm('vm-2', 'b'), vm('vm-3', 'c'), vm('vm-4', 'd')], key=sort_key)
+    first, cursor = paginate(vms, limit=2)
+
+    # One VM before the boundary is deleted, another created before it
+    changed = sorted([vm('vm-2', 'b'), vm('vm-5', 'aa'), vm('vm-3', 'c'), vm('vm-4', 'd')], key=sort_key)
+    second, cursor = paginate(changed, limit=2, cursor=cursor)
+
+    assert names(first) == ['a', 'b']
+    assert names(second) == ['c', 'd']
+    assert cursor is None
+
+
+def test_vms_with_the_same_name_are_paged_by_id():
+    vms = sorted([vm('vm-2', 'web'), vm('vm-1', 'web'), vm('vm-3', 'web')], key=sort_key)
+
+    first, cursor = paginate(vms, limit=2)
+    second, _ = paginate(vms, limit=2, cursor=cursor)
+
+    assert [item['id'] for item in first + second] == ['vm-1', 'vm-2', 'vm-3']
+
+
+def test_malformed_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor')
+
+
+def test_filters():
+    vms = [
+        vm('vm-1', 'Web-01', disk_size_gb=20),
+        vm('vm-2', 'db-web', status='poweredOff', disk_size_gb=200),
+        vm('vm-3', 'web-02', folder='test', cluster='c2', disk_size_gb=50),
+    ]
+
+    assert names(filter_vms(vms, name='web')) == ['Web-01', 'db-web', 'web-02']
+    assert names(filter_vms(vms, name='web-*')) == ['Web-01', 'web-02']
+    assert names(filter_vms(vms, power_state='poweredOff')) == ['db-web']
+    assert names(filter_vms(vms, folder='test', cluster='c2')) == ['web-02']
+    assert names(filter_vms(vms, min_disk_gb=20, max_disk_gb=50)) == ['Web-01', 'web-02']
+
+
+def test_first_listing_loads_the_cache_then_serves_from_it(redis, connector):
+    cache = InventoryCache()
+
+    vms, age = cache.list_vms(connector)
+    again, _ = cache.list_vms(connector)
+
+    assert names(vms) == ['db-01', 'web-01', 'web-02']
+    assert age < 1
+    assert again == vms
+    assert connector.full_loads == 1
+    assert connector.live_listings == 0
+
+
+def test_stale_cache_is_served_and_refreshed_with_deltas(redis, connector, monkeypatch):
+    monkeypatch.setattr(settings, 'VMWARE_INVENTORY_MAX_AGE_SECONDS', 0)
+    cache = InventoryCache()
+    cache.list_vms(connector)
+    connector.change(updated=[vm('vm-4', 'app-01'), vm('vm-2', 'web-01', status='poweredOff')], removed=['vm-3'])
+
+    stale, _ = cache.list_vms(connector)
+    settle(cache)
+    fresh, _ = cache.list_vms(connector)
+    settle(cache)
+
+    assert names(stale) == ['db-01', 'web-01', 'web-02']
+    assert names(fresh) == ['app-01', 'db-01', 'web-01']
+    assert fresh[2]['status'] == 'poweredOff'
+    # Only the first load was a full one
+    assert connector.full_loads == 1
+
+
+def test_empty_cache_streams_live_without_waiting(redis, connector):
+    cache = InventoryCache()
+
+    vms, age = cache.list_vms(connector, wait=False)
+    live = list(vms)
+    settle(cache)
+
+    assert age is None
+    assert sorted(names(live)) == ['db-01', 'web-01', 'web-02']
+    # Filled in the background for the next caller
+    assert names(cache.list_vms(connector)[0]) == ['db-01', 'web-01', 'web-02']
+
+
+def test_lost_cache_starts_the_feed_over(redis, connector):
+    cache = InventoryCache()
+    cache.list_vms(connector)
+    redis.hashes.clear()
+
+    vms, _ = cache.list_vms(connector)
+
+    assert names(vms) == ['db-01', 'web-01', 'web-02']
+    assert connector.full_loads == 2
+
+
+def test_unavailable_redis_lists_live(redis, connector):
+    redis.down = True
+
+    vms, age = InventoryCache().list_vms(connector)
+
+    assert age is None
+    assert sorted(names(vms)) == ['db-01', 'web-01', 'web-02']
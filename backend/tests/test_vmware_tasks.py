@@ -0,0 +1,189 @@
+"""TaskWaiter against a fake PropertyCollector that long-polls like vCenter"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from pyVmomi import vim, vmodl
+
+from app.config import settings
+from app.connectors.vmware_tasks import TaskWaiter
+
+
+class FakeFilter:
+    def __init__(self, collector, moid, task):
+        self.collector = collector
+        self._moId = moid
+        self.task = task
+
+    def DestroyPropertyFilter(self):
+        with self.collector.changed:
+            self.collector.filters.pop(self._moId, None)
+
+
+class FakeCollector:
+    """
+    A PropertyCollector over tasks the test moves along with set_task()
+
+    WaitForUpdatesEx blocks until a watched task changed or maxWaitSeconds
+    passed, and only reports what changed since the last call.
+    """
+
+    def __init__(self):
+        self.filters = {}
+        self.tasks = {}
+        # Task moId -> properties changed since the last update
+        self.dirty = {}
+        self.changed = threading.Condition()
+        self.version = 0
+        self.polls = 0
+        self.pollers = set()
+        self.fail_with = None
+        self.cancelled = False
+
+    def CreateFilter(self, spec, partial_updates):
+        task = spec.objectSet[0].obj
+        with self.changed:
+            moid = f'filter-{len(self.filters) + self.version}-{task._moId}'
+            self.filters[moid] = FakeFilter(self, moid, task)
+            # The first update reports the current values
+            self.dirty[task._moId] = dict(self.tasks.setdefault(task._moId, {'info.state': 'running'}))
+            self.changed.notify_all()
+        return self.filters[moid]
+
+    def set_task(self, moid, **values):
+        with self.changed:
+            for name, value in values.items():
+                self.tasks.setdefault(moid, {})[f'info.{name}'] = value
+                self.dirty.setdefault(moid, {})[f'info.{name}'] = value
+            self.changed.notify_all()
+
+    def fail(self, error):
+        """Make the waiting call fail, like a dropped session"""
+        with self.changed:
+            self.fail_with = error
+            self.changed.notify_all()
+
+    def WaitForUpdatesEx(self, version, options):
+        with self.changed:
+            self.polls += 1
+            self.pollers.add(threading.current_thread())
+            self.changed.wait_for(
+                lambda: self.fail_with or self.cancelled or any(
+                    watched.task._moId in self.dirty for watched in self.filters.values()
+                ),
+                timeout=options.maxWaitSeconds
+            )
+            if self.cancelled:
+                self.cancelled = False
+                raise vmodl.fault.RequestCanceled()
+            if self.fail_with:
+                raise self.fail_with
+            filter_set = []
+            for watched in self.filters.values():
+                changes = self.dirty.pop(watched.task._moId, None)
+                if changes:
+                    filter_set.append(SimpleNamespace(filter=watched, objectSet=[SimpleNamespace(
+                        changeSet=[SimpleNamespace(name=name, val=value) for name, value in changes.items()]
+                    )]))
+            if not filter_set:
+                return None
+            self.version += 1
+            return SimpleNamespace(version=str(self.version), filterSet=filter_set)
+
+    def CancelWaitForUpdates(self):
+        with self.changed:
+            self.cancelled = True
+            self.changed.notify_all()
+
+    def DestroyPropertyCollector(self):
+        pass
+
+
+@pytest.fixture
+def collector():
+    return FakeCollector()
+
+
+@pytest.fixture
+def waiter(collector, monkeypatch):
+    monkeypatch.setattr(settings, 'VMWARE_TASK_POLL_SECONDS', 1)
+    content = SimpleNamespace(propertyCollector=SimpleNamespace(CreatePropertyCollector=lambda: collector))
+    waiter = TaskWaiter(SimpleNamespace(RetrieveContent=lambda: content))
+    yield waiter
+    waiter.close()
+
+
+def later(seconds, action, *args, **kwargs):
+    timer = threading.Timer(seconds, action, args, kwargs)
+    timer.start()
+    return timer
+
+
+def test_wait_returns_once_the_task_succeeds(waiter, collector):
+    later(0.2, collector.set_task, 'task-1', progress=50)
+    later(0.4, collector.set_task, 'task-1', state='success', result='snapshot-7')
+    progress = []
+
+    result = waiter.wait(vim.Task('task-1'), timeout=5, progress_callback=progress.append)
+
+    assert result == 'snapshot-7'
+    assert progress == [50]
+    # Woken by changes, not by polling
+    assert collector.polls <= 4
+    assert collector.filters == {}
+
+
+def test_failed_task_raises_its_message(waiter, collector):
+    later(0.1, collector.set_task, 'task-1', state='error', error=SimpleNamespace(msg='Insufficient disk space'))
+
+    with pytest.raises(Exception, match='Insufficient disk space'):
+        waiter.wait(vim.Task('task-1'), timeout=5)
+
+
+def test_wait_many_reports_each_task(waiter, collector):
+    collector.set_task('task-2', state='success', result='done early')
+    later(0.1, collector.set_task, 'task-1', state='error', error=SimpleNamespace(msg='Locked'))
+    later(0.2, collector.set_task, 'task-3', state='success', result=None)
+
+    outcomes = waiter.wait_many([vim.Task('task-1'), vim.Task('task-2'), vim.Task('task-3')], timeout=5)
+
+    assert [outcome['error'] for outcome in outcomes] == ['Locked', None, None]
+    assert outcomes[1]['result'] == 'done early'
+
+
+def test_task_still_running_at_the_deadline_times_out(waiter, collector):
+    started = time.monotonic()
+
+    outcomes = waiter.wait_many([vim.Task('task-1')], timeout=0.3)
+
+    assert isinstance(outcomes[0]['error'], TimeoutError)
+    assert time.monotonic() - started < 2
+    assert collector.filters == {}
+
+
+def test_many_threads_share_one_collector_thread(waiter, collector):
+    results = {}
+
+    def wait(number):
+        results[number] = waiter.wait(vim.Task(f'task-{number}'), timeout=5)
+
+    threads = [threading.Thread(target=wait, args=(number,)) for number in range(10)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    for number in range(10):
+        collector.set_task(f'task-{number}', state='success', result=number)
+    for thread in threads:
+        thread.join(5)
+
+    assert results == {number: number for number in range(10)}
+    assert len(collector.pollers) == 1
+
+
+def test_lost_connection_fails_every_waiting_task(waiter, collector):
+    later(0.2, collector.fail, ConnectionError("Connection reset"))
+
+    outcomes = waiter.wait_many([vim.Task('task-0'), vim.Task('task-1')], timeout=5)
+
+    assert all('Connection reset' in outcome['error'] for outcome in outcomes)
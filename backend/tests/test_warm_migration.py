@@ -0,0 +1,215 @@
+"""WarmMigration against a fake vSphere connector and local raw images"""
+import pytest
+
+from app.services.disk_transfer import LocalFileReader, LocalFileWriter
+from app.services.warm_migration import ALL_ALLOCATED, WarmMigration
+
+MIB = 1024 * 1024
+
+
+class FakeVMware:
+    """
+    A running VM whose disks are local raw images
+
+    writes[n] lists the (disk_index, offset, data) the guest writes before
+    snapshot n + 1 is taken, so they show up as changed areas of that
+    snapshot. Snapshots are not copies; the images are read as they are.
+    """
+
+    def __init__(self, disk_paths, writes, report_changes=True):
+        self.disk_paths = disk_paths
+        self.writes = writes
+        self.report_changes = report_changes
+        self.events = []
+        self.snapshots = []
+        # Change ID -> (disk_index, offset, length) written before that snapshot
+        self.changes = {}
+
+    def enable_change_tracking(self, vm_name):
+        self.events.append(('cbt', vm_name))
+
+    def power_off_vm(self, vm_name):
+        self.events.append(('power_off', vm_name))
+
+    def power_on_vm(self, vm_name):
+        self.events.append(('power_on', vm_name))
+
+    def create_snapshot(self, vm_name, snapshot_name, quiesce=True):
+        number = len(self.changes)
+        areas = []
+        for disk_index, offset, data in (self.writes[number] if number < len(self.writes) else []):
+            with open(self.disk_paths[disk_index], 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            areas.append((disk_index, offset, len(data)))
+        self.changes[str(number)] = areas
+        self.snapshots.append(snapshot_name)
+        self.events.append(('snapshot', snapshot_name, quiesce))
+
+    def get_snapshot_disks(self, vm_name, snapshot_name):
+        number = str(len(self.changes) - 1)
+        return [
+            {'key': 2000 + index, 'file_name': path, 'capacity_bytes': 4 * MIB, 'change_id': number}
+            for index, path in enumerate(self.disk_paths)
+        ]
+
+    def query_changed_areas(self, vm_name, snapshot_name, disk_key, change_id, capacity_bytes):
+        if change_id == ALL_ALLOCATED:
+            return [(0, capacity_bytes)]
+        disk_index = disk_key - 2000
+        newer = [number for number in self.changes if int(number) > int(change_id)]
+        return [
+            (offset, length)
+            for number in newer
+            for index, offset, length in self.changes[number]
+            if index == disk_index and self.report_changes
+        ]
+
+    def get_snapshot_moref(self, vm_name, snapshot_name):
+        return f'snapshot-{self.snapshots.index(snapshot_name)}'
+
+    def remove_snapshot(self, vm_name, snapshot_name):
+        self.snapshots.remove(snapshot_name)
+        self.events.append(('remove', snapshot_name))
+
+
+@pytest.fixture
+def disks(image):
+    return [
+        image('disk0.raw', [('data', 2 * MIB), ('hole', 2 * MIB)]),
+        image('disk1.raw', [('data', 4 * MIB)]),
+    ]
+
+
+def migrate(vmware, tmp_path, fail_at_open=None, **kwargs):
+    """Run a WarmMigration; fail_at_open makes the writer factory fail on that call"""
+    targets = [str(tmp_path / f'target{index}.raw') for index in range(len(vmware.disk_paths))]
+    opened = []
+
+    def writer_factory(disk_index, disk, zeroed):
+        opened.append((disk_index, zeroed))
+        if len(opened) == fail_at_open:
+            raise IOError("Target storage went away")
+        return LocalFileWriter(targets[disk_index], zeroed=zeroed)
+
+    result = WarmMigration(
+        vmware,
+        'web01',
+        lambda disk_index, disk, snapshot_moref: LocalFileReader(disk['file_name']),
+        writer_factory,
+        **kwargs
+    ).run()
+    return result, targets, opened
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_copies_changed_areas_until_cutover(disks, tmp_path):
+    writes = [
+        [],
+        [(0, MIB, b'\x01' * 8192), (1, 3 * MIB, b'\x02' * 4096)],
+        [(1, 10, b'\x03' * 100)],
+        [(0, 3 * MIB, b'\x04' * 4096)],
+    ]
+    vmware = FakeVMware([path for path, _ in disks], writes)
+
+    result, targets, opened = migrate(vmware, tmp_path, max_passes=4, cutover_threshold_bytes=0, disk_parallelism=2)
+
+    assert result['pass_bytes'] == [8 * MIB, 8192 + 4096, 100, 4096]
+    assert result['cutover_bytes'] == 4096
+    for path, target in zip(vmware.disk_paths, targets):
+        assert read(target) == read(path)
+    # Only the full pass writes to targets known to read as zero
+    assert sorted(opened[:2]) == [(0, True), (1, True)]
+    assert all(not zeroed for _, zeroed in opened[2:])
+    # Disk 0 had nothing to copy in pass 3
+    assert len(opened) == 2 + 2 + 1 + 1
+
+
+def test_cutover_powers_off_then_snapshots_without_quiescing(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [])
+
+    result, _, _ = migrate(vmware, tmp_path, max_passes=3)
+
+    final_snapshot = [event for event in vmware.events if event[0] == 'snapshot'][-1]
+    assert vmware.events.index(('power_off', 'web01')) < vmware.events.index(final_snapshot)
+    assert final_snapshot[1] == result['backup_snapshot']
+    assert final_snapshot[2] is False
+    # Every pass snapshot but the backup is removed again
+    assert vmware.snapshots == [result['backup_snapshot']]
+
+
+def test_small_delta_brings_cutover_forward(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [[], [(0, 0, b'\x05' * 512)]])
+
+    result, _, _ = migrate(vmware, tmp_path, max_passes=5, cutover_threshold_bytes=MIB)
+
+    # Full pass, one small delta, then the cutover pass
+    assert result['passes'] == 3
+
+
+def test_validation_compares_targets_with_cutover_snapshot(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [[], [(1, MIB, b'\x06' * 4096)]])
+
+    result, targets, _ = migrate(vmware, tmp_path, max_passes=2, validate=True)
+
+    assert [disk['disk_index'] for disk in result['disks']] == [0, 1]
+    assert all(disk['validation']['passed'] for disk in result['disks'])
+    assert all(disk['warm'] and disk['size_bytes'] == 4 * MIB for disk in result['disks'])
+
+
+def test_validation_catches_unreported_changes(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [[], [(1, MIB, b'\x06' * 4096)]], report_changes=False)
+
+    result, _, _ = migrate(vmware, tmp_path, max_passes=2, validate=True)
+
+    validation = {disk['disk_index']: disk['validation'] for disk in result['disks']}
+    assert validation[0]['passed']
+    assert not validation[1]['passed']
+
+
+def test_merge_joins_touching_and_overlapping_areas():
+    assert WarmMigration._merge([(100, 10), (0, 10), (10, 5), (105, 20), (200, 1)]) == [(0, 15), (100, 25), (200, 1)]
+
+
+def test_failed_pass_removes_its_snapshots(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [[], [(1, MIB, b'\x07' * 4096)]])
+
+    with pytest.raises(IOError):
+        migrate(vmware, tmp_path, max_passes=3, fail_at_open=3)
+
+    # Failed in the delta pass, with both warm snapshots taken; none is left
+    taken = [event[1] for event in vmware.events if event[0] == 'snapshot']
+    assert [name[:len('migration-warm-1-')] for name in taken] == ['migration-warm-1-', 'migration-warm-2-']
+    assert vmware.snapshots == []
+    assert ('power_off', 'web01') not in vmware.events
+    assert ('power_on', 'web01') not in vmware.events
+
+
+def test_failed_cutover_powers_source_back_on(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [[], [(1, MIB, b'\x07' * 4096)]])
+
+    # Pass 1 opens both disks, the cutover fails on the one changed disk
+    with pytest.raises(IOError):
+        migrate(vmware, tmp_path, max_passes=2, fail_at_open=3)
+
+    assert vmware.snapshots == []
+    assert vmware.events.index(('power_off', 'web01')) < vmware.events.index(('power_on', 'web01'))
+
+
+def test_reused_targets_are_overwritten_whole(disks, tmp_path):
+    vmware = FakeVMware([path for path, _ in disks], [])
+    # An earlier attempt left data where disk 0 now has a hole
+    for index in range(2):
+        with open(tmp_path / f'target{index}.raw', 'wb') as f:
+            f.write(b'\xee' * 4 * MIB)
+
+    result, targets, opened = migrate(vmware, tmp_path, max_passes=2, reused_disks={0, 1})
+
+    for path, target in zip(vmware.disk_paths, targets):
+        assert read(target) == read(path)
+    assert result['pass_bytes'][0] == 8 * MIB
+    assert not any(zeroed for _, zeroed in opened)